@@ -0,0 +1,111 @@
+"""
+sizes the batches written to the sink from measured throughput
+
+fragments are still split at a fixed line count, the loader re-batches them so that each write to the sink
+takes about target_seconds: wide etab rows get large batches that amortise the per-statement overhead, and the
+legal batches shrink when the upserts spend their time waiting on row locks. the size chosen for each file is
+saved to batch_sizes.json so next month's run starts from it rather than from the default
+"""
+import json
+import logging
+import os
+import time
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+batch_size_file = os.environ.get('sirene_batch_size_file', 'batch_sizes.json')
+
+batch_size_bounds = {
+    'etab': {'initial_rows': 50000, 'min_rows': 10000, 'max_rows': 250000, 'target_seconds': 20},
+    'legal': {'initial_rows': 50000, 'min_rows': 5000, 'max_rows': 100000, 'target_seconds': 8},
+}
+
+
+def load_batch_sizes() -> dict:
+    if not os.path.exists(batch_size_file):
+        return {}
+    with open(batch_size_file) as f:
+        return json.load(f)
+
+
+class AdaptiveBatcher:
+    """
+    proposes the next batch size from the rows/sec and lock wait of the batches written so far
+    """
+
+    def __init__(self, kind: str, min_rows: int = None, max_rows: int = None, target_seconds: float = None,
+                 max_lock_share: float = 0.2, smoothing: float = 0.5):
+        """
+        :param kind: etab or legal, selects the configured bounds and the saved size
+        :param min_rows: overrides the configured bound
+        :param max_rows: overrides the configured bound
+        :param target_seconds: wanted duration of one write transaction
+        :param max_lock_share: share of a write spent waiting on locks above which batches are shrunk
+        :param smoothing: weight of the latest measurement in the throughput estimate
+        """
+        bounds = batch_size_bounds[kind]
+        self.kind = kind
+        self.min_rows = min_rows or bounds['min_rows']
+        self.max_rows = max_rows or bounds['max_rows']
+        self.target_seconds = target_seconds or bounds['target_seconds']
+        self.max_lock_share = max_lock_share
+        self.smoothing = smoothing
+
+        saved = load_batch_sizes().get(kind, {})
+        self.batch_size = self.clamp(saved.get('batch_size', bounds['initial_rows']))
+        self.rows_per_second = saved.get('rows_per_second')
+        self.history = []
+        if saved:
+            logger.info(f'{kind} batches start at {self.batch_size} rows, tuned on {saved.get("updated")}')
+
+    def clamp(self, rows: float) -> int:
+        return int(min(max(rows, self.min_rows), self.max_rows))
+
+    def observe(self, rows: int, seconds: float, lock_wait_seconds: float = 0.0) -> int:
+        """
+        record a written batch and update the batch size
+        :param rows:
+        :param seconds: wall time of the write
+        :param lock_wait_seconds: time the write spent waiting on row locks
+        :return: the next batch size
+        """
+        if rows <= 0 or seconds <= 0:
+            return self.batch_size
+        rate = rows / seconds
+        if self.rows_per_second is None:
+            self.rows_per_second = rate
+        else:
+            self.rows_per_second = self.smoothing * rate + (1 - self.smoothing) * self.rows_per_second
+
+        proposed = self.rows_per_second * self.target_seconds
+        lock_share = min(lock_wait_seconds / seconds, 1.0)
+        if lock_share > self.max_lock_share:
+            # long transactions are blocking or being blocked by other writers, shorten them
+            proposed *= 1 - lock_share
+        # move at most a factor of two per batch so one outlier cannot swing the size
+        proposed = min(max(proposed, self.batch_size / 2), self.batch_size * 2)
+        previous_size = self.batch_size
+        self.batch_size = self.clamp(round(proposed, -3))
+        self.history.append({'rows': rows, 'seconds': round(seconds, 2), 'lock_wait': round(lock_wait_seconds, 2),
+                             'rows_per_second': round(rate), 'next_batch_size': self.batch_size})
+        if self.batch_size != previous_size:
+            logger.debug(f'{self.kind} batch size {previous_size} -> {self.batch_size} '
+                         f'({round(rate)} rows/s, {lock_share:.0%} lock wait)')
+        return self.batch_size
+
+    def save(self) -> None:
+        """
+        persist the tuned size for the next run
+        :return:
+        """
+        batch_sizes = load_batch_sizes()
+        batch_sizes[self.kind] = {'batch_size': self.batch_size,
+                                  'rows_per_second': round(self.rows_per_second) if self.rows_per_second else None,
+                                  'updated': time.strftime('%Y-%m-%d %H:%M:%S')}
+        temp_file = f'{batch_size_file}.{os.getpid()}'
+        with open(temp_file, 'w') as f:
+            json.dump(batch_sizes, f, indent=2)
+        os.replace(temp_file, batch_size_file)
+        logger.info(f'{self.kind} batch size {self.batch_size} saved to {batch_size_file}')
@@ -0,0 +1,162 @@
+"""
+dimension tables for the address labels repeated across millions of etab rows
+
+the commune, street type, cedex and country labels of an establishment are staged as integer ids rather than
+text, and the full labels are rebuilt on the database side by joining sirene_dim_<dimension> when the staging
+rows are upserted into geo_location and sirene_stocketab. an id is the first 63 bits of the md5 of its label, so
+every fragment, queue worker and target database derives the same id without coordinating, and loading a
+dimension row is an idempotent insert ignore.
+
+the clean stage writes the labels of the whole file to dimensions/etab_address_dimensions.parquet, which the
+MySQL sink loads in one go when the file begins, fragments then only insert labels missing from that file
+"""
+import hashlib
+import logging
+import os
+import time
+
+import polars as pl
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+dimension_dir = 'dimensions'
+dimension_tables = {'commune': 'sirene_dim_commune',
+                    'street_type': 'sirene_dim_street_type',
+                    'cedex': 'sirene_dim_cedex',
+                    'country': 'sirene_dim_country'}
+# staged column -> dimension
+dimension_columns = {'AddressMunicipalityLabel': 'commune',
+                     'AddressMunicipalityLabel2': 'commune',
+                     'AddressUniqueIdentifier': 'street_type',
+                     'AddressUniqueIdentifier2': 'street_type',
+                     'AddressCEDEXLabel': 'cedex',
+                     'AddressCEDEXLabel2': 'cedex',
+                     'AddressOverseasCountryLabel': 'country',
+                     'AddressOverseasCountryLabel2': 'country'}
+
+
+def dimensions_path() -> str:
+    return os.path.join(dimension_dir, 'etab_address_dimensions.parquet')
+
+
+def id_column(column: str) -> str:
+    return f'{column}_id'
+
+
+def label_id(label: str) -> int:
+    """
+    :param label:
+    :return: first 63 bits of the md5 of the label, a positive signed bigint
+    """
+    return int.from_bytes(hashlib.md5(label.encode('utf-8')).digest()[:8], 'big') >> 1
+
+
+def dimension_labels(pldf: pl.DataFrame) -> pl.DataFrame:
+    """
+    :param pldf: cleaned etab rows
+    :return: unique non-null (dimension, label) pairs
+    """
+    frames = [pldf.select(pl.lit(dimension).alias('dimension'), pl.col(column).cast(pl.Utf8).alias('label'))
+              for column, dimension in dimension_columns.items() if column in pldf.columns]
+    if not frames:
+        return pl.DataFrame(schema={'dimension': pl.Utf8, 'label': pl.Utf8})
+    return pl.concat(frames).drop_nulls().unique()
+
+
+def write_dimensions(labels: pl.DataFrame) -> None:
+    """
+    write the labels of a cleaned file with their ids, for the sink to load when the file begins
+    :param labels: output of dimension_labels, over the whole file
+    :return:
+    """
+    os.makedirs(dimension_dir, exist_ok=True)
+    labels = labels.unique().with_columns(pl.col('label').apply(label_id, return_dtype=pl.Int64).alias('id'))
+    labels.write_parquet(dimensions_path())
+    logger.info(f'{len(labels)} address labels written to {dimensions_path()}')
+
+
+def decoded_staging(staging_table: str) -> str:
+    """
+    derived table with the columns of a staging table, the dimension ids replaced by their labels.
+    used in place of the staging table, with an alias, in the statements reading from it
+    :param staging_table:
+    :return:
+    """
+    label_columns = []
+    joins = []
+    for column, dimension in dimension_columns.items():
+        alias = f'dim_{column}'
+        label_columns.append(f'{alias}.label as `{column}`')
+        joins.append(f'left join {dimension_tables[dimension]} {alias} on {alias}.id = s.`{id_column(column)}`')
+    return f"""(select s.*, {', '.join(label_columns)} from {staging_table} s {' '.join(joins)})"""
+
+
+class AddressDimensions:
+    """
+    keeps the dimension tables of one database in step with the staged ids
+    """
+
+    def __init__(self, cursor, db, metrics=None):
+        """
+        :param cursor:
+        :param db:
+        :param metrics: LoadMetrics the dimension loads are recorded in
+        """
+        self.cursor = cursor
+        self.db = db
+        self.metrics = metrics
+        # labels already in the database, per dimension, as a label -> id frame for encoding
+        self.known = {dimension: pl.DataFrame(schema={'label': pl.Utf8, 'id': pl.Int64})
+                      for dimension in dimension_tables}
+        for table in dimension_tables.values():
+            self.cursor.execute(
+                f"""create table if not exists {table} (id bigint primary key, label varchar(255) not null)""")
+        self.db.commit()
+
+    def preload(self) -> None:
+        """
+        load the labels of the file written by the clean stage, if there is one
+        :return:
+        """
+        if os.path.exists(dimensions_path()):
+            self.load(pl.read_parquet(dimensions_path()))
+
+    def load(self, labels: pl.DataFrame) -> int:
+        """
+        insert the labels the database does not have yet
+        :param labels: (dimension, label) pairs, with or without their id
+        :return: number of labels sent
+        """
+        t0 = time.time()
+        sent = 0
+        for dimension, table in dimension_tables.items():
+            new_labels = labels.filter(pl.col('dimension') == dimension).select('label').unique() \
+                .join(self.known[dimension], on='label', how='anti')
+            if new_labels.is_empty():
+                continue
+            new_labels = new_labels.with_columns(pl.col('label').apply(label_id, return_dtype=pl.Int64).alias('id'))
+            self.cursor.executemany(f"""insert ignore into {table} (id, label) values (%s, %s)""",
+                                    list(zip(new_labels['id'].to_list(), new_labels['label'].to_list())))
+            self.known[dimension] = pl.concat([self.known[dimension], new_labels.select('label', 'id')])
+            sent += len(new_labels)
+        self.db.commit()
+        if sent and self.metrics is not None:
+            self.metrics.record('dimension_load', time.time() - t0, sent)
+        return sent
+
+    def encode(self, pldf: pl.DataFrame) -> pl.DataFrame:
+        """
+        replace the label columns of a fragment by their ids, loading any label the database is missing.
+        a null label stays null
+        :param pldf:
+        :return:
+        """
+        self.load(dimension_labels(pldf))
+        for column, dimension in dimension_columns.items():
+            if column not in pldf.columns:
+                continue
+            mapping = self.known[dimension].rename({'label': column, 'id': id_column(column)})
+            pldf = pldf.with_columns(pl.col(column).cast(pl.Utf8)).join(mapping, on=column, how='left').drop(column)
+        return pldf
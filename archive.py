@@ -0,0 +1,122 @@
+"""
+archive a month's raw stock zips and its cleaned parquet partitions to S3
+
+    python archive.py --month 2024-07 --bucket iqblade-data-services-sirene-archive --lake sirene_lake
+
+raw zips are taken from the download stage of the stage cache and from raw_dir, where the pipelined cleaners keep
+the zip they streamed, and stored as raw/<month>/<zip>. raw_dir keeps the zips of the newest raw_keep_months
+months. parquet files are stored under lake/ with the same partition layout as the local lake.
+set aws_endpoint_url to archive to MinIO
+"""
+import argparse
+import logging
+import os
+import shutil
+
+from stage_cache import list_entries, read_meta
+from utils import transfer_batch
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+# absolute so backfill workers running in their own month directories share it
+raw_dir = os.path.abspath(os.environ.get('sirene_raw_dir', 'raw_zips'))
+raw_keep_months = 2
+
+
+def keep_raw_zip(path: str) -> str:
+    """
+    move a downloaded zip into raw_dir for archiving, dropping the zips of older months
+    :param path: the monthly zip, named <YYYY-MM-DD>-<file>.zip
+    :return: its new path
+    """
+    os.makedirs(raw_dir, exist_ok=True)
+    kept_path = os.path.join(raw_dir, os.path.basename(path))
+    shutil.move(path, kept_path)
+    months = sorted({name[:7] for name in os.listdir(raw_dir) if name.endswith('.zip')})
+    for name in os.listdir(raw_dir):
+        if name.endswith('.zip') and name[:7] not in months[-raw_keep_months:]:
+            os.remove(os.path.join(raw_dir, name))
+    return kept_path
+
+
+def raw_zip_transfers(month: str, bucket: str) -> list:
+    """
+    :param month: YYYY-MM
+    :param bucket:
+    :return: uploads of the month's zips, from raw_dir or the download stage of the stage cache
+    """
+    zips = {}
+    for entry in list_entries():
+        filestring = entry['params'].get('filestring', '')
+        if entry['stage'] == 'download' and filestring.startswith(month):
+            zips[filestring] = os.path.join(entry['path'], read_meta(entry['path'])['files'][0])
+    if os.path.isdir(raw_dir):
+        for filestring in os.listdir(raw_dir):
+            if filestring.startswith(month) and filestring.endswith('.zip'):
+                zips.setdefault(filestring, os.path.join(raw_dir, filestring))
+    if not zips:
+        logger.warning(f'no raw zips of {month} found in the stage cache or {raw_dir}')
+    return [{'direction': 'upload', 'filename': path, 'bucket': bucket, 'key': f'raw/{month}/{filestring}'}
+            for filestring, path in sorted(zips.items())]
+
+
+def lake_transfers(month: str, bucket: str, lake_root: str) -> list:
+    """
+    :param month: YYYY-MM
+    :param bucket:
+    :param lake_root: root of the parquet lake written by ParquetSink
+    :return: uploads of every parquet file in the month's partitions
+    """
+    transfers = []
+    if not os.path.isdir(lake_root):
+        return transfers
+    for dataset in os.listdir(lake_root):
+        month_dir = os.path.join(lake_root, dataset, f'month={month}')
+        for dirpath, _, filenames in os.walk(month_dir):
+            for filename in filenames:
+                if filename.endswith('.parquet'):
+                    path = os.path.join(dirpath, filename)
+                    transfers.append({'direction': 'upload', 'filename': path, 'bucket': bucket,
+                                      'key': 'lake/' + os.path.relpath(path, lake_root).replace(os.sep, '/')})
+    return transfers
+
+
+def archive_month(month: str, bucket: str, lake_root: str = None, max_workers: int = 4) -> dict:
+    """
+    upload a month's raw zips and parquet partitions in parallel
+    :param month: YYYY-MM
+    :param bucket:
+    :param lake_root: leave out to archive only the raw zips
+    :param max_workers:
+    :return: transfer summary from transfer_batch
+    """
+    transfers = raw_zip_transfers(month, bucket)
+    if lake_root:
+        transfers += lake_transfers(month, bucket, lake_root)
+    logger.info(f'archiving {len(transfers)} files for {month} to {bucket}')
+    return transfer_batch(transfers, max_workers=max_workers)
+
+
+def describe_failures(summary: dict) -> str:
+    """
+    one line summary of the failed transfers for the pipeline notifications
+    :param summary: from archive_month
+    :return:
+    """
+    return f'{len(summary["failures"])} files failed to archive: ' + \
+        ', '.join(f'{failure["key"]} ({failure["error"]})' for failure in summary['failures'][:10])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='archive a month of raw zips and parquet partitions to S3')
+    parser.add_argument('--month', required=True, help='YYYY-MM')
+    parser.add_argument('--bucket', required=True)
+    parser.add_argument('--lake', help='root of the parquet lake')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    summary = archive_month(args.month, args.bucket, lake_root=args.lake, max_workers=args.workers)
+    if summary['failures']:
+        raise SystemExit(describe_failures(summary))
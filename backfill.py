@@ -0,0 +1,175 @@
+"""
+reload a range of months, e.g. after an outage or for a historical analysis
+
+    python backfill.py --start 2023-01 --end 2023-06 --workers 3
+
+each month is downloaded, cleaned and split in its own worker process and working directory under backfill/,
+with at most --workers months being prepared at once. downloads and cleaned files go through the stage cache,
+so a month that was already prepared by an earlier run is restored instead of downloaded again.
+the prepared months are loaded into the sink one at a time in chronological order, etab then legal,
+and the backfill stops at the first month that fails so later months are never applied on top of a gap
+"""
+import argparse
+import datetime
+import logging
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from address_dimensions import dimensions_path
+from company_names import names_path
+from download_files import wait_for_publication
+from etab_main import prepare_etab_fragments, load_etab_fragments, etab_filestring
+from legal_main import prepare_legal_fragments, load_legal_fragments, legal_filestring
+from sinks import create_sink
+from stale_sync import pending_keys_path
+from utils import pipeline_messenger
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+backfill_dir = 'backfill'
+
+
+def month_range(start: str, end: str) -> list:
+    """
+    :param start: YYYY-MM
+    :param end: YYYY-MM, included
+    :return: every month from start to end in chronological order
+    """
+    month = datetime.datetime.strptime(start, '%Y-%m')
+    last_month = datetime.datetime.strptime(end, '%Y-%m')
+    if month > last_month:
+        raise ValueError(f'backfill start {start} is after end {end}')
+    months = []
+    while month <= last_month:
+        months.append(month.strftime('%Y-%m'))
+        month = (month + datetime.timedelta(days=32)).replace(day=1)
+    return months
+
+
+def prepare_month(kind: str, month: str, work_dir: str, pipelined: bool = False) -> dict:
+    """
+    download, clean and split one month in its own working directory, runs in a worker process
+    :param kind: etab or legal
+    :param month: YYYY-MM
+    :param work_dir: absolute working directory for this month
+    :param pipelined:
+    :return: absolute paths of the fragments, of the month's live key snapshot, of its address labels (etab)
+        and of its company names (legal)
+    """
+    os.makedirs(os.path.join(work_dir, 'fragments'), exist_ok=True)
+    os.chdir(work_dir)
+    t0 = time.time()
+    filestring = etab_filestring(month) if kind == 'etab' else legal_filestring(month)
+    probe = wait_for_publication(filestring)
+    remote_version = probe['etag'] or probe['last_modified']
+    if kind == 'etab':
+        list_of_fragments = prepare_etab_fragments(filestring, pipelined=pipelined, remote_version=remote_version)
+    else:
+        list_of_fragments = prepare_legal_fragments(filestring, pipelined=pipelined, remote_version=remote_version)
+    t1 = time.time()
+    logger.info(f'{kind} {month} prepared in {round(t1 - t0)} seconds, {len(list_of_fragments)} fragments')
+    return {'fragments': [os.path.abspath(fragment) for fragment in list_of_fragments],
+            'pending_keys': os.path.abspath(pending_keys_path(kind)),
+            'dimensions': os.path.abspath(dimensions_path()) if kind == 'etab' else None,
+            'names': os.path.abspath(names_path()) if kind == 'legal' else None}
+
+
+def apply_month(kind: str, month: str, prepared: dict, sink) -> None:
+    """
+    load a prepared month into the sink, the month's key snapshot is moved into place first so the
+    stale key sync compares it with the previous month that was applied, and its address labels and company names
+    so the sink loads them in one go
+    :param kind:
+    :param month:
+    :param prepared: output of prepare_month
+    :param sink:
+    :return:
+    """
+    if os.path.exists(prepared['pending_keys']):
+        os.makedirs(os.path.dirname(pending_keys_path(kind)), exist_ok=True)
+        os.replace(prepared['pending_keys'], pending_keys_path(kind))
+    if prepared.get('dimensions') and os.path.exists(prepared['dimensions']):
+        os.makedirs(os.path.dirname(dimensions_path()), exist_ok=True)
+        os.replace(prepared['dimensions'], dimensions_path())
+    if prepared.get('names') and os.path.exists(prepared['names']):
+        os.makedirs(os.path.dirname(names_path()), exist_ok=True)
+        os.replace(prepared['names'], names_path())
+    if kind == 'etab':
+        load_report = load_etab_fragments(prepared['fragments'], sink, month)
+    else:
+        load_report = load_legal_fragments(prepared['fragments'], sink, month)
+    logger.info(f'{kind} {month} applied, {load_report["fragments"]} fragments in {load_report["wall_time"]} seconds')
+
+
+def run_backfill(start: str, end: str, sink_spec: str = 'mysql', kinds: tuple = ('etab', 'legal'),
+                 max_workers: int = 2, pipelined: bool = False, full_refresh: bool = False) -> list:
+    """
+    prepare the months in parallel and apply them in chronological order
+    :param start: YYYY-MM
+    :param end: YYYY-MM, included
+    :param sink_spec: mysql, duckdb:<path> or parquet:<directory>
+    :param kinds: files to load for each month
+    :param max_workers: number of months prepared at the same time
+    :param pipelined:
+    :param full_refresh: only used by the mysql sink
+    :return: months that were applied
+    """
+    months = month_range(start, end)
+    base_dir = os.path.abspath(backfill_dir)
+    logger.info(f'backfilling {", ".join(kinds)} for {len(months)} months, {months[0]} to {months[-1]}')
+
+    applied_months = []
+    sink = create_sink(sink_spec, full_refresh=full_refresh)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # submitted oldest first, so the month needed next is always the first to be prepared
+        futures = {(month, kind): executor.submit(prepare_month, kind, month,
+                                                  os.path.join(base_dir, month), pipelined)
+                   for month in months for kind in kinds}
+        try:
+            for month in months:
+                for kind in kinds:
+                    prepared = futures[(month, kind)].result()
+                    apply_month(kind, month, prepared, sink)
+                applied_months.append(month)
+        except Exception:
+            for future in futures.values():
+                future.cancel()
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            traceback_str = traceback.format_exception(exc_type, exc_value, exc_traceback)
+            pipeline_messenger(
+                title='Sirene Backfill Notification',
+                text=f'backfill stopped at {month} after applying {applied_months}: {traceback_str}',
+                notification_type='fail'
+            )
+            raise
+        finally:
+            sink.close()
+
+    pipeline_messenger(
+        title='Sirene Backfill Notification',
+        text=f'backfill applied {len(applied_months)} months, {months[0]} to {months[-1]}',
+        notification_type='pass'
+    )
+    return applied_months
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='load a range of monthly sirene stock files in order')
+    parser.add_argument('--start', required=True, help='first month, YYYY-MM')
+    parser.add_argument('--end', required=True, help='last month, YYYY-MM')
+    parser.add_argument('--workers', type=int, default=2, help='months downloaded and cleaned at the same time')
+    parser.add_argument('--kinds', nargs='+', choices=['etab', 'legal'], default=['etab', 'legal'])
+    parser.add_argument('--sink', default='mysql',
+                        help='where to write the cleaned fragments: mysql, mysql:<env prefix>, duckdb:<path> or '
+                             'parquet:<directory>, several comma separated sinks are loaded from one parse')
+    parser.add_argument('--pipelined', action='store_true')
+    parser.add_argument('--full-refresh', action='store_true')
+    args = parser.parse_args()
+
+    run_backfill(args.start, args.end, sink_spec=args.sink, kinds=tuple(args.kinds), max_workers=args.workers,
+                 pipelined=args.pipelined, full_refresh=args.full_refresh)
@@ -0,0 +1,267 @@
+"""
+normalised company names and blocking keys for matching external names against the legal units
+
+    python company_names.py match "Société Dupont & Fils S.A.R.L." "BOULANGERIE MARTIN"
+
+the legal cleaners write every name of a legal unit (LegalEntityName, LegalEntityName1..3 and LegalAcronym) to
+names/company_names.parquet with its normalised form: upper case, accents folded, punctuation dropped, legal
+forms such as SARL, SAS or SA stripped from either end and whitespace collapsed. each name gets blocking keys:
+
+    name_prefix      the first prefix_length characters of the name without spaces
+    sorted_tokens    the words of the name in alphabetical order, so word order does not matter
+    sig_1..sig_4     minhash signatures of the name's character trigrams, two names share a signature with a
+                     probability equal to the jaccard similarity of their trigram sets
+
+everything is computed with polars expressions over the whole frame. the MySQL sink loads the file into the
+indexed sirene_company_names table when the legal file finishes, and NameMatcher matches names in process,
+scoring the rows that share a blocking key with a name rather than scanning organisation with LIKE.
+the signatures use polars' hash, so the table is built and queried with the same polars version
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import polars as pl
+
+from full_refresh import prepare_shadow_table, finalise_shadow_table, shadow_table_name
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+names_dir = 'names'
+names_table = 'sirene_company_names'
+load_slice_rows = 500000
+name_columns = ['LegalEntityName', 'LegalEntityName1', 'LegalEntityName2', 'LegalEntityName3', 'LegalAcronym']
+legal_forms = ['SARL', 'SARLU', 'EURL', 'SAS', 'SASU', 'SA', 'SCA', 'SCS', 'SNC', 'SCI', 'SCP', 'SCM', 'SCEA',
+               'SCOP', 'SELARL', 'SELAS', 'SELAFA', 'SELCA', 'SEM', 'SEML', 'GIE', 'GAEC', 'EARL']
+folded_characters = {'A': 'ÀÁÂÃÄÅ', 'C': 'Ç', 'E': 'ÈÉÊË', 'I': 'ÌÍÎÏ', 'N': 'Ñ', 'O': 'ÒÓÔÕÖØ', 'U': 'ÙÚÛÜ',
+                     'Y': 'ÝŸ', 'OE': 'Œ', 'AE': 'Æ'}
+prefix_length = 4
+signature_seeds = [1, 2, 3, 4]
+signature_columns = [f'sig_{seed}' for seed in signature_seeds]
+key_columns = ['name_prefix', 'sorted_tokens'] + signature_columns
+
+
+def names_path() -> str:
+    return os.path.join(names_dir, 'company_names.parquet')
+
+
+def normalise_name(name: pl.Expr) -> pl.Expr:
+    """
+    :param name: a string expression
+    :return: the normalised name, an empty string when nothing is left
+    """
+    name = name.str.to_uppercase()
+    for replacement, characters in folded_characters.items():
+        name = name.str.replace_all(f'[{characters}]', replacement)
+    legal_form_pattern = '|'.join(legal_forms)
+    return name.str.replace_all('&', ' ET ', literal=True) \
+        .str.replace_all(r'\b([A-Z])\.', '$1') \
+        .str.replace_all(r'[^A-Z0-9]+', ' ') \
+        .str.strip() \
+        .str.replace(f'^(?:(?:{legal_form_pattern}) )+', '') \
+        .str.replace(f'(?: (?:{legal_form_pattern}))+$', '') \
+        .str.replace_all(r'\s+', ' ') \
+        .str.strip()
+
+
+def add_name_keys(pldf: pl.DataFrame) -> pl.DataFrame:
+    """
+    :param pldf: frame with a normalised_name column
+    :return: the frame with its blocking keys
+    """
+    name = pl.col('normalised_name')
+    padded = pl.lit(' ') + name + pl.lit(' ')
+    # a run too short for a trigram is null rather than empty, and would null the whole list
+    no_trigrams = pl.lit(pl.Series([[]], dtype=pl.List(pl.Utf8)))
+    # every trigram is in one of the three non-overlapping runs starting at offsets 0, 1 and 2
+    pldf = pldf.with_columns(
+        name.str.replace_all(' ', '', literal=True).str.slice(0, prefix_length).alias('name_prefix'),
+        name.str.split(' ').list.sort().list.join(' ').alias('sorted_tokens'),
+        pl.concat_list([padded.str.slice(offset).str.extract_all('...').fill_null(no_trigrams)
+                        for offset in range(3)]).alias('trigrams'))
+    # minhash, the smallest seeded hash of the trigrams, halved to fit a signed bigint
+    return pldf.with_columns([(pl.col('trigrams').list.eval(pl.element().hash(seed)).list.min() // 2)
+                              .cast(pl.Int64).alias(column)
+                              for seed, column in zip(signature_seeds, signature_columns)]).drop('trigrams')
+
+
+def company_name_rows(pldf: pl.DataFrame) -> pl.DataFrame:
+    """
+    :param pldf: cleaned legal rows
+    :return: one row per distinct normalised name of each legal unit, with its blocking keys
+    """
+    frames = [pldf.select(pl.col('company_number').cast(pl.Utf8), pl.lit(column).alias('name_source'),
+                          pl.col(column).cast(pl.Utf8).alias('name'))
+              for column in name_columns if column in pldf.columns]
+    names = pl.concat(frames).filter(pl.col('name').is_not_null() & (pl.col('name') != '[ND]')) \
+        .with_columns(normalise_name(pl.col('name')).alias('normalised_name')) \
+        .filter(pl.col('normalised_name') != '') \
+        .unique(subset=['company_number', 'normalised_name'], keep='first', maintain_order=True)
+    return add_name_keys(names)
+
+
+def write_company_names(names: pl.DataFrame) -> None:
+    """
+    write the names of a cleaned file, for the sink to load into sirene_company_names when the file finishes
+    :param names: output of company_name_rows, over the whole file
+    :return:
+    """
+    os.makedirs(names_dir, exist_ok=True)
+    names.write_parquet(names_path(), compression='zstd')
+    logger.info(f'{len(names)} company names written to {names_path()}')
+
+
+def load_company_names(cursor, db, constring: str, metrics=None) -> int:
+    """
+    replace sirene_company_names with the names of the last cleaned file, bulk loaded into a shadow table
+    whose indexes are built once the rows are in
+    :param cursor:
+    :param db:
+    :param constring: connection uri for write_database
+    :param metrics: LoadMetrics the load is recorded in
+    :return: number of names loaded
+    """
+    t0 = time.time()
+    cursor.execute(
+        f"""
+        create table if not exists {names_table} (
+        company_number varchar(9) not null,
+        name_source varchar(16) not null,
+        name varchar(512),
+        normalised_name varchar(512),
+        name_prefix varchar(8),
+        sorted_tokens varchar(512),
+        sig_1 bigint,
+        sig_2 bigint,
+        sig_3 bigint,
+        sig_4 bigint,
+        primary key (company_number, name_source),
+        key name_prefix (name_prefix),
+        key sorted_tokens (sorted_tokens(64)),
+        key sig_1 (sig_1),
+        key sig_2 (sig_2),
+        key sig_3 (sig_3),
+        key sig_4 (sig_4))
+        """
+    )
+    db.commit()
+    names = pl.read_parquet(names_path())
+    refresh_state = prepare_shadow_table(cursor, db, names_table)
+    for offset in range(0, len(names), load_slice_rows):
+        names.slice(offset, load_slice_rows).write_database(table_name=shadow_table_name(names_table),
+                                                            connection_uri=constring, if_exists='append')
+    refresh_state['loaded_rows'] = len(names)
+    finalise_shadow_table(cursor, db, refresh_state)
+    if metrics is not None:
+        metrics.record('company_names_load', time.time() - t0, len(names))
+    logger.info(f'{len(names)} company names loaded into {names_table} in {round(time.time() - t0)} seconds')
+    return len(names)
+
+
+def trigrams(name: str) -> set:
+    padded = f' {name} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameMatcher:
+    """
+    in process matching of company names against the normalised names and their blocking keys. each key column
+    is kept as a sorted array of hashes, so the rows sharing a key with a name are found by binary search
+    """
+    # a key shared by more rows than this, e.g. a very common prefix, is too unselective to block on
+    max_bucket_rows = 2000
+
+    def __init__(self, names: pl.DataFrame):
+        """
+        :param names: rows written by write_company_names, or read back from sirene_company_names
+        """
+        self.names = names.select('company_number', 'name', 'normalised_name')
+        self.normalised = self.names['normalised_name'].to_list()
+        self.keys = {}
+        for column in key_columns:
+            hashes = self.key_hashes(names[column])
+            order = np.argsort(hashes, kind='stable')
+            self.keys[column] = (hashes[order], order)
+        logger.info(f'name matcher ready over {len(self.names)} names')
+
+    @classmethod
+    def from_parquet(cls, path: str = None):
+        return cls(pl.read_parquet(path or names_path()))
+
+    @classmethod
+    def from_database(cls, env_prefix: str = 'preprod'):
+        from utils import mysql_constring
+        return cls(pl.read_database(
+            f"""select company_number, name, normalised_name, {', '.join(key_columns)} from {names_table}""",
+            mysql_constring(env_prefix)))
+
+    @staticmethod
+    def key_hashes(keys: pl.Series) -> np.ndarray:
+        if keys.dtype == pl.Int64:
+            return keys.fill_null(-1).to_numpy()
+        return keys.fill_null('').hash().to_numpy()
+
+    def candidates(self, query_keys: pl.DataFrame) -> np.ndarray:
+        """
+        :param query_keys: the blocking keys of one name
+        :return: rows sharing at least one key with it
+        """
+        rows = []
+        for column in key_columns:
+            sorted_hashes, order = self.keys[column]
+            query_hash = self.key_hashes(query_keys[column])[0]
+            low = np.searchsorted(sorted_hashes, query_hash, side='left')
+            high = np.searchsorted(sorted_hashes, query_hash, side='right')
+            if 0 < high - low <= self.max_bucket_rows:
+                rows.append(order[low:high])
+        return np.unique(np.concatenate(rows)) if rows else np.zeros(0, dtype=np.int64)
+
+    def match(self, names: list, limit: int = 5, min_score: float = 0.5) -> list:
+        """
+        :param names: external company names
+        :param limit: matches returned per name
+        :param min_score: smallest trigram jaccard similarity of a match
+        :return: per name, its normalised form and its best matches, best first
+        """
+        queries = add_name_keys(pl.DataFrame({'name': [str(name) for name in names]})
+                                .with_columns(normalise_name(pl.col('name')).alias('normalised_name')))
+        results = []
+        for i, query_name in enumerate(queries['normalised_name'].to_list()):
+            query_trigrams = trigrams(query_name)
+            scored = []
+            for row in self.candidates(queries.slice(i, 1)) if query_name else []:
+                candidate_trigrams = trigrams(self.normalised[row])
+                score = len(query_trigrams & candidate_trigrams) / len(query_trigrams | candidate_trigrams)
+                if score >= min_score:
+                    scored.append((score, int(row)))
+            scored.sort(key=lambda pair: -pair[0])
+            matches = [{**self.names.row(row, named=True), 'score': round(score, 3)}
+                       for score, row in scored[:limit]]
+            results.append({'name': names[i], 'normalised_name': query_name, 'matches': matches})
+        return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='match company names against the normalised legal unit names')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    match_parser = subparsers.add_parser('match', help='print the best matches of each name')
+    match_parser.add_argument('names', nargs='+')
+    match_parser.add_argument('--names-file', default=None, help='company names parquet, defaults to the last '
+                                                                    'cleaned file')
+    match_parser.add_argument('--database', metavar='ENV_PREFIX', help='read sirene_company_names from this '
+                                                                        'database instead of the parquet file')
+    match_parser.add_argument('--limit', type=int, default=5)
+    match_parser.add_argument('--min-score', type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.database:
+        matcher = NameMatcher.from_database(args.database)
+    else:
+        matcher = NameMatcher.from_parquet(args.names_file)
+    print(json.dumps(matcher.match(args.names, limit=args.limit, min_score=args.min_score), indent=2,
+                     ensure_ascii=False))
@@ -1,13 +1,16 @@
+import json
 import logging
+import mmap
 import os
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-from filesplit.split import Split
 
-from utils import connect_preprod, return_file_date
-
-cursor, db = connect_preprod()
+from memory_guard import guarded
+from profiling import profiled
+from utils import return_file_date
 
 
 format_str = "[%(levelname)s: %(lineno)d] %(message)s"
@@ -18,47 +21,167 @@ logger = logging.getLogger(__name__)
 
 
 
+files_url = 'https://files.data.gouv.fr/insee-sirene/'
+
+
+def remote_meta_path(filestring: str) -> str:
+    """
+    the ETag and Last-Modified of a remote file are kept in a json file beside the zip
+    :param filestring:
+    :return:
+    """
+    return f'{filestring}.meta.json'
+
+
+def read_remote_meta(filestring: str) -> dict:
+    if not os.path.exists(remote_meta_path(filestring)):
+        return {}
+    with open(remote_meta_path(filestring)) as f:
+        return json.load(f)
+
+
+def write_remote_meta(filestring: str, meta: dict) -> None:
+    with open(remote_meta_path(filestring), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def conditional_headers(meta: dict, version: str = 'downloaded') -> dict:
+    """
+    If-None-Match / If-Modified-Since headers for a version recorded in the meta file
+    :param meta:
+    :param version: downloaded or applied
+    :return:
+    """
+    headers = {}
+    if meta.get(f'{version}_etag'):
+        headers['If-None-Match'] = meta[f'{version}_etag']
+    if meta.get(f'{version}_last_modified'):
+        headers['If-Modified-Since'] = meta[f'{version}_last_modified']
+    return headers
+
+
+def probe_remote_file(filestring: str) -> dict:
+    """
+    HEAD the remote file, conditional on the version last applied to the database
+    :param filestring:
+    :return: dict with published, changed, etag, last_modified and content_length
+    """
+    meta = read_remote_meta(filestring)
+    r = requests.head(files_url + filestring, headers=conditional_headers(meta, 'applied'),
+                      allow_redirects=True, verify=False, timeout=30)
+    if r.status_code == 404:
+        return {'published': False, 'changed': False, 'etag': None, 'last_modified': None, 'content_length': None}
+    if r.status_code == 304:
+        return {'published': True, 'changed': False, 'etag': meta.get('applied_etag'),
+                'last_modified': meta.get('applied_last_modified'), 'content_length': None}
+    if r.status_code != 200:
+        logger.error('status code: {}'.format(r.status_code))
+        raise requests.exceptions.HTTPError(f'{r.status_code} when probing {filestring}')
+
+    etag = r.headers.get('ETag')
+    last_modified = r.headers.get('Last-Modified')
+    # some servers ignore conditional headers on HEAD, so compare the validators as well
+    if etag and etag == meta.get('applied_etag'):
+        changed = False
+    elif not etag and last_modified and last_modified == meta.get('applied_last_modified'):
+        changed = False
+    else:
+        changed = True
+    return {'published': True, 'changed': changed, 'etag': etag, 'last_modified': last_modified,
+            'content_length': r.headers.get('Content-Length')}
+
+
+def wait_for_publication(filestring: str, max_wait_seconds: float = 0, initial_delay: float = 60,
+                         max_delay: float = 3600) -> dict:
+    """
+    probe the remote file until it is published, backing off exponentially between probes
+    :param filestring:
+    :param max_wait_seconds: 0 probes once
+    :param initial_delay:
+    :param max_delay:
+    :return: the successful probe
+    """
+    t0 = time.time()
+    delay = initial_delay
+    while True:
+        probe = probe_remote_file(filestring)
+        if probe['published']:
+            return probe
+        waited = time.time() - t0
+        if waited + delay > max_wait_seconds:
+            raise FileNotFoundError(f'{filestring} has not been published on {files_url} '
+                                    f'after waiting {round(waited)} seconds')
+        logger.info(f'{filestring} not published yet, probing again in {round(delay)} seconds')
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+def record_applied_version(filestring: str, probe: dict) -> None:
+    """
+    remember the version of the remote file that has been loaded, the next run is skipped while it is unchanged
+    :param filestring:
+    :param probe: output of probe_remote_file
+    :return:
+    """
+    meta = read_remote_meta(filestring)
+    meta.update({'applied_etag': probe['etag'], 'applied_last_modified': probe['last_modified'],
+                 'applied_at': time.strftime('%Y-%m-%dT%H:%M:%S')})
+    write_remote_meta(filestring, meta)
+
+
 def process_download(filestring: str) -> str:
-    """check for file, if not exists, download, unzip and split"""
+    """check for file, if not exists or the remote file has changed, download"""
 
     # build the url for the request, by appending filestring var to files_url
-    files_url = 'https://files.data.gouv.fr/insee-sirene/'
     request_url = files_url + filestring
 
-    # check for
-    list_of_files = os.listdir()
-    downloaded = 0
-    for file in list_of_files:
-        if '.zip' in file and file == filestring:
-            logger.info('{} has been found'.format(filestring))
-            downloaded = 1
-
-    # if a zip file has not been found, download one
-    if downloaded == 0:
+    # a local zip is revalidated with a conditional GET, a 304 means the local copy is current
+    meta = read_remote_meta(filestring)
+    headers = conditional_headers(meta) if os.path.exists(filestring) else {}
+    if os.path.exists(filestring) and not headers:
+        logger.info('{} has been found'.format(filestring))
+        return filestring
 
-        # send a request to recieve the file
-        r = requests.get(request_url, stream=True, verify=False)
+    # send a request to recieve the file
+    r = requests.get(request_url, stream=True, verify=False, headers=headers, timeout=60)
+    if r.status_code == 304:
+        logger.info('{} has been found and is unchanged on the server'.format(filestring))
+        return filestring
+    if r.status_code == 404:
+        raise FileNotFoundError(f'{filestring} has not been published on {files_url}')
 
-        # if we recieve a 200, that files exists and we can continue
-        if r.status_code != 200:
-            logger.error('status code: {}'.format(r.status_code))
-            raise requests.exceptions.HTTPError
+    # if we recieve a 200, that files exists and we can continue
+    if r.status_code != 200:
+        logger.error('status code: {}'.format(r.status_code))
+        raise requests.exceptions.HTTPError(f'{r.status_code} when downloading {filestring}')
 
-        # create a new file, and write in the data from the request
-        with open(filestring, 'wb') as f:
-            chunkcount = 0
-            for chunk in r.iter_content(chunk_size=50000):
-                chunkcount += 1
+    # create a new file, and write in the data from the request. the old zip may be hard linked into the stage
+    # cache, so it is unlinked rather than overwritten in place
+    if os.path.exists(filestring):
+        os.remove(filestring)
+    with open(filestring, 'wb') as f:
+        chunkcount = 0
+        for chunk in r.iter_content(chunk_size=50000):
+            chunkcount += 1
 
-                f.write(chunk)
-                if chunkcount % 100 == 0:
-                    logger.info(chunkcount)
+            f.write(chunk)
+            if chunkcount % 100 == 0:
+                logger.info(chunkcount)
 
-            logger.info('file successfully downloaded')
+        logger.info('file successfully downloaded')
+    meta.update({'downloaded_etag': r.headers.get('ETag'),
+                 'downloaded_last_modified': r.headers.get('Last-Modified')})
+    write_remote_meta(filestring, meta)
     return filestring
+
+
 def unzip_file(filestring: str) -> str:
     # unzip the file and delete the zip file
     with zipfile.ZipFile(filestring, 'r') as zip_ref:
+        # a csv left from an earlier run may be hard linked into the stage cache, unlink it rather than overwrite it
+        for member in zip_ref.namelist():
+            if os.path.isfile(member):
+                os.remove(member)
         zip_ref.extractall()
         infolist = zip_ref.infolist()
         if infolist:
@@ -73,14 +196,82 @@ def unzip_file(filestring: str) -> str:
 
     return unzipped_file_name
 
-def split_file(unzipped_file_name: str) -> None:
-    # we use filesplit.split Split to divide the file into
-    # smaller batches of 50,000 lines
-    split = Split(unzipped_file_name, 'fragments')
-    split.bylinecount(linecount=50000, includeheader=True)
-    os.remove('fragments/manifest')
+def row_end(mm: mmap.mmap, row_start: int, newline_end: int) -> int:
+    """
+    move a candidate fragment boundary past any newline that sits inside a quoted field
+    :param mm: memory map of the csv
+    :param row_start: start of a row
+    :param newline_end: just after a newline at or after row_start
+    :return: just after the first newline at or after newline_end - 1 that ends a row
+    """
+    quotes = mm[row_start:newline_end].count(b'"')
+    while quotes % 2 and newline_end < len(mm):
+        next_end = mm.find(b'\n', newline_end) + 1 or len(mm)
+        quotes += mm[newline_end:next_end].count(b'"')
+        newline_end = next_end
+    return newline_end
+
+
+def find_fragment_offsets(mm: mmap.mmap, linecount: int, window: int = 1024 * 1024) -> tuple:
+    """
+    find byte ranges of linecount rows each. newlines are counted a window at a time on the memory map, so the
+    file is never read line by line, and each boundary is moved past newlines inside quoted fields so a row with
+    an embedded newline is never cut in two
+    :param mm: memory map of the csv
+    :param linecount: number of rows per fragment, a quoted newline counts as a row
+    :param window: bytes counted at a time
+    :return: end of the header, list of (start, end) byte ranges
+    """
+    header_end = row_end(mm, 0, mm.find(b'\n') + 1 or len(mm))
+    boundaries = [header_end]
+    rows = 0
+    position = header_end
+    while position < len(mm):
+        window_end = min(position + window, len(mm))
+        newlines = mm[position:window_end].count(b'\n')
+        if rows + newlines < linecount:
+            rows += newlines
+            position = window_end
+            continue
+        for _ in range(linecount - rows):
+            position = mm.find(b'\n', position) + 1
+        position = row_end(mm, boundaries[-1], position)
+        boundaries.append(position)
+        rows = 0
+    if boundaries[-1] < len(mm):
+        boundaries.append(len(mm))
+    return header_end, list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def write_fragment(unzipped_file_name: str, header_end: int, start: int, end: int, fragment_name: str) -> None:
+    window = 16 * 1024 * 1024
+    with open(unzipped_file_name, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            open(fragment_name, 'wb') as out:
+        out.write(mm[:header_end])
+        for position in range(start, end, window):
+            out.write(mm[position:min(position + window, end)])
+
 
-    # once this is done, we can delete the unzipped csv
-    os.remove(unzipped_file_name)
+@profiled('split')
+@guarded('split')
+def split_file(unzipped_file_name: str, linecount: int = 50000) -> list:
+    """
+    divide the file into fragments of roughly linecount rows, each keeping the header.
+    the fragment boundaries are found on a memory map of the file and the fragments are written in parallel
+    :param unzipped_file_name:
+    :param linecount:
+    :return: list of fragment paths
+    """
+    with open(unzipped_file_name, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header_end, ranges = find_fragment_offsets(mm, linecount)
 
+    stem, extension = os.path.splitext(os.path.basename(unzipped_file_name))
+    fragment_names = [os.path.join('fragments', f'{stem}_{i}{extension}') for i in range(1, len(ranges) + 1)]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(lambda args: write_fragment(unzipped_file_name, header_end, *args),
+                          [(start, end, fragment_name) for (start, end), fragment_name in zip(ranges, fragment_names)]))
+    logger.info(f'{unzipped_file_name} split into {len(fragment_names)} fragments')
 
+    # the csv is left in place for the snapshot taken after the split, the caller removes it with its other
+    # working files
+    return fragment_names
@@ -1,9 +1,20 @@
+import os
+
 import polars as pl
 import time
 import logging
 import datetime
 import hashlib
 
+from archive import keep_raw_zip
+from address_dimensions import dimension_labels, write_dimensions
+from geo_projection import add_wgs84_columns
+from quality_profile import QualityProfile, apply_filter_rules
+from memory_guard import guarded, fits_in_memory, read_csv_chunks, SpillBuffer, chunk_rows
+from profiling import profiled
+from stale_sync import write_pending_keys
+from stream_pipeline import StreamingCSVBatches, iter_csv_frames
+
 format_str = "[%(levelname)s: %(lineno)d] %(message)s"
 logging.basicConfig(level=logging.INFO, format=format_str)
 logger = logging.getLogger(__name__)
@@ -83,95 +94,109 @@ def generate_geo_md5(input_dict: dict) -> str:
     return hashlib.md5(str(concat_str).encode('utf-8')).hexdigest()
 
 
-def etab_file_process(filename: str) -> str:
+unite_etab_cols = {
+    'siren': 'company_number',  #
+    'nic': 'localnic',  #
+    'siret': 'siret',  #
+    'statutDiffusionEtablissement': 'distributionStatus',
+    # How publically available the company data is, O is open and P is private
+    'dateCreationEtablissement': 'EstablishmentDate',  #
+    'trancheEffectifsEtablissement': 'EmployeeCountCategory',  #
+    'anneeEffectifsEtablissement': 'EmployeeCountCategoryYear',  #
+    'activitePrincipaleRegistreMetiersEtablissement': 'mainNAF',  #
+    'dateDernierTraitementEtablissement': 'LastNAFUpdate',  #
+    'etablissementSiege': 'RegisteredOfficeBool',  # either True or False
+    'nombrePeriodesEtablissement': 'PeriodNumber',
+    'dernierNumeroVoieEtablissement': 'LastAddressNumber',
+    'indiceRepetitionDernierNumeroVoieEtablissement': 'DateOfLastAddressNumber',
+
+    'identifiantAdresseEtablissement': 'InstitutionAddressID',
+    'coordonneeLambertAbscisseEtablissement': 'LambertCoordinateX',
+    'coordonneeLambertOrdonneeEtablissement': 'LambertCoordinateY',
+
+    # details number of periods the establishment has been written as office
+    'complementAdresseEtablissement': 'AddressBuildingBlock',  #
+    'numeroVoieEtablissement': 'AddressNumber',  # -12-b Example Way
+    'indiceRepetitionEtablissement': 'AddressNumberSubUnit',  # 12-b- Example Way
+    'typeVoieEtablissement': 'AddressUniqueIdentifier',  #
+    'libelleVoieEtablissement': 'AddressLabel',  #
+    'codePostalEtablissement': 'AddressPostcode',  #
+    'libelleCommuneEtablissement': 'AddressMunicipalityLabel',  #
+    'libelleCommuneEtrangerEtablissement': 'AddressForeignMunicipality',  # only if foreign address
+    'distributionSpecialeEtablissement': 'AddressPOBox',  #
+    'codeCommuneEtablissement': 'AddressCommuneCode',  #
+    'codeCedexEtablissement': 'AddressCEDEXCode',  #
+    'libelleCedexEtablissement': 'AddressCEDEXLabel',  #
+    'codePaysEtrangerEtablissement': 'AddressOverseasCountryCode',  #
+    'libellePaysEtrangerEtablissement': 'AddressOverseasCountryLabel',  #
+    'complementAdresse2Etablissement': 'AddressBuildingBlock2',  #
+    'numeroVoie2Etablissement': 'AddressNumber2',  #
+    'indiceRepetition2Etablissement': 'AddressNumberSubUnit2',  #
+    'typeVoie2Etablissement': 'AddressUniqueIdentifier2',  #
+    'libelleVoie2Etablissement': 'AddressLabel2',  #
+    'codePostal2Etablissement': 'AddressPostcode2',  #
+    'libelleCommune2Etablissement': 'AddressMunicipalityLabel2',  #
+    'libelleCommuneEtranger2Etablissement': 'AddressForeignMunicipality2',  #
+    'distributionSpeciale2Etablissement': 'AddressPOBox2',  #
+    'codeCommune2Etablissement': 'AddressCommuneCode2',  #
+    'codeCedex2Etablissement': 'AddressCEDEXCode2',  #
+    'libelleCedex2Etablissement': 'AddressCEDEXLabel2',  #
+    'codePaysEtranger2Etablissement': 'AddressOverseasCountryCode2',  #
+    'libellePaysEtranger2Etablissement': 'AddressOverseasCountryLabel2',  #
+    'dateDebut': 'DateOfBusinessStart',  #
+    'etatAdministratifEtablissement': 'AdministrativeStatus',  # A for active, F for closed
+    'enseigne1Etablissement': 'EstablishmentSign1',  #
+    'enseigne2Etablissement': 'EstablishmentSign2',  #
+    'enseigne3Etablissement': 'EstablishmentSign3',  #
+    'denominationUsuelleEtablissement': 'CommonCompanyName',  # company publicly known as
+    'activitePrincipaleEtablissement': 'APETCode',  #
+    'nomenclatureActivitePrincipaleEtablissement': 'APETCodeCategory',  #
+    'caractereEmployeurEtablissement': 'EmploymentType',  #
+}
+
+etab_read_options = {
+    'dtypes': {'codeCommuneEtablissement': pl.Utf8,
+               'codeCedexEtablissement': pl.Utf8,
+               'numeroVoieEtablissement': pl.Utf8,
+               'codePostalEtablissement': pl.Utf8,
+               'numeroVoie2Etablissement': pl.Utf8,
+               'codePostal2Etablissement': pl.Utf8,
+               'distributionSpecialeEtablissement': pl.Utf8,
+               'complementAdresseEtablissement': pl.Utf8,
+               'siren': pl.Utf8},
+    'ignore_errors': True,
+    # [ND] is read as text so the quality profile counts it as in the legal file, clean_etab_frame nulls it after
+    'null_values': ['NN'],
+}
+
+# rows are kept when they pass every rule, the rows each rule drops are counted in the quality profile
+etab_filter_rules = [
+    # todo remove closed addresses
+    # a missing status is kept, as it was when the filter ran after fill_null
+    ('closed_establishment', pl.col('AdministrativeStatus').fill_null('') != 'F'),
+]
+
+
+def clean_etab_frame(pldf: pl.DataFrame, filename: str, profile: QualityProfile = None) -> pl.DataFrame:
     """
-    Process StockEtablissement
-    :param filename:
+    rename, filter and derive the geo_location columns for a frame of StockEtablissement rows,
+    used on the whole file or on each batch in pipelined mode
+    :param pldf: frame read with etab_read_options
+    :param filename: source file, recorded in last_modified_by
+    :param profile: quality profile the frame is added to, while it is filtered
     :return:
     """
-    unite_etab_cols = {
-        'siren': 'company_number',  #
-        'nic': 'localnic',  #
-        'siret': 'siret',  #
-        'statutDiffusionEtablissement': 'distributionStatus',
-        # How publically available the company data is, O is open and P is private
-        'dateCreationEtablissement': 'EstablishmentDate',  #
-        'trancheEffectifsEtablissement': 'EmployeeCountCategory',  #
-        'anneeEffectifsEtablissement': 'EmployeeCountCategoryYear',  #
-        'activitePrincipaleRegistreMetiersEtablissement': 'mainNAF',  #
-        'dateDernierTraitementEtablissement': 'LastNAFUpdate',  #
-        'etablissementSiege': 'RegisteredOfficeBool',  # either True or False
-        'nombrePeriodesEtablissement': 'PeriodNumber',
-        'dernierNumeroVoieEtablissement': 'LastAddressNumber',
-        'indiceRepetitionDernierNumeroVoieEtablissement': 'DateOfLastAddressNumber',
-
-        'identifiantAdresseEtablissement': 'InstitutionAddressID',
-        'coordonneeLambertAbscisseEtablissement': 'LambertCoordinateX',
-        'coordonneeLambertOrdonneeEtablissement': 'LambertCoordinateY',
-
-        # details number of periods the establishment has been written as office
-        'complementAdresseEtablissement': 'AddressBuildingBlock',  #
-        'numeroVoieEtablissement': 'AddressNumber',  # -12-b Example Way
-        'indiceRepetitionEtablissement': 'AddressNumberSubUnit',  # 12-b- Example Way
-        'typeVoieEtablissement': 'AddressUniqueIdentifier',  #
-        'libelleVoieEtablissement': 'AddressLabel',  #
-        'codePostalEtablissement': 'AddressPostcode',  #
-        'libelleCommuneEtablissement': 'AddressMunicipalityLabel',  #
-        'libelleCommuneEtrangerEtablissement': 'AddressForeignMunicipality',  # only if foreign address
-        'distributionSpecialeEtablissement': 'AddressPOBox',  #
-        'codeCommuneEtablissement': 'AddressCommuneCode',  #
-        'codeCedexEtablissement': 'AddressCEDEXCode',  #
-        'libelleCedexEtablissement': 'AddressCEDEXLabel',  #
-        'codePaysEtrangerEtablissement': 'AddressOverseasCountryCode',  #
-        'libellePaysEtrangerEtablissement': 'AddressOverseasCountryLabel',  #
-        'complementAdresse2Etablissement': 'AddressBuildingBlock2',  #
-        'numeroVoie2Etablissement': 'AddressNumber2',  #
-        'indiceRepetition2Etablissement': 'AddressNumberSubUnit2',  #
-        'typeVoie2Etablissement': 'AddressUniqueIdentifier2',  #
-        'libelleVoie2Etablissement': 'AddressLabel2',  #
-        'codePostal2Etablissement': 'AddressPostcode2',  #
-        'libelleCommune2Etablissement': 'AddressMunicipalityLabel2',  #
-        'libelleCommuneEtranger2Etablissement': 'AddressForeignMunicipality2',  #
-        'distributionSpeciale2Etablissement': 'AddressPOBox2',  #
-        'codeCommune2Etablissement': 'AddressCommuneCode2',  #
-        'codeCedex2Etablissement': 'AddressCEDEXCode2',  #
-        'libelleCedex2Etablissement': 'AddressCEDEXLabel2',  #
-        'codePaysEtranger2Etablissement': 'AddressOverseasCountryCode2',  #
-        'libellePaysEtranger2Etablissement': 'AddressOverseasCountryLabel2',  #
-        'dateDebut': 'DateOfBusinessStart',  #
-        'etatAdministratifEtablissement': 'AdministrativeStatus',  # A for active, F for closed
-        'enseigne1Etablissement': 'EstablishmentSign1',  #
-        'enseigne2Etablissement': 'EstablishmentSign2',  #
-        'enseigne3Etablissement': 'EstablishmentSign3',  #
-        'denominationUsuelleEtablissement': 'CommonCompanyName',  # company publicly known as
-        'activitePrincipaleEtablissement': 'APETCode',  #
-        'nomenclatureActivitePrincipaleEtablissement': 'APETCodeCategory',  #
-        'caractereEmployeurEtablissement': 'EmploymentType',  #
-    }
-
-    t0 = time.time()
-    pldf = pl.read_csv(filename, dtypes={'codeCommuneEtablissement': pl.Utf8,
-                                         'codeCedexEtablissement': pl.Utf8,
-                                         'numeroVoieEtablissement': pl.Utf8,
-                                         'codePostalEtablissement': pl.Utf8,
-                                         'numeroVoie2Etablissement': pl.Utf8,
-                                         'codePostal2Etablissement': pl.Utf8,
-                                         'distributionSpecialeEtablissement': pl.Utf8,
-                                         'complementAdresseEtablissement': pl.Utf8,
-                                         'siren': pl.Utf8}, ignore_errors=True,
-                       null_values=['[ND]', 'NN'])
     pldf = pldf.rename(unite_etab_cols)
+    # filtered before the nulls are filled so the profile sees them, and before the per-row id is built
+    pldf = apply_filter_rules(pldf, etab_filter_rules, profile)
+    pldf = pldf.with_columns([pl.when(pl.col(column) == '[ND]').then(None).otherwise(pl.col(column)).alias(column)
+                              for column, dtype in pldf.schema.items() if dtype == pl.Utf8])
     pldf = pldf.fill_null('')
     pldf = pldf.fill_nan('')
     pldf = pldf.with_columns(pl.struct(['company_number']).apply(create_org_id, return_dtype=pl.Utf8).alias('id'))
 
-    # get original size for analytics
-    original_pldf_size = len(pldf)
-
-    # todo remove closed addresses
-    logger.debug(f'size of file before removing closed offices for {filename}: {len(pldf)}')
-    pldf = pldf.filter(pl.col('AdministrativeStatus') != 'F')
-    logger.debug(f'size of file after removing closed offices for {filename}: {len(pldf)}')
+    # convert the Lambert-93 coordinates to latitude and longitude for geo_location
+    pldf = add_wgs84_columns(pldf)
 
     # generate md5 hash
     pldf = pldf.with_columns(
@@ -193,19 +218,113 @@ def etab_file_process(filename: str) -> str:
     pldf = pldf.with_columns(
         pl.struct(['RegisteredOfficeBool']).apply(assign_office_type).alias('registered_office_type'))
 
-    t1 = time.time()
-
     # for diagnostic purposes, add filenames and update times into the dataframe
     pldf = pldf.with_columns(pl.lit(filename + ' - insert').alias('last_modified_by'))
     pldf = pldf.with_columns(pl.lit(datetime.datetime.now()).alias('last_modified_date'))
+    return pldf
 
-    new_pldf_size = len(pldf)
 
+def log_etab_sizes(original_pldf_size: int, new_pldf_size: int) -> None:
     logger.info(f'size of file: {new_pldf_size}')
     logger.info(f'size of original file: {original_pldf_size}')
     logger.info(f'change in filesize: {round((original_pldf_size - new_pldf_size) / original_pldf_size * 100, 2)}')
 
+
+@profiled('clean_etab')
+@guarded('clean_etab')
+def etab_file_process(filename: str) -> str:
+    """
+    Process StockEtablissement
+    :param filename:
+    :return:
+    """
+    if not fits_in_memory(filename):
+        return etab_chunked_process(filename)
+
+    t0 = time.time()
+    pldf = pl.read_csv(filename, **etab_read_options)
+
+    # get original size for analytics
+    profile = QualityProfile('etab')
+    pldf = clean_etab_frame(pldf, filename, profile)
+    t1 = time.time()
+
+    log_etab_sizes(profile.rows_in, profile.rows_out)
     logger.info('Preparing etab file in {} seconds'.format(round(t1 - t0)))
 
+    # keep the live address keys so closed establishments can be removed from geo_location after the load
+    write_pending_keys(pldf, 'etab', 'geo_md5')
+    profile.write()
+    # and the address labels, for the sink to load into its dimension tables once
+    write_dimensions(dimension_labels(pldf))
+
     pldf.write_csv('StockEtablissement_clean.csv')
-    return 'StockEtablissement_clean.csv'
\ No newline at end of file
+    return 'StockEtablissement_clean.csv'
+
+
+def etab_chunked_process(filename: str) -> str:
+    """
+    Process StockEtablissement in chunks of chunk_rows when the file does not fit in the memory budget,
+    each chunk is cleaned and appended to the clean csv, the live keys are spilled to disk if needed
+    :param filename:
+    :return:
+    """
+    logger.info(f'{filename} does not fit in the memory budget, cleaning it in chunks of {chunk_rows} rows')
+    t0 = time.time()
+    profile = QualityProfile('etab')
+    keys = SpillBuffer('etab_keys')
+    labels = []
+    try:
+        with open('StockEtablissement_clean.csv', 'wb') as f:
+            for batch_number, pldf in enumerate(read_csv_chunks(filename, etab_read_options)):
+                pldf = clean_etab_frame(pldf, filename, profile)
+                keys.append(pldf.select('geo_md5'))
+                labels.append(dimension_labels(pldf))
+                pldf.write_csv(f, has_header=batch_number == 0)
+                logger.info(f'chunk {batch_number + 1} cleaned, {profile.rows_out} rows so far')
+        t1 = time.time()
+
+        log_etab_sizes(profile.rows_in, profile.rows_out)
+        logger.info('Preparing etab file in {} seconds'.format(round(t1 - t0)))
+
+        write_pending_keys(keys.collect(unique=True), 'etab', 'geo_md5')
+        profile.write()
+        write_dimensions(pl.concat(labels))
+    finally:
+        keys.close()
+    return 'StockEtablissement_clean.csv'
+
+
+@profiled('stream_clean_etab')
+@guarded('stream_clean_etab')
+def etab_stream_process(filestring: str) -> str:
+    """
+    Process StockEtablissement while it downloads, each batch is cleaned as soon as it has been inflated
+    and appended to the clean csv. the zip is moved to archive.raw_dir once the clean csv is complete
+    :param filestring: name of the monthly zip
+    :return:
+    """
+    t0 = time.time()
+    profile = QualityProfile('etab')
+    keys = SpillBuffer('etab_keys')
+    labels = []
+    batches = StreamingCSVBatches(filestring)
+    with open('StockEtablissement_clean.csv', 'wb') as f:
+        for batch_number, pldf in enumerate(iter_csv_frames(batches, etab_read_options)):
+            pldf = clean_etab_frame(pldf, batches.member_name, profile)
+            keys.append(pldf.select('geo_md5'))
+            labels.append(dimension_labels(pldf))
+            pldf.write_csv(f, has_header=batch_number == 0)
+            logger.info(f'batch {batch_number} cleaned, {profile.rows_out} rows so far')
+    t1 = time.time()
+
+    log_etab_sizes(profile.rows_in, profile.rows_out)
+    logger.info('Downloading and preparing etab file in {} seconds'.format(round(t1 - t0)))
+
+    write_pending_keys(keys.collect(unique=True), 'etab', 'geo_md5')
+    profile.write()
+    keys.close()
+    write_dimensions(pl.concat(labels))
+    # kept rather than removed, the download stage that holds it in the other mode is not run
+    keep_raw_zip(filestring)
+    return 'StockEtablissement_clean.csv'
@@ -6,11 +6,24 @@ import time
 
 import polars as pl
 
-from download_files import process_download, unzip_file, split_file
-from utils import connect_preprod, pipeline_messenger, constring
-from etab_clean_func import etab_file_process
-
-cursor, db = connect_preprod()
+import address_dimensions
+import etab_clean_func
+import geo_projection
+import quality_profile
+import stream_pipeline
+from download_files import process_download, unzip_file, split_file, find_fragment_offsets, write_fragment, \
+    wait_for_publication, record_applied_version
+from utils import pipeline_messenger
+from etab_clean_func import etab_file_process, etab_stream_process
+from sinks import Sink, MySQLSink
+from stage_cache import run_cached_stage
+from adaptive_batching import AdaptiveBatcher
+from fragment_loader import run_fragment_pipeline, describe_report
+from memory_guard import guarded, describe_peaks
+from profiling import profiled, profiling_enabled
+from stale_sync import pending_keys_path
+from snapshot_store import write_snapshot
+from quality_profile import record_profile
 
 format_str = "[%(levelname)s: %(lineno)d] %(message)s"
 logging.basicConfig(level=logging.INFO, format=format_str)
@@ -90,11 +103,33 @@ def generate_geo_md5(input_dict: dict) -> str:
     concat_str = input_dict['id'] + input_dict['AddressPostcode']
     return hashlib.md5(str(concat_str).encode('utf-8')).hexdigest()
 
-def process_etab_fragment(filename: str) -> None:
+def read_etab_fragment(filename: str) -> pl.DataFrame:
+    """
+    read a cleaned fragment with the column types the staging table expects
+    :param filename:
+    :return:
+    """
+    return pl.read_csv(filename, dtypes={'AddressCommuneCode': pl.Utf8,
+                                         'AddressCommuneCode2': pl.Utf8,
+                                         'AddressCEDEXCode': pl.Utf8,
+                                         'AddressCedexCode2': pl.Utf8,
+                                         'AddressNumber': pl.Utf8,
+                                         'AddressNumber2': pl.Utf8,
+                                         'AddressPostcode': pl.Utf8,
+                                         'AddressPostcode2': pl.Utf8,
+                                         'AddressPOBox': pl.Utf8,
+                                         'AddressBuildingBlock': pl.Utf8,
+                                         'siren': pl.Utf8}, ignore_errors=True,
+                       null_values=['[ND]', 'NN'])
+
+
+@profiled('etab_fragment', per_fragment=True)
+def process_etab_fragment(filename: str, sink: Sink) -> None:
     """
     main process to write StockEtablissement
-    upserts to geo_location
+    reads a fragment and hands it to the sink, the mysql sink upserts to geo_location
     :param filename:
+    :param sink:
     :return:
     """
     unite_etab_cols = {
@@ -157,191 +192,156 @@ def process_etab_fragment(filename: str) -> None:
         'caractereEmployeurEtablissement': 'EmploymentType',  #
     }
 
-    pldf = pl.read_csv(filename, dtypes={'AddressCommuneCode': pl.Utf8,
-                                         'AddressCommuneCode2': pl.Utf8,
-                                         'AddressCEDEXCode': pl.Utf8,
-                                         'AddressCedexCode2': pl.Utf8,
-                                         'AddressNumber': pl.Utf8,
-                                         'AddressNumber2': pl.Utf8,
-                                         'AddressPostcode': pl.Utf8,
-                                         'AddressPostcode2': pl.Utf8,
-                                         'AddressPOBox': pl.Utf8,
-                                         'AddressBuildingBlock': pl.Utf8,
-                                         'siren': pl.Utf8}, ignore_errors=True,
-                       null_values=['[ND]', 'NN'])
-
-    # write to staging table
-    t0 = time.time()
-    pldf.write_database(table_name='sirene_stocketab_staging', connection_uri=constring, if_exists='append')
-    t1 = time.time()
-    logger.info('Sending etab file to staging in {:.2f} seconds'.format(t1 - t0))
-
-    #  upsert to geolocation here # todo include filepath in last_modified_by
-    t0 = time.time()
-    cursor.execute("""
-    insert ignore into geo_location (
-    address_1, 
-    address_2, 
-    town,  
-    country, 
-    post_code, 
-    address_type,  
-    organisation_id, 
-    post_code_formatted, 
-    md5_key, 
-    date_last_modified, 
-    last_modified_by) 
-
-    select 
-     address_line_1 as address_1,
-     address_line_2 as address_2,
-     AddressMunicipalityLabel as town, 
-     'France' as country,
-     AddressPostcode as post_code,
-     registered_office_type as address_type,
-     id as organisation_id,
-     AddressPostcode as post_code_formatted,
-     geo_md5 as md5_key,
-     curdate() as date_last_modified,
-     'sirene_etab insert' as last_modified_by
-     from sirene_stocketab_staging
-
-     on duplicate key update
-    address_1 = address_line_1,
-    address_2 = address_line_2,
-    town = AddressMunicipalityLabel,
-    post_code = AddressPostcode,
-    address_type = registered_office_type,
-    post_code_formatted = AddressPostcode,
-    date_last_modified = CURDATE(),
-    last_modified_by = 'sirene_etab update'
-    """)
-    db.commit()
-    t1 = time.time()
-    logger.info('time taken for upsert to geo_location: {}'.format(round(t1 - t0)))
+    pldf = read_etab_fragment(filename)
+    sink.write_etab(pldf)
 
-    # upsert into larger stock etab table for debugging when needed, similar to rchis
-    t0 = time.time()
-    cursor.execute(
-        """
-    insert into sirene_stocketab
-    select * from sirene_stocketab_staging t2
-    on duplicate key update
-    sirene_stocketab.company_number = t2.company_number,
-    sirene_stocketab.localnic = t2.localnic,
-    sirene_stocketab.siret = t2.siret,
-    sirene_stocketab.distributionStatus = t2.distributionStatus,
-    sirene_stocketab.EstablishmentDate = t2.EstablishmentDate,
-    sirene_stocketab.EmployeeCountCategory = t2.EmployeeCountCategory,
-    sirene_stocketab.EmployeeCountCategoryYear = t2.EmployeeCountCategoryYear,
-    sirene_stocketab.mainNAF = t2.mainNAF,
-    sirene_stocketab.LastNAFUpdate = t2.LastNAFUpdate,
-    sirene_stocketab.RegisteredOfficeBool = t2.RegisteredOfficeBool,
-    sirene_stocketab.PeriodNumber = t2.PeriodNumber,
-    sirene_stocketab.AddressBuildingBlock = t2.AddressBuildingBlock,
-    sirene_stocketab.AddressNumber = t2.AddressNumber,
-    sirene_stocketab.AddressNumberSubUnit = t2.AddressNumberSubUnit,
-    sirene_stocketab.AddressUniqueIdentifier = t2.AddressUniqueIdentifier,
-    sirene_stocketab.AddressLabel = t2.AddressLabel,
-    sirene_stocketab.AddressPostcode = t2.AddressPostcode,
-    sirene_stocketab.AddressMunicipalityLabel = t2.AddressMunicipalityLabel,
-    sirene_stocketab.AddressForeignMunicipality = t2.AddressForeignMunicipality,
-    sirene_stocketab.AddressPOBox = t2.AddressPOBox,
-    sirene_stocketab.AddressCommuneCode = t2.AddressCommuneCode,
-    sirene_stocketab.AddressCEDEXCode = t2.AddressCEDEXCode,
-    sirene_stocketab.AddressCEDEXLabel = t2.AddressCEDEXLabel,
-    sirene_stocketab.AddressOverseasCountryCode = t2.AddressOverseasCountryCode,
-    sirene_stocketab.AddressOverseasCountryLabel = t2.AddressOverseasCountryLabel,
-    sirene_stocketab.AddressBuildingBlock2 = t2.AddressBuildingBlock2,
-    sirene_stocketab.AddressNumber2 = t2.AddressNumber2,
-    sirene_stocketab.AddressNumberSubUnit2 = t2.AddressNumberSubUnit2,
-    sirene_stocketab.AddressUniqueIdentifier2 = t2.AddressUniqueIdentifier2,
-    sirene_stocketab.AddressLabel2 = t2.AddressLabel2,
-    sirene_stocketab.AddressPostcode2 = t2.AddressPostcode2,
-    sirene_stocketab.AddressMunicipalityLabel2 = t2.AddressMunicipalityLabel2,
-    sirene_stocketab.AddressForeignMunicipality2 = t2.AddressForeignMunicipality2,
-    sirene_stocketab.AddressPOBox2 = t2.AddressPOBox2,
-    sirene_stocketab.AddressCommuneCode2 = t2.AddressCommuneCode2,
-    sirene_stocketab.AddressCEDEXCode2 = t2.AddressCEDEXCode2,
-    sirene_stocketab.AddressCEDEXLabel2 = t2.AddressCEDEXLabel2,
-    sirene_stocketab.AddressOverseasCountryCode2 = t2.AddressOverseasCountryCode2,
-    sirene_stocketab.AddressOverseasCountryLabel2 = t2.AddressOverseasCountryLabel2,
-    sirene_stocketab.DateOfBusinessStart = t2.DateOfBusinessStart,
-    sirene_stocketab.AdministrativeStatus = t2.AdministrativeStatus,
-    sirene_stocketab.EstablishmentSign1 = t2.EstablishmentSign1,
-    sirene_stocketab.EstablishmentSign2 = t2.EstablishmentSign2,
-    sirene_stocketab.EstablishmentSign3 = t2.EstablishmentSign3,
-    sirene_stocketab.CommonCompanyName = t2.CommonCompanyName,
-    sirene_stocketab.APETCode = t2.APETCode,
-    sirene_stocketab.APETCodeCategory = t2.APETCodeCategory,
-    sirene_stocketab.EmploymentType = t2.EmploymentType,
-    sirene_stocketab.geo_md5 = t2.geo_md5,
-    sirene_stocketab.last_modified_date = t2.last_modified_date,
-    sirene_stocketab.last_modified_by = t2.last_modified_by
-
-        """
-    )
-    db.commit()
-    cursor.execute("""truncate table sirene_stocketab_staging""")
-    db.commit()
-    t1 = time.time()
-    logger.info('time taken for upsert to live etab table: {}'.format(round(t1 - t0)))
 
+def prepare_etab_fragments(filestring: str, pipelined: bool = False, remote_version: str = None) -> list:
+    """
+    download, clean and split the etab file, each stage is reused from the stage cache
+    when its input files, code and parameters are unchanged
+    :param filestring: name of the monthly zip
+    :param pipelined: download, inflate and clean in overlapping stages
+    :param remote_version: ETag or Last-Modified of the remote file, a republished file is downloaded again
+    :return: list of fragment paths
+    """
+    if pipelined:
+        intermediate_files = []
+        clean_etab_file, _, _, _ = run_cached_stage(
+            'stream_clean_etab',
+            lambda: [etab_stream_process(filestring), pending_keys_path('etab'), address_dimensions.dimensions_path(),
+                     quality_profile.profile_path('etab')],
+            [], {'filestring': filestring, 'remote_version': remote_version},
+            [etab_clean_func, geo_projection, stream_pipeline, address_dimensions, quality_profile])
+    else:
+        # download the lastest file
+        zipped_file, = run_cached_stage(
+            'download', lambda: process_download(filestring=filestring),
+            [], {'filestring': filestring, 'remote_version': remote_version}, [process_download])
+
+        # unzip the file and return a .csv
+        unzipped_file, = run_cached_stage(
+            'unzip', lambda: unzip_file(filestring=zipped_file),
+            [zipped_file], {}, [unzip_file])
+
+        # process and filter the etab csv
+        clean_etab_file, _, _, _ = run_cached_stage(
+            'clean_etab',
+            lambda: [etab_file_process(unzipped_file), pending_keys_path('etab'), address_dimensions.dimensions_path(),
+                     quality_profile.profile_path('etab')],
+            [unzipped_file], {}, [etab_clean_func, geo_projection, address_dimensions, quality_profile])
+        intermediate_files = [zipped_file, unzipped_file]
+
+    # split the processed file
+    list_of_fragments = run_cached_stage(
+        'split', lambda: split_file(unzipped_file_name=clean_etab_file),
+        [clean_etab_file], {'linecount': 50000}, [split_file, find_fragment_offsets, write_fragment])
+
+    # keep the cleaned file as the month's snapshot for point-in-time lookups
+    write_snapshot('etab', filestring[:7], clean_etab_file)
+    # and its quality profile, flagging drift from the previous month
+    record_profile('etab', filestring[:7])
+
+    # every stage output is kept in the cache, working copies restored from it are not needed any more
+    for intermediate_file in intermediate_files + [clean_etab_file]:
+        if os.path.exists(intermediate_file):
+            os.remove(intermediate_file)
+    return list_of_fragments
+
+
+def etab_filestring(month: str = None) -> str:
+    """
+    name of the monthly StockEtablissement zip
+    :param month: YYYY-MM, defaults to the current month
+    :return:
+    """
+    if month is None:
+        month = datetime.datetime.now().strftime('%Y-%m')
+    return f'{month}-01-StockEtablissement_utf8.zip'
 
-def run_etab():
-    current_date_month = datetime.datetime.now().month
-    current_date_year = datetime.datetime.now().year
-    filestring = f'{current_date_year}-{current_date_month:02d}-01-StockEtablissement_utf8.zip'
 
-    logger.info(f'sending request with filestring: {filestring}')
-    # check if zipfile is not already in the dir
-    if filestring not in os.listdir():
-        logger.error(f'file {filestring} does not exist or {len(os.listdir("fragments"))} is not 1')
+@guarded('load_etab')
+def load_etab_fragments(list_of_fragments: list, sink: Sink, month: str, prefetch: int = 2) -> dict:
+    """
+    write every fragment of a month through the sink, removing each fragment once written.
+    the next fragments are parsed in a producer thread while the current one is being loaded, and are
+    re-batched to the size that keeps each write near its target duration
+    :param list_of_fragments:
+    :param sink:
+    :param month: YYYY-MM of the stock file
+    :param prefetch: fragments parsed ahead of the load, 0 loads them one at a time
+    :return: load report, with the time taken per batch and the parse/load overlap
+    """
+    sink.begin('etab', month)
+    if prefetch and not profiling_enabled():
+        report = run_fragment_pipeline(list_of_fragments, read_etab_fragment, sink.write_etab, prefetch=prefetch,
+                                       batcher=AdaptiveBatcher('etab'), lock_wait_seconds=sink.lock_wait_seconds,
+                                       write_times=sink.write_times)
+    else:
+        # profiled fragments are parsed and loaded together so their profiles cover both
         t0 = time.time()
-        if len(os.listdir('fragments')) == 1:
-            logger.info(f'no fragments found in file, downloading new file')
-
-            # download the lastest file
-            process_download(filestring=filestring)
-
-            # unzip the file and return a .csv
-            unzipped_file = unzip_file(filestring=filestring)
-
-            # process and filter the etab csv
-            clean_etab_file = etab_file_process(unzipped_file)
-
-            # split the processed file
-            split_file(unzipped_file_name=clean_etab_file)
+        fragment_times = []
+        for fragment in list_of_fragments:
+            f_t0 = time.time()
+            process_etab_fragment(filename=fragment, sink=sink)
+            os.remove(fragment)
+            f_t1 = time.time()
+            fragment_time_taken = round(f_t1 - f_t0)
+            fragment_times.append(fragment_time_taken)
+        report = {'fragments': len(fragment_times), 'batches': len(fragment_times),
+                  'batch_times': fragment_times,
+                  'wall_time': round(time.time() - t0, 2), 'producer_busy': 0.0, 'producer_blocked': 0.0,
+                  'consumer_busy': round(time.time() - t0, 2), 'consumer_waiting': 0.0, 'overlap': 0.0}
+    sink.finish('etab')
+    return report
+
+
+def run_etab(sink: Sink = None, pipelined: bool = False, month: str = None, force: bool = False,
+             wait_seconds: float = 0):
+    """
+    download, clean and load a month's stock file, unless it is unchanged since it was last loaded
+    :param sink: defaults to the preprod MySQL database
+    :param pipelined:
+    :param month: YYYY-MM, defaults to the current month
+    :param force: load the file even if it has not changed
+    :param wait_seconds: keep probing for this long, with backoff, if the file has not been published yet
+    :return: the load report, None if the file was unchanged and False if the load failed
+    """
+    filestring = etab_filestring(month)
+    probe = wait_for_publication(filestring, max_wait_seconds=wait_seconds)
+    if not probe['changed'] and not force:
+        logger.info(f'{filestring} is unchanged since it was last loaded, skipping')
+        return
 
-        t1 = time.time()
-        download_time = round(t1 - t0)
-        logger.info(f'download and processing time: {download_time}')
-    else:
-        logger.info('file already uploaded OR fragments need to be processed')
+    logger.info(f'sending request with filestring: {filestring}')
+    t0 = time.time()
+    list_of_fragments = prepare_etab_fragments(filestring, pipelined=pipelined,
+                                               remote_version=probe['etag'] or probe['last_modified'])
+    t1 = time.time()
+    download_time = round(t1 - t0)
+    logger.info(f'download and processing time: {download_time}')
 
-    # process_download leaves the section fragments to be processed
-    list_of_fragments = os.listdir('fragments')
-    fragcount = 0
+    owns_sink = sink is None
+    if owns_sink:
+        sink = MySQLSink()
     try:
         t0 = time.time()
-        fragment_times = []
-        for fragment in list_of_fragments:
-            if 'Etablissement' in filestring and 'Etablissement' in fragment:
-                f_t0 = time.time()
-                process_etab_fragment(filename='fragments/' + fragment)
-                os.remove('fragments/' + fragment)
-                fragcount += 1
-                f_t1 = time.time()
-                fragment_time_taken = round(f_t1 - f_t0)
-                fragment_times.append(fragment_time_taken)
+        load_report = load_etab_fragments(list_of_fragments, sink, filestring[:7])
+        batch_times = load_report['batch_times']
+        record_applied_version(filestring, probe)
         t1 = time.time()
-        avg_time_taken = round(sum(fragment_times) / len(fragment_times), 2)
+        # the writes are re-batched, so a batch is not a fragment
+        avg_time_taken = round(sum(batch_times) / max(len(batch_times), 1), 2)
         time_taken = t1 - t0
+        avg_fragment_time = round(time_taken / max(load_report['fragments'], 1), 2)
         pipeline_messenger(
         title= 'Sirene Stock Etablissement Pipeline has run',
-        text= f'time taken: {time_taken}, average time per fragment: {avg_time_taken} seconds',
+        text= f'time taken: {time_taken}, average time per batch: {avg_time_taken} seconds over '
+              f'{len(batch_times)} batches, per fragment: {avg_fragment_time} seconds, '
+              f'{describe_report(load_report)}, peak memory: {describe_peaks()}',
         notification_type= 'pass'
         )
+        return load_report
 
     except Exception as e:
         pipeline_messenger(
@@ -349,6 +349,10 @@ def run_etab():
             text= f'Error in file: {filestring} - {e}',
             notification_type='fail'
         )
+        return False
+    finally:
+        if owns_sink:
+            sink.close()
 
 if __name__ == '__main__':
     run_etab()
@@ -0,0 +1,183 @@
+"""
+overlaps fragment parsing with the database load
+
+a producer thread reads and prepares the next fragments into a bounded queue while the calling thread writes
+the current one to the sink. polars parses the csv outside the GIL and the MySQL client waits on the socket
+outside it too, so while MySQL runs a long upsert the next fragments are already being parsed.
+
+the report returned by run_fragment_pipeline compares the busy time of both sides with the wall time:
+overlap is the share of the shorter side that was hidden behind the other, 1.0 being a perfect overlap.
+given an AdaptiveBatcher, the fragments are re-batched to the sizes it tunes from the measured write times
+"""
+import logging
+import os
+import queue
+import threading
+import time
+
+import polars as pl
+
+from adaptive_batching import AdaptiveBatcher
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+end_of_fragments = None
+
+
+def run_fragment_pipeline(list_of_fragments: list, read_fragment, write_fragment, prefetch: int = 2,
+                          remove_fragments: bool = True, batcher: AdaptiveBatcher = None,
+                          lock_wait_seconds=None, write_times=None) -> dict:
+    """
+    :param list_of_fragments: fragment paths, written in this order
+    :param read_fragment: callable taking a path and returning a prepared dataframe, runs in the producer thread
+    :param write_fragment: callable taking the dataframe, runs in the calling thread
+    :param prefetch: number of prepared fragments held in the queue
+    :param remove_fragments: remove each fragment once all of its rows have been written
+    :param batcher: re-batch the fragments to the sizes it proposes, otherwise each fragment is one write
+    :param lock_wait_seconds: callable returning a cumulative lock wait counter, fed to the batcher
+    :param write_times: Sink.write_times of a sink writing in the background, whose batches are timed when the
+        sink has written them rather than when write_fragment returns
+    :return: report with batch_times (seconds per write), producer and consumer busy and waiting times, wall time
+        and overlap
+    """
+    prepared = queue.Queue(maxsize=max(prefetch, 1))
+    stop = threading.Event()
+    producer_stats = {'busy': 0.0, 'blocked': 0.0, 'error': None}
+
+    def put_unless_stopped(item) -> bool:
+        # wait for room in the queue, giving up if the consumer has stopped
+        while not stop.is_set():
+            try:
+                prepared.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for fragment in list_of_fragments:
+                if stop.is_set():
+                    return
+                t0 = time.time()
+                pldf = read_fragment(fragment)
+                t1 = time.time()
+                producer_stats['busy'] += t1 - t0
+                if not put_unless_stopped((fragment, pldf)):
+                    return
+                producer_stats['blocked'] += time.time() - t1
+        except Exception as e:
+            producer_stats['error'] = e
+        finally:
+            put_unless_stopped(end_of_fragments)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    wall_t0 = time.time()
+    producer.start()
+
+    batch_times = []
+    consumer_busy = 0.0
+    consumer_waiting = 0.0
+    # (fragment, frame of its rows not yet written)
+    buffered = []
+
+    def write_batch(batch_rows: int) -> None:
+        nonlocal consumer_busy
+        parts = []
+        rows_needed = batch_rows
+        while buffered and rows_needed > 0:
+            fragment, pldf = buffered[0]
+            parts.append(pldf.head(rows_needed))
+            rows_needed -= len(parts[-1])
+            if len(pldf) > len(parts[-1]):
+                buffered[0] = (fragment, pldf.slice(len(parts[-1])))
+            else:
+                buffered.pop(0)
+        batch = parts[0] if len(parts) == 1 else pl.concat(parts, how='vertical_relaxed')
+        t0 = time.time()
+        lock_wait_t0 = lock_wait_seconds() if lock_wait_seconds else 0.0
+        write_fragment(batch)
+        batch_time_taken = time.time() - t0
+        consumer_busy += batch_time_taken
+        written = write_times() if write_times else None
+        if written is None:
+            lock_wait = lock_wait_seconds() - lock_wait_t0 if lock_wait_seconds else 0.0
+            written = [(len(batch), batch_time_taken, lock_wait)]
+        record_writes(written)
+
+    def record_writes(written: list) -> None:
+        for rows, seconds, lock_wait in written:
+            if batcher is not None:
+                batcher.observe(rows, seconds, lock_wait)
+            batch_times.append(round(seconds))
+
+    def remove_written_fragments(fragments_read: list) -> None:
+        pending_fragments = {fragment for fragment, _ in buffered}
+        while fragments_read and fragments_read[0] not in pending_fragments:
+            fragment = fragments_read.pop(0)
+            if remove_fragments:
+                os.remove(fragment)
+
+    fragments_read = []
+    try:
+        while True:
+            t0 = time.time()
+            item = prepared.get()
+            consumer_waiting += time.time() - t0
+            if item is end_of_fragments:
+                break
+            fragments_read.append(item[0])
+            buffered.append(item)
+            if batcher is None:
+                write_batch(len(item[1]))
+            while batcher is not None and sum(len(pldf) for _, pldf in buffered) >= batcher.batch_size:
+                write_batch(batcher.batch_size)
+            remove_written_fragments(fragments_read)
+        if producer_stats['error'] is None:
+            while buffered:
+                write_batch(batcher.batch_size if batcher is not None else len(buffered[0][1]))
+            remove_written_fragments(fragments_read)
+    finally:
+        stop.set()
+        # a producer blocked on a full queue sees stop within a second, draining frees it at once
+        while not prepared.empty():
+            prepared.get_nowait()
+        producer.join()
+    if producer_stats['error'] is not None:
+        raise producer_stats['error']
+    if write_times:
+        # the batches still queued in the sink
+        record_writes(write_times(wait=True) or [])
+
+    wall_time = time.time() - wall_t0
+    shorter_side = min(producer_stats['busy'], consumer_busy)
+    hidden_time = max(producer_stats['busy'] + consumer_busy - wall_time, 0.0)
+    report = {'fragments': len(list_of_fragments),
+              'batches': len(batch_times),
+              'batch_times': batch_times,
+              'wall_time': round(wall_time, 2),
+              'producer_busy': round(producer_stats['busy'], 2),
+              'producer_blocked': round(producer_stats['blocked'], 2),
+              'consumer_busy': round(consumer_busy, 2),
+              'consumer_waiting': round(consumer_waiting, 2),
+              'overlap': round(min(hidden_time / shorter_side, 1.0), 2) if shorter_side else 0.0}
+    if batcher is not None:
+        report['batch_size'] = batcher.batch_size
+        batcher.save()
+    logger.info(f'{report["fragments"]} fragments written as {report["batches"]} batches in {report["wall_time"]}s: '
+                f'parsing {report["producer_busy"]}s, '
+                f'loading {report["consumer_busy"]}s, loader waited {report["consumer_waiting"]}s for fragments, '
+                f'overlap {report["overlap"]:.0%}')
+    return report
+
+
+def describe_report(report: dict) -> str:
+    """
+    one line summary for the pipeline notifications
+    :param report:
+    :return:
+    """
+    return (f'parsing {report["producer_busy"]}s and loading {report["consumer_busy"]}s overlapped '
+            f'{report["overlap"]:.0%} in {report["wall_time"]}s, loader waited {report["consumer_waiting"]}s')
@@ -0,0 +1,192 @@
+"""
+full refresh of the live stock tables (sirene_stocketab and sirene_stocklegal)
+
+rather than upserting every row of the monthly stock file into the live table, the fragments are bulk loaded
+into a shadow copy of the live table with its secondary indexes removed. once every fragment is in, the indexes
+are built in one pass, the row counts are checked and the shadow table is swapped in with a single atomic
+RENAME TABLE. the previous live table is kept as <table>_old so the swap can be rolled back
+"""
+import logging
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+
+def shadow_table_name(table: str) -> str:
+    return f'{table}_shadow'
+
+
+def old_table_name(table: str) -> str:
+    return f'{table}_old'
+
+
+def get_secondary_indexes(cursor, table: str) -> list:
+    """
+    read the secondary indexes of a table from information_schema so they can be dropped on the shadow table
+    and rebuilt once the bulk load has finished
+    :param cursor:
+    :param table:
+    :return: list of dicts with the index name, uniqueness, type and ordered (column, prefix length) pairs
+    """
+    cursor.execute(
+        """
+        select index_name, non_unique, column_name, sub_part, index_type
+        from information_schema.statistics
+        where table_schema = database()
+        and table_name = %s
+        and index_name != 'PRIMARY'
+        order by index_name, seq_in_index
+        """, (table,)
+    )
+    indexes = {}
+    for index_name, non_unique, column_name, sub_part, index_type in cursor.fetchall():
+        if index_name not in indexes:
+            indexes[index_name] = {'name': index_name,
+                                   'unique': int(non_unique) == 0,
+                                   'index_type': index_type,
+                                   'columns': []}
+        indexes[index_name]['columns'].append((column_name, sub_part))
+    return list(indexes.values())
+
+
+def index_definition(index: dict) -> str:
+    """
+    build the 'add index' clause for an index returned by get_secondary_indexes
+    :param index:
+    :return:
+    """
+    columns = ', '.join(f'`{column}`({sub_part})' if sub_part else f'`{column}`'
+                        for column, sub_part in index['columns'])
+    if index['index_type'] == 'FULLTEXT':
+        index_kind = 'fulltext index'
+    elif index['unique']:
+        index_kind = 'unique index'
+    else:
+        index_kind = 'index'
+    return f'add {index_kind} `{index["name"]}` ({columns})'
+
+
+def apply_bulk_session_settings(cursor) -> dict:
+    """
+    relax the per-row checks for this session while the shadow table is loaded,
+    returns the previous values so they can be restored afterwards
+    :param cursor:
+    :return:
+    """
+    cursor.execute("""select @@session.unique_checks, @@session.foreign_key_checks, @@session.transaction_isolation""")
+    unique_checks, foreign_key_checks, transaction_isolation = cursor.fetchone()
+    cursor.execute("""set session unique_checks = 0""")
+    cursor.execute("""set session foreign_key_checks = 0""")
+    # avoid taking shared locks on the staging rows for every insert ... select
+    cursor.execute("""set session transaction_isolation = 'READ-COMMITTED'""")
+    return {'unique_checks': unique_checks,
+            'foreign_key_checks': foreign_key_checks,
+            'transaction_isolation': transaction_isolation}
+
+
+def restore_session_settings(cursor, settings: dict) -> None:
+    cursor.execute("""set session unique_checks = %s""", (settings['unique_checks'],))
+    cursor.execute("""set session foreign_key_checks = %s""", (settings['foreign_key_checks'],))
+    cursor.execute("""set session transaction_isolation = %s""", (settings['transaction_isolation'],))
+
+
+def prepare_shadow_table(cursor, db, table: str) -> dict:
+    """
+    create an empty shadow copy of the live table without its secondary indexes
+    and switch the session to bulk load settings
+    :param cursor:
+    :param db:
+    :param table: live table name
+    :return: state needed by finalise_shadow_table
+    """
+    shadow_table = shadow_table_name(table)
+    cursor.execute(f"""drop table if exists {shadow_table}""")
+    cursor.execute(f"""create table {shadow_table} like {table}""")
+
+    indexes = get_secondary_indexes(cursor, table)
+    if indexes:
+        drop_clauses = ', '.join(f'drop index `{index["name"]}`' for index in indexes)
+        cursor.execute(f"""alter table {shadow_table} {drop_clauses}""")
+    logger.info(f'created {shadow_table}, deferring {len(indexes)} secondary indexes')
+
+    session_settings = apply_bulk_session_settings(cursor)
+    db.commit()
+    return {'table': table, 'indexes': indexes, 'session_settings': session_settings, 'loaded_rows': 0}
+
+
+def load_staging_into_shadow(cursor, db, refresh_state: dict, staging_table: str, columns: str = None) -> int:
+    """
+    plain bulk insert of the staging table into the shadow table, no duplicate key handling is needed
+    as the shadow table starts empty
+    :param cursor:
+    :param db:
+    :param refresh_state: state returned by prepare_shadow_table
+    :param staging_table:
+    :param columns: explicit comma separated column list, all columns by position if not given
+    :return: number of rows inserted
+    """
+    shadow_table = shadow_table_name(refresh_state['table'])
+    if columns:
+        cursor.execute(f"""insert into {shadow_table} ({columns}) select {columns} from {staging_table}""")
+    else:
+        cursor.execute(f"""insert into {shadow_table} select * from {staging_table}""")
+    inserted_rows = cursor.rowcount
+    db.commit()
+    refresh_state['loaded_rows'] += inserted_rows
+    return inserted_rows
+
+
+def count_rows(cursor, table: str) -> int:
+    cursor.execute(f"""select count(*) from {table}""")
+    return cursor.fetchone()[0]
+
+
+def finalise_shadow_table(cursor, db, refresh_state: dict, min_ratio: float = 0.9) -> None:
+    """
+    build the deferred indexes, check the row counts and swap the shadow table in.
+    the swap is skipped with a ValueError if the shadow table does not hold every loaded row,
+    or if it is suspiciously small compared to the live table
+    :param cursor:
+    :param db:
+    :param refresh_state: state returned by prepare_shadow_table
+    :param min_ratio: smallest accepted shadow/live row count ratio
+    :return:
+    """
+    table = refresh_state['table']
+    shadow_table = shadow_table_name(table)
+    restore_session_settings(cursor, refresh_state['session_settings'])
+
+    if refresh_state['indexes']:
+        add_clauses = ', '.join(index_definition(index) for index in refresh_state['indexes'])
+        cursor.execute(f"""alter table {shadow_table} {add_clauses}""")
+        logger.info(f'built {len(refresh_state["indexes"])} indexes on {shadow_table}')
+
+    shadow_rows = count_rows(cursor, shadow_table)
+    live_rows = count_rows(cursor, table)
+    logger.info(f'{shadow_table}: {shadow_rows} rows, {table}: {live_rows} rows')
+    if shadow_rows != refresh_state['loaded_rows']:
+        raise ValueError(f'{shadow_table} holds {shadow_rows} rows but {refresh_state["loaded_rows"]} were loaded')
+    if live_rows and shadow_rows < live_rows * min_ratio:
+        raise ValueError(f'{shadow_table} holds {shadow_rows} rows, less than {min_ratio:.0%} '
+                         f'of the {live_rows} rows in {table}, not swapping')
+
+    # keep one previous generation for rollback
+    cursor.execute(f"""drop table if exists {old_table_name(table)}""")
+    cursor.execute(f"""rename table {table} to {old_table_name(table)}, {shadow_table} to {table}""")
+    db.commit()
+    logger.info(f'{shadow_table} swapped in as {table}, previous table kept as {old_table_name(table)}')
+
+
+def rollback_full_refresh(cursor, db, table: str) -> None:
+    """
+    swap the previous generation back in, the rolled back table is kept as the shadow table
+    :param cursor:
+    :param db:
+    :param table:
+    :return:
+    """
+    cursor.execute(f"""drop table if exists {shadow_table_name(table)}""")
+    cursor.execute(f"""rename table {table} to {shadow_table_name(table)}, {old_table_name(table)} to {table}""")
+    db.commit()
+    logger.info(f'{old_table_name(table)} restored as {table}')
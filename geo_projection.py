@@ -0,0 +1,80 @@
+"""
+Lambert-93 (RGF93, EPSG:2154) to WGS84 latitude/longitude
+
+sirene gives each establishment coordonneeLambertAbscisse/Ordonnee, converting them while cleaning means
+geo_location rows arrive with a latitude and longitude instead of going through the per-address geocoder.
+the inverse Lambert conformal conic projection is from IGN note ALG0004, evaluated with numpy over whole
+columns. RGF93 and WGS84 differ by well under a metre so no datum shift is applied. tests/test_geo_projection.py
+checks the conversion against reference points projected with PROJ
+"""
+import logging
+
+import numpy as np
+import polars as pl
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+# Lambert-93 projection constants published by IGN
+lambert93_n = 0.7256077650532670
+lambert93_c = 11754255.4261
+lambert93_xs = 700000.0
+lambert93_ys = 12655612.0499
+grs80_e = 0.08181919104281579
+lambert93_lon0 = np.radians(3.0)
+
+def lambert93_to_wgs84(x: np.ndarray, y: np.ndarray, iterations: int = 8) -> tuple:
+    """
+    vectorised inverse Lambert-93 projection
+    :param x: eastings in metres
+    :param y: northings in metres
+    :param iterations: fixed point iterations for the latitude, 8 converges to well below a millimetre
+    :return: latitude and longitude arrays in degrees, nan where the input is nan
+    """
+    dx = x - lambert93_xs
+    dy = lambert93_ys - y
+    r = np.hypot(dx, dy)
+    gamma = np.arctan2(dx, dy)
+    longitude = lambert93_lon0 + gamma / lambert93_n
+
+    # isometric latitude, then latitude by fixed point iteration (IGN ALG0001 inverse)
+    isometric_latitude = -np.log(r / lambert93_c) / lambert93_n
+    exp_isometric_latitude = np.exp(isometric_latitude)
+    latitude = 2 * np.arctan(exp_isometric_latitude) - np.pi / 2
+    for _ in range(iterations):
+        e_sin = grs80_e * np.sin(latitude)
+        latitude = 2 * np.arctan(((1 + e_sin) / (1 - e_sin)) ** (grs80_e / 2) * exp_isometric_latitude) - np.pi / 2
+
+    return np.degrees(latitude), np.degrees(longitude)
+
+
+def add_wgs84_columns(pldf: pl.DataFrame, x_column: str = 'LambertCoordinateX', y_column: str = 'LambertCoordinateY',
+                      batch_size: int = 1000000) -> pl.DataFrame:
+    """
+    add latitude and longitude columns converted from the Lambert-93 columns, in batches of batch_size rows
+    to bound the size of the numpy temporaries. rows without usable coordinates get null
+    :param pldf:
+    :param x_column:
+    :param y_column:
+    :param batch_size:
+    :return:
+    """
+    latitudes = []
+    longitudes = []
+    for offset in range(0, len(pldf), batch_size):
+        batch = pldf.slice(offset, batch_size)
+        x = batch[x_column].cast(pl.Float64, strict=False).fill_null(np.nan).to_numpy()
+        y = batch[y_column].cast(pl.Float64, strict=False).fill_null(np.nan).to_numpy()
+        # zero or negative coordinates are placeholders, not positions
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x = np.where(x > 0, x, np.nan)
+            y = np.where(y > 0, y, np.nan)
+            latitude, longitude = lambert93_to_wgs84(x, y)
+        latitudes.append(pl.Series('latitude', latitude).fill_nan(None))
+        longitudes.append(pl.Series('longitude', longitude).fill_nan(None))
+
+    if not latitudes:
+        return pldf.with_columns(pl.lit(None, dtype=pl.Float64).alias('latitude'),
+                                 pl.lit(None, dtype=pl.Float64).alias('longitude'))
+    return pldf.with_columns(pl.concat(latitudes), pl.concat(longitudes))
@@ -0,0 +1,151 @@
+"""
+head office of every legal unit, resolved from the month's cleaned files rather than by joins on the live tables
+
+    python head_office.py --month 2024-03 --sink mysql
+
+the legal file names the head office of a siren by its NIC (NICAssignment) and the etab file flags it with
+RegisteredOfficeBool. both are read from the month's snapshots in snapshot_store, joined in polars on
+siren + NIC, and every legal unit is given a status:
+
+    matched                 the siret exists in the etab file and is flagged as the head office
+    not_flagged_in_etab     the siret exists in the etab file but is not flagged
+    flagged_elsewhere       the etab file flags a different siret of the siren
+    head_office_missing     no live establishment has the siret, e.g. it was closed
+    no_nic                  the legal unit has no NICAssignment
+
+establishments flagged as a head office whose siren is not in the legal file are reported as unknown_legal_unit.
+the mapping, with the geo_md5 of the head office's geo_location row, is handed to the sink's write_head_offices
+and the counts and a sample of every mismatch are written to head_office_reports/<month>_report.json
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+import polars as pl
+
+import snapshot_store
+from sinks import Sink, create_sink
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+report_dir = 'head_office_reports'
+sample_size = 20
+
+
+def report_path(month: str) -> str:
+    return os.path.join(report_dir, f'{month}_report.json')
+
+
+def resolve_head_offices(etab: pl.LazyFrame, legal: pl.LazyFrame) -> tuple:
+    """
+    :param etab: cleaned etab rows, as text
+    :param legal: cleaned legal rows, as text
+    :return: the mapping, one row per legal unit, and the flagged establishments of unknown legal units
+    """
+    legal = legal.select(
+        pl.col('company_number').str.zfill(9),
+        pl.col('id').alias('organisation_id'),
+        pl.col('NICAssignment').str.strip().str.zfill(5).alias('nic'),
+    ).with_columns(
+        pl.when(pl.col('nic').str.lengths() == 5).then(pl.col('company_number') + pl.col('nic'))
+        .otherwise(None).alias('head_office_siret'))
+    etab = etab.select(
+        pl.col('siret').str.zfill(14),
+        pl.col('company_number').str.zfill(9),
+        pl.col('RegisteredOfficeBool').str.to_lowercase().is_in(['true', '1']).alias('flagged'),
+        'geo_md5')
+    flagged = etab.filter(pl.col('flagged')).groupby('company_number').agg(
+        pl.col('siret').first().alias('flagged_siret'),
+        pl.count().alias('flagged_count'))
+
+    mapping = legal.join(etab.select(pl.col('siret').alias('head_office_siret'), 'flagged', 'geo_md5',
+                                     pl.lit(True).alias('found')),
+                         on='head_office_siret', how='left') \
+        .join(flagged, on='company_number', how='left') \
+        .with_columns(
+            pl.when(pl.col('head_office_siret').is_null()).then(pl.lit('no_nic'))
+            .when(pl.col('found').is_null()).then(pl.lit('head_office_missing'))
+            .when(pl.col('flagged')).then(pl.lit('matched'))
+            .when(pl.col('flagged_siret').is_not_null()).then(pl.lit('flagged_elsewhere'))
+            .otherwise(pl.lit('not_flagged_in_etab')).alias('status')) \
+        .select('company_number', 'organisation_id', 'head_office_siret', 'geo_md5', 'status', 'flagged_siret',
+                pl.col('flagged_count').fill_null(0))
+    orphans = flagged.join(legal.select('company_number'), on='company_number', how='anti')
+    return mapping.collect(), orphans.collect()
+
+
+def build_report(mapping: pl.DataFrame, orphans: pl.DataFrame, month: str, source_digests: dict) -> dict:
+    counts = {row['status']: row['count'] for row in mapping.groupby('status').agg(pl.count()).to_dicts()}
+    counts['unknown_legal_unit'] = len(orphans)
+    samples = {status: mapping.filter(pl.col('status') == status).head(sample_size).to_dicts()
+               for status in counts if status not in ('matched', 'unknown_legal_unit')}
+    samples['unknown_legal_unit'] = orphans.head(sample_size).to_dicts()
+    # more than one flagged establishment is reported whatever the status
+    counts['several_flagged'] = mapping.filter(pl.col('flagged_count') > 1).height
+    samples['several_flagged'] = mapping.filter(pl.col('flagged_count') > 1).head(sample_size).to_dicts()
+    return {'month': month, 'legal_units': len(mapping), 'counts': counts, 'samples': samples,
+            'source_digests': source_digests}
+
+
+def describe_report(report: dict) -> str:
+    """
+    one line summary for the pipeline notifications
+    :param report:
+    :return:
+    """
+    return f'{report["legal_units"]} legal units, ' + \
+        ', '.join(f'{status} {count}' for status, count in sorted(report['counts'].items()))
+
+
+def run_head_office(sink: Sink, month: str, force: bool = False):
+    """
+    resolve the month's head offices and load the mapping through the sink, unless it was already loaded
+    from the same cleaned files
+    :param sink:
+    :param month: YYYY-MM, both files of the month must have been snapshotted
+    :param force: load the mapping even if the cleaned files are unchanged
+    :return: the report, None if there was nothing to do
+    """
+    if not all(month in snapshot_store.available_months(kind) for kind in snapshot_store.kinds):
+        logger.info(f'no etab and legal snapshots for {month}, head offices not resolved')
+        return None
+    source_digests = {kind: snapshot_store.read_index(kind, month)['source_digest'] for kind in snapshot_store.kinds}
+    if not force and os.path.exists(report_path(month)):
+        with open(report_path(month)) as f:
+            if json.load(f).get('source_digests') == source_digests:
+                logger.info(f'head offices of {month} are up to date')
+                return None
+
+    t0 = time.time()
+    mapping, orphans = resolve_head_offices(pl.scan_parquet(snapshot_store.snapshot_path('etab', month)),
+                                            pl.scan_parquet(snapshot_store.snapshot_path('legal', month)))
+    t1 = time.time()
+    logger.info(f'head offices of {len(mapping)} legal units resolved in {round(t1 - t0, 2)} seconds')
+    sink.write_head_offices(mapping.drop('flagged_count'), month)
+    logger.info(f'head office mapping loaded in {round(time.time() - t1, 2)} seconds')
+
+    report = build_report(mapping, orphans, month, source_digests)
+    os.makedirs(report_dir, exist_ok=True)
+    with open(report_path(month), 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    logger.info(f'head offices of {month}: {describe_report(report)}')
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='resolve and load the head office of every legal unit of a month')
+    parser.add_argument('--month', required=True, help='YYYY-MM, both files must have been snapshotted')
+    parser.add_argument('--sink', default='mysql',
+                        help='mysql, mysql:<env prefix>, duckdb:<path> or parquet:<directory>, or several comma '
+                             'separated sinks')
+    parser.add_argument('--force', action='store_true', help='load the mapping even if the files are unchanged')
+    args = parser.parse_args()
+    sink = create_sink(args.sink)
+    try:
+        run_head_office(sink, args.month, force=args.force)
+    finally:
+        sink.close()
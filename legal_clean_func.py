@@ -8,6 +8,14 @@ import time
 import logging
 import datetime
 
+from archive import keep_raw_zip
+from company_names import company_name_rows, write_company_names
+from quality_profile import QualityProfile, apply_filter_rules
+from memory_guard import guarded, fits_in_memory, read_csv_chunks, SpillBuffer, chunk_rows
+from profiling import profiled
+from stale_sync import write_pending_keys
+from stream_pipeline import StreamingCSVBatches, iter_csv_frames
+
 format_str = "[%(levelname)s: %(lineno)d] %(message)s"
 logging.basicConfig(level=logging.INFO, format=format_str)
 logger = logging.getLogger(__name__)
@@ -128,78 +136,77 @@ def map_company_type(input_dict: dict) -> str:
     return company_type_map[input_dict['LegalCategory'][0:2]]
 
 
-def legal_file_process(filename) -> str:
-    """
-    This function is used to process the UniteLegale .csv file as a whole before splitting it
-    :param filename:
-    :return:
-    """
-    unite_legale_cols = {
-        # breakdowns of each column name can be found on https://www.sirene.fr/static-resources/htm/v_sommaire_311.htm#7
-        'siren': 'company_number',  # we know this one
-        'statutDiffusionUniteLegale': 'LegalUnitBroadcastID',  # Dissemination status of the legal unit.
-        'unitePurgeeUniteLegale': 'PurgeStatus',  # whether or not the legal unit has been purged (removed?)
-        'dateCreationUniteLegale': 'DateCreated',  # date the
-        'sigleUniteLegale': 'LegalAcronym',  # legal acronym?
-        'sexeUniteLegale': 'GenderOfPerson',  # person/company's gender?
-        'prenom1UniteLegale': 'NaturalName1',  # not applicable to legal entities
-        'prenom2UniteLegale': 'NaturalName2',  # not applicable to legal entities
-        'prenom3UniteLegale': 'NaturalName3',  # not applicable to legal entities
-        'prenom4UniteLegale': 'NaturalName4',  # not applicable to legal entities
-        'prenomUsuelUniteLegale': 'PreferredName',  # not applicable to legal entities
-        'pseudonymeUniteLegale': 'pseudonym',  # pseudonym of the natural person
-        'identifiantAssociationUniteLegale': 'RNANumber',  #
-        'trancheEffectifsUniteLegale': 'EmployeeCountCategory',
-        'anneeEffectifsUniteLegale': 'EmployeeCountCategoryDateUpdated', # year when the employee number was last recorded
-        'dateDernierTraitementUniteLegale': 'LegalUnitUpdated',  #
-        'nombrePeriodesUniteLegale': 'TimeAsLegalUnit',  #
-        'categorieEntreprise': 'BusinessCategory',  # either SME (small-medium enterprise), Medium (ETI) or GE (Large)
-        'anneeCategorieEntreprise': 'YearOfBusinessCategoryAssignment',  #
-        'dateDebut': 'DateOfBusinessStart',  #
-        'etatAdministratifUniteLegale': 'AdministrativeStatus',  # A means active, C means inactive
-        'nomUniteLegale': 'PersonBirthName',  # not applicable
-        'nomUsageUniteLegale': 'PersonUsedName',  # not applicable
-        'denominationUniteLegale': 'LegalEntityName',  # company name
-        'denominationUsuelle1UniteLegale': 'LegalEntityName1',  # company name
-        'denominationUsuelle2UniteLegale': 'LegalEntityName2',  # company name
-        'denominationUsuelle3UniteLegale': 'LegalEntityName3',  # company name
-        'categorieJuridiqueUniteLegale': 'LegalCategory',  #
-        'activitePrincipaleUniteLegale': 'NAFCategory',  # different naf based on when the company set up
-        'nomenclatureActivitePrincipaleUniteLegale': 'ActiveLegalUnit',  #
-        'nicSiegeUniteLegale': 'NICAssignment',  #
-        'economieSocialeSolidaireUniteLegale': 'SSEBool',  #
-        'societeMissionUniteLegale': 'MissionDrivenCompanyBool',  #
-        'caractereEmployeurUniteLegale': 'EmployerNature',  # largely null according to sirene
-    }
-
-    # prepare the stock legal file for insert into staging
-    t0 = time.time()
-    pldf = pl.read_csv(filename, dtypes={'codeCommuneEtablissement': pl.Utf8,
-                                         'siren': pl.Utf8,
-                                         'siret': pl.Utf8,
-                                         'categorieJuridiqueUniteLegale': pl.Utf8,
-                                         'trancheEffectifsUniteLegale': pl.Utf8},
-
-                       ignore_errors=False)
-
-    original_pldf_size = len(pldf)
-
-    pldf = pldf.rename(unite_legale_cols)
-
+unite_legale_cols = {
+    # breakdowns of each column name can be found on https://www.sirene.fr/static-resources/htm/v_sommaire_311.htm#7
+    'siren': 'company_number',  # we know this one
+    'statutDiffusionUniteLegale': 'LegalUnitBroadcastID',  # Dissemination status of the legal unit.
+    'unitePurgeeUniteLegale': 'PurgeStatus',  # whether or not the legal unit has been purged (removed?)
+    'dateCreationUniteLegale': 'DateCreated',  # date the
+    'sigleUniteLegale': 'LegalAcronym',  # legal acronym?
+    'sexeUniteLegale': 'GenderOfPerson',  # person/company's gender?
+    'prenom1UniteLegale': 'NaturalName1',  # not applicable to legal entities
+    'prenom2UniteLegale': 'NaturalName2',  # not applicable to legal entities
+    'prenom3UniteLegale': 'NaturalName3',  # not applicable to legal entities
+    'prenom4UniteLegale': 'NaturalName4',  # not applicable to legal entities
+    'prenomUsuelUniteLegale': 'PreferredName',  # not applicable to legal entities
+    'pseudonymeUniteLegale': 'pseudonym',  # pseudonym of the natural person
+    'identifiantAssociationUniteLegale': 'RNANumber',  #
+    'trancheEffectifsUniteLegale': 'EmployeeCountCategory',
+    'anneeEffectifsUniteLegale': 'EmployeeCountCategoryDateUpdated', # year when the employee number was last recorded
+    'dateDernierTraitementUniteLegale': 'LegalUnitUpdated',  #
+    'nombrePeriodesUniteLegale': 'TimeAsLegalUnit',  #
+    'categorieEntreprise': 'BusinessCategory',  # either SME (small-medium enterprise), Medium (ETI) or GE (Large)
+    'anneeCategorieEntreprise': 'YearOfBusinessCategoryAssignment',  #
+    'dateDebut': 'DateOfBusinessStart',  #
+    'etatAdministratifUniteLegale': 'AdministrativeStatus',  # A means active, C means inactive
+    'nomUniteLegale': 'PersonBirthName',  # not applicable
+    'nomUsageUniteLegale': 'PersonUsedName',  # not applicable
+    'denominationUniteLegale': 'LegalEntityName',  # company name
+    'denominationUsuelle1UniteLegale': 'LegalEntityName1',  # company name
+    'denominationUsuelle2UniteLegale': 'LegalEntityName2',  # company name
+    'denominationUsuelle3UniteLegale': 'LegalEntityName3',  # company name
+    'categorieJuridiqueUniteLegale': 'LegalCategory',  #
+    'activitePrincipaleUniteLegale': 'NAFCategory',  # different naf based on when the company set up
+    'nomenclatureActivitePrincipaleUniteLegale': 'ActiveLegalUnit',  #
+    'nicSiegeUniteLegale': 'NICAssignment',  #
+    'economieSocialeSolidaireUniteLegale': 'SSEBool',  #
+    'societeMissionUniteLegale': 'MissionDrivenCompanyBool',  #
+    'caractereEmployeurUniteLegale': 'EmployerNature',  # largely null according to sirene
+}
+
+legal_read_options = {
+    'dtypes': {'codeCommuneEtablissement': pl.Utf8,
+               'siren': pl.Utf8,
+               'siret': pl.Utf8,
+               'categorieJuridiqueUniteLegale': pl.Utf8,
+               'trancheEffectifsUniteLegale': pl.Utf8},
+    'ignore_errors': False,
+}
+
+
+# rows are kept when they pass every rule, the rows each rule drops are counted in the quality profile
+legal_filter_rules = [
     # remove records where a company name is not found
     # perform a wider filtering of [ND], if a record has a lot of [ND] fields, especially fields we need, omit the record
-    pldf = pldf.filter(pl.col('LegalEntityName') != '[ND]')
-    pldf.drop_nulls(subset='LegalEntityName')
-
+    ('no_company_name', pl.col('LegalEntityName') != '[ND]'),
     # drop records where the legal category is 0000; these are people and not companies
-    pldf = pldf.filter(pl.col('LegalCategory') != '0000')
-
+    ('natural_person', pl.col('LegalCategory') != '0000'),
     # for now, we are only accepting LegalCategory 5xxx, as these are societe commerciale and the priority
-    logger.debug(f'size of file before filtering category for {filename}: {len(pldf)}')
+    ('not_societe_commerciale', pl.col('LegalCategory').str.slice(0, 1) == '5'),
+]
 
-    # filtering only on societe commercial
-    pldf = pldf.filter(pl.col('LegalCategory').str.slice(0,1) ==  '5')
-    logger.debug(f'size of file after filtering category for {filename}: {len(pldf)}')
+
+def clean_legal_frame(pldf: pl.DataFrame, filename: str, profile: QualityProfile = None) -> pl.DataFrame:
+    """
+    rename, filter and map the organisation columns for a frame of UniteLegale rows,
+    used on the whole file or on each batch in pipelined mode
+    :param pldf: frame read with legal_read_options
+    :param filename: source file, recorded in last_modified_by
+    :param profile: quality profile the frame is added to, while it is filtered
+    :return:
+    """
+    pldf = pldf.rename(unite_legale_cols)
+    pldf = apply_filter_rules(pldf, legal_filter_rules, profile)
 
     # map company_type ids
     pldf = pldf.with_columns(pl.struct(['LegalCategory']).apply(map_company_type, return_dtype=pl.Utf8).alias('company_type'))
@@ -217,20 +224,55 @@ def legal_file_process(filename) -> str:
     # map the category provided by siren to their documentation to get a range of numbers for employees, rather than a
     # representative category
     pldf = pldf.with_columns(pl.struct(['EmployeeCountCategory']).apply(map_employee_count, return_dtype=pl.Utf8).alias('EmployeeCount'))
-    t1 = time.time()
 
     # for diagnostic purposes, add filenames and update times into the dataframe
     pldf = pldf.with_columns(pl.lit(filename + ' - insert').alias('last_modified_by'))
     pldf = pldf.with_columns(pl.lit(datetime.datetime.now()).alias('last_modified_date'))
+    return pldf
 
-    new_pldf_size = len(pldf)
 
+def live_legal_keys(pldf: pl.DataFrame) -> pl.DataFrame:
+    """
+    organisation ids that are live this month, purged units are left out so they are flagged after the load
+    :param pldf: cleaned frame
+    :return:
+    """
+    return pldf.filter(pl.col('PurgeStatus').cast(pl.Utf8).fill_null('') != 'true').select('id')
+
+
+def log_legal_sizes(original_pldf_size: int, new_pldf_size: int) -> None:
     logger.info(f'size of file: {new_pldf_size}')
     logger.info(f'size of original file: {original_pldf_size}')
     logger.info(f'change in filesize: {round((original_pldf_size - new_pldf_size) / original_pldf_size * 100, 2)}')
 
+
+@profiled('clean_legal')
+@guarded('clean_legal')
+def legal_file_process(filename) -> str:
+    """
+    This function is used to process the UniteLegale .csv file as a whole before splitting it
+    :param filename:
+    :return:
+    """
+    if not fits_in_memory(filename):
+        return legal_chunked_process(filename)
+
+    # prepare the stock legal file for insert into staging
+    t0 = time.time()
+    pldf = pl.read_csv(filename, **legal_read_options)
+
+    profile = QualityProfile('legal')
+    pldf = clean_legal_frame(pldf, filename, profile)
+    t1 = time.time()
+
+    log_legal_sizes(profile.rows_in, profile.rows_out)
     logger.info('time taken to prepare stock legal: {}s'.format(round(t1 - t0)))
 
+    write_pending_keys(live_legal_keys(pldf), 'legal', 'id')
+    profile.write()
+    # and the normalised names with their blocking keys, for the sink to load into sirene_company_names
+    write_company_names(company_name_rows(pldf))
+
     # export to csv that will be fragmented
     pldf.write_csv('StockUniteLegale_clean.csv')
 
@@ -240,4 +282,75 @@ def legal_file_process(filename) -> str:
     return 'StockUniteLegale_clean.csv'
 
 
+def legal_chunked_process(filename) -> str:
+    """
+    process the UniteLegale .csv in chunks of chunk_rows when it does not fit in the memory budget,
+    each chunk is cleaned and appended to the clean csv, the live keys are spilled to disk if needed
+    :param filename:
+    :return:
+    """
+    logger.info(f'{filename} does not fit in the memory budget, cleaning it in chunks of {chunk_rows} rows')
+    t0 = time.time()
+    profile = QualityProfile('legal')
+    keys = SpillBuffer('legal_keys')
+    names = SpillBuffer('legal_names')
+    try:
+        with open('StockUniteLegale_clean.csv', 'wb') as f:
+            for batch_number, pldf in enumerate(read_csv_chunks(filename, legal_read_options)):
+                pldf = clean_legal_frame(pldf, filename, profile)
+                keys.append(live_legal_keys(pldf))
+                names.append(company_name_rows(pldf))
+                pldf.write_csv(f, has_header=batch_number == 0)
+                logger.info(f'chunk {batch_number + 1} cleaned, {profile.rows_out} rows so far')
+        t1 = time.time()
+
+        log_legal_sizes(profile.rows_in, profile.rows_out)
+        logger.info('time taken to prepare stock legal: {}s'.format(round(t1 - t0)))
+
+        write_pending_keys(keys.collect(unique=True), 'legal', 'id')
+        profile.write()
+        write_company_names(names.collect())
+    finally:
+        keys.close()
+        names.close()
+
+    # remove original file
+    os.remove(filename)
 
+    return 'StockUniteLegale_clean.csv'
+
+
+@profiled('stream_clean_legal')
+@guarded('stream_clean_legal')
+def legal_stream_process(filestring: str) -> str:
+    """
+    Process the UniteLegale file while it downloads, each batch is cleaned as soon as it has been inflated
+    and appended to the clean csv. the zip is moved to archive.raw_dir once the clean csv is complete
+    :param filestring: name of the monthly zip
+    :return:
+    """
+    t0 = time.time()
+    profile = QualityProfile('legal')
+    keys = SpillBuffer('legal_keys')
+    names = SpillBuffer('legal_names')
+    batches = StreamingCSVBatches(filestring)
+    with open('StockUniteLegale_clean.csv', 'wb') as f:
+        for batch_number, pldf in enumerate(iter_csv_frames(batches, legal_read_options)):
+            pldf = clean_legal_frame(pldf, batches.member_name, profile)
+            keys.append(live_legal_keys(pldf))
+            names.append(company_name_rows(pldf))
+            pldf.write_csv(f, has_header=batch_number == 0)
+            logger.info(f'batch {batch_number} cleaned, {profile.rows_out} rows so far')
+    t1 = time.time()
+
+    log_legal_sizes(profile.rows_in, profile.rows_out)
+    logger.info('time taken to download and prepare stock legal: {}s'.format(round(t1 - t0)))
+
+    write_pending_keys(keys.collect(unique=True), 'legal', 'id')
+    profile.write()
+    keys.close()
+    write_company_names(names.collect())
+    names.close()
+    # kept rather than removed, the download stage that holds it in the other mode is not run
+    keep_raw_zip(filestring)
+    return 'StockUniteLegale_clean.csv'
@@ -1,5 +1,19 @@
-from download_files import process_download, split_file, unzip_file
-from legal_clean_func import legal_file_process
+import company_names
+import legal_clean_func
+import quality_profile
+import stream_pipeline
+from download_files import process_download, split_file, unzip_file, find_fragment_offsets, write_fragment, \
+    wait_for_publication, record_applied_version
+from legal_clean_func import legal_file_process, legal_stream_process
+from sinks import Sink, MySQLSink
+from stage_cache import run_cached_stage
+from adaptive_batching import AdaptiveBatcher
+from fragment_loader import run_fragment_pipeline, describe_report
+from memory_guard import guarded, describe_peaks
+from profiling import profiled, profiling_enabled
+from stale_sync import pending_keys_path
+from snapshot_store import write_snapshot
+from quality_profile import record_profile
 import time
 import datetime
 import os
@@ -7,9 +21,8 @@ import os
 import polars as pl
 import logging
 
-from utils import connect_preprod, pipeline_messenger, constring
+from utils import pipeline_messenger
 
-cursor, db = connect_preprod()
 logger = logging.getLogger()
 logging.basicConfig(level=logging.INFO,
                     format='%(filename)s line:%(lineno)d %(message)s')
@@ -130,196 +143,189 @@ def map_company_type(input_dict: dict) -> str:
 
     return company_type_map[input_dict['LegalCategory'][0:2]]
 
-def process_legal_fragment(filename: str) -> None:
+def read_legal_fragment(filename: str) -> pl.DataFrame:
     """
-    main process to write to StockLegale
-    upserts to organisation and naf_code
+    read a cleaned fragment with the column types the staging table expects
     :param filename:
     :return:
     """
-
-    pldf = pl.read_csv(filename, dtypes={
+    return pl.read_csv(filename, dtypes={
                                          'company_number': pl.Utf8,
                                          'siret': pl.Utf8,
                                          'LegalCategory': pl.Utf8,
                                          'EmployeeCountCategory': pl.Utf8})
-    # sending polars dataframe to staging table
-    t0 = time.time()
-    pldf.write_database(table_name='sirene_stocklegal_staging',
-                        connection_uri=constring, if_exists='replace',
-                        )
-    t1 = time.time()
 
-    logger.info('time taken to write stock legal into staging: {}'.format(round(t1 - t0)))
-    # upsert into organisation
-    cursor.execute(
-        """
-        insert into organisation (
-    id,
-    company_number,
-    company_name,
-    company_status,
-    country,
-    date_formed,
-    company_type,
-    last_modified_by,
-    last_modified_date,
-    country_code)
-    
-    select
-    id,
-    company_number,
-    LegalEntityName,
-    company_status,
-    country,
-    DateCreated,
-    company_type,
-    last_modified_by,
-    last_modified_date,
-    'FR' as country_code
-    from sirene_stocklegal_staging
-
-    on duplicate key update
-    company_name = LegalEntityName,
-    organisation.company_status = sirene_stocklegal_staging.company_status,
-    organisation.company_type = sirene_stocklegal_staging.company_type,
-    organisation.last_modified_by = sirene_stocklegal_staging.last_modified_by,
-    organisation.last_modified_date = sirene_stocklegal_staging.last_modified_date"""
-    )
-    db.commit()
-    t0 = time.time()
 
-    # insert naf code data into NAF code
-    cursor.execute(
-        """
-        insert into naf_code (code, organisation_id, name_en, name_fr, last_modified_date, last_modified_by) 
-        
-        select  NAFCategory, id, t2.name_en, t2.name_fr, last_modified_date, last_modified_by
-        from sirene_stocklegal_staging t1
-        inner join naf_codes_translations t2
-        on t1.NAFCategory = t2.code
-        
-        on duplicate key update last_modified_date = curdate(), last_modified_by = 'stock legal pipeline update'
-        """
-    )
-    db.commit()
+@profiled('legal_fragment', per_fragment=True)
+def process_legal_fragment(filename: str, sink: Sink) -> None:
+    """
+    main process to write to StockLegale
+    reads a fragment and hands it to the sink, the mysql sink upserts to organisation and naf_code
+    :param filename:
+    :param sink:
+    :return:
+    """
 
-    t1 = time.time()
-    logger.info('time taken to insert NAF codes into staging: {}'.format(round(t1 - t0)))
+    pldf = read_legal_fragment(filename)
+    sink.write_legal(pldf)
 
-    # upsert staging table into main stock_legal table
-    t0 = time.time()
-    cursor.execute(
-        """
-        insert into sirene_stocklegal
-        select * from sirene_stocklegal_staging t2
-        on duplicate key update 
-    sirene_stocklegal.company_number = t2.company_number,
-    sirene_stocklegal.LegalUnitBroadcastID = t2.LegalUnitBroadcastID,
-    sirene_stocklegal.PurgeStatus = t2.PurgeStatus,
-    sirene_stocklegal.DateCreated = t2.DateCreated,
-    sirene_stocklegal.LegalAcronym = t2.LegalAcronym,
-    sirene_stocklegal.GenderOfPerson = t2.GenderOfPerson,
-    sirene_stocklegal.NaturalName1 = t2.NaturalName1,
-    sirene_stocklegal.NaturalName2 = t2.NaturalName2,
-    sirene_stocklegal.NaturalName3 = t2.NaturalName3,
-    sirene_stocklegal.NaturalName4 = t2.NaturalName4,
-    sirene_stocklegal.PreferredName = t2.PreferredName,
-    sirene_stocklegal.pseudonym = t2.pseudonym,
-    sirene_stocklegal.RNANumber = t2.RNANumber,
-    sirene_stocklegal.EmployeeCountCategory = t2.EmployeeCountCategory,
-    sirene_stocklegal.EmployeeCountCategoryDateUpdated = t2.EmployeeCountCategoryDateUpdated,
-    sirene_stocklegal.LegalUnitUpdated = t2.LegalUnitUpdated,
-    sirene_stocklegal.TimeAsLegalUnit = t2.TimeAsLegalUnit,
-    sirene_stocklegal.BusinessCategory = t2.BusinessCategory,
-    sirene_stocklegal.YearOfBusinessCategoryAssignment = t2.YearOfBusinessCategoryAssignment,
-    sirene_stocklegal.DateOfBusinessStart = t2.DateOfBusinessStart,
-    sirene_stocklegal.AdministrativeStatus = t2.AdministrativeStatus,
-    sirene_stocklegal.PersonBirthName = t2.PersonBirthName,
-    sirene_stocklegal.PersonUsedName = t2.PersonUsedName,
-    sirene_stocklegal.LegalEntityName = t2.LegalEntityName,
-    sirene_stocklegal.LegalEntityName1 = t2.LegalEntityName1,
-    sirene_stocklegal.LegalEntityName2 = t2.LegalEntityName2,
-    sirene_stocklegal.LegalEntityName3 = t2.LegalEntityName3,
-    sirene_stocklegal.LegalCategory = t2.LegalCategory,
-    sirene_stocklegal.NAFCategory = t2.NAFCategory,
-    sirene_stocklegal.ActiveLegalUnit = t2.ActiveLegalUnit,
-    sirene_stocklegal.NICAssignment = t2.NICAssignment,
-    sirene_stocklegal.SSEBool = t2.SSEBool,
-    sirene_stocklegal.MissionDrivenCompanyBool = t2.MissionDrivenCompanyBool,
-    sirene_stocklegal.EmployerNature = t2.EmployerNature,
-    sirene_stocklegal.country = t2.country,
-    sirene_stocklegal.country_code = t2.country_code,
-    sirene_stocklegal.last_modified_by = t2.last_modified_by,
-    sirene_stocklegal.last_modified_date = t2.last_modified_date
-        """
-    )
-    db.commit()
-    cursor.execute("""truncate table sirene_stocklegal_staging""")
-    db.commit()
-    t1 = time.time()
-    logger.info('time taken to upsert into live tables: {}'.format(round(t1-t0)))
-
-def run_legal():
-    # in the future, this will be the curdate month
-    current_date_month = datetime.datetime.now().month
-    current_date_year = datetime.datetime.now().year
-    filestring = f'{current_date_year}-{current_date_month:02d}-01-StockUniteLegale_utf8.zip'
-    logger.info(f'sending request with filestring: {filestring}')
 
-    # check if zipfile is not already in the dir
-    if filestring not in os.listdir():
-        t0 = time.time()
+def prepare_legal_fragments(filestring: str, pipelined: bool = False, remote_version: str = None) -> list:
+    """
+    download, clean and split the legal file, each stage is reused from the stage cache
+    when its input files, code and parameters are unchanged
+    :param filestring: name of the monthly zip
+    :param pipelined: download, inflate and clean in overlapping stages
+    :param remote_version: ETag or Last-Modified of the remote file, a republished file is downloaded again
+    :return: list of fragment paths
+    """
+    if pipelined:
+        intermediate_files = []
+        processed_file, _, _, _ = run_cached_stage(
+            'stream_clean_legal',
+            lambda: [legal_stream_process(filestring), pending_keys_path('legal'), company_names.names_path(),
+                     quality_profile.profile_path('legal')],
+            [], {'filestring': filestring, 'remote_version': remote_version},
+            [legal_clean_func, stream_pipeline, company_names, quality_profile])
+    else:
         # download file
-        # zipped_file = '2024-08-01-StockUniteLegale_utf8.zip'
-        zipped_file = process_download(filestring=filestring)
+        zipped_file, = run_cached_stage(
+            'download', lambda: process_download(filestring=filestring),
+            [], {'filestring': filestring, 'remote_version': remote_version}, [process_download])
         # unzip file
-        unzipped_file = unzip_file(filestring=zipped_file)
+        unzipped_file, = run_cached_stage(
+            'unzip', lambda: unzip_file(filestring=zipped_file),
+            [zipped_file], {}, [unzip_file])
         # process unzipped file
-        processed_file = legal_file_process(filename=unzipped_file)
-        # split processed file
-        split_file(processed_file)
-        t1 = time.time()
-        download_time = round(t1 - t0)
-        logger.info(f'download and processing time: {download_time}')
-    else:
-        logger.info('file already downloaded')
+        processed_file, _, _, _ = run_cached_stage(
+            'clean_legal',
+            lambda: [legal_file_process(filename=unzipped_file), pending_keys_path('legal'),
+                     company_names.names_path(), quality_profile.profile_path('legal')],
+            [unzipped_file], {}, [legal_clean_func, company_names, quality_profile])
+        intermediate_files = [zipped_file, unzipped_file]
 
-    # process_download leaves the section fragments to be processed
-    list_of_fragments = os.listdir('fragments')
-    frag_count = 1
-    try:
+    # split processed file
+    list_of_fragments = run_cached_stage(
+        'split', lambda: split_file(processed_file),
+        [processed_file], {'linecount': 50000}, [split_file, find_fragment_offsets, write_fragment])
+
+    # keep the cleaned file as the month's snapshot for point-in-time lookups
+    write_snapshot('legal', filestring[:7], processed_file)
+    # and its quality profile, flagging drift from the previous month
+    record_profile('legal', filestring[:7])
+
+    # every stage output is kept in the cache, working copies restored from it are not needed any more
+    for intermediate_file in intermediate_files + [processed_file]:
+        if os.path.exists(intermediate_file):
+            os.remove(intermediate_file)
+    return list_of_fragments
+
+
+def legal_filestring(month: str = None) -> str:
+    """
+    name of the monthly StockUniteLegale zip
+    :param month: YYYY-MM, defaults to the current month
+    :return:
+    """
+    if month is None:
+        month = datetime.datetime.now().strftime('%Y-%m')
+    return f'{month}-01-StockUniteLegale_utf8.zip'
+
+
+@guarded('load_legal')
+def load_legal_fragments(list_of_fragments: list, sink: Sink, month: str, prefetch: int = 2) -> dict:
+    """
+    write every fragment of a month through the sink, removing each fragment once written.
+    the next fragments are parsed in a producer thread while the current one is being loaded, and are
+    re-batched to the size that keeps each write near its target duration
+    :param list_of_fragments:
+    :param sink:
+    :param month: YYYY-MM of the stock file
+    :param prefetch: fragments parsed ahead of the load, 0 loads them one at a time
+    :return: load report, with the time taken per batch and the parse/load overlap
+    """
+    sink.begin('legal', month)
+    if prefetch and not profiling_enabled():
+        report = run_fragment_pipeline(list_of_fragments, read_legal_fragment, sink.write_legal, prefetch=prefetch,
+                                       batcher=AdaptiveBatcher('legal'), lock_wait_seconds=sink.lock_wait_seconds,
+                                       write_times=sink.write_times)
+    else:
+        # profiled fragments are parsed and loaded together so their profiles cover both
         t0 = time.time()
         fragment_times = []
-        logger.debug('processing fragments')
         for fragment in list_of_fragments:
-            logger.info(fragment)
-            if 'Legal' in filestring and 'Legal' in fragment:
-                f_t0 = time.time()
-                process_legal_fragment(filename='fragments/' + fragment)
-                os.remove('fragments/' + fragment)
-                frag_count += 1
-                f_t1 = time.time()
-                fragment_time_taken = round(f_t1 - f_t0)
-                fragment_times.append(fragment_time_taken)
+            f_t0 = time.time()
+            process_legal_fragment(filename=fragment, sink=sink)
+            os.remove(fragment)
+            f_t1 = time.time()
+            fragment_time_taken = round(f_t1 - f_t0)
+            fragment_times.append(fragment_time_taken)
+        report = {'fragments': len(fragment_times), 'batches': len(fragment_times),
+                  'batch_times': fragment_times,
+                  'wall_time': round(time.time() - t0, 2), 'producer_busy': 0.0, 'producer_blocked': 0.0,
+                  'consumer_busy': round(time.time() - t0, 2), 'consumer_waiting': 0.0, 'overlap': 0.0}
+    sink.finish('legal')
+    return report
+
+
+def run_legal(sink: Sink = None, pipelined: bool = False, month: str = None, force: bool = False,
+              wait_seconds: float = 0):
+    """
+    download, clean and load a month's stock file, unless it is unchanged since it was last loaded
+    :param sink: defaults to the preprod MySQL database
+    :param pipelined:
+    :param month: YYYY-MM, defaults to the current month
+    :param force: load the file even if it has not changed
+    :param wait_seconds: keep probing for this long, with backoff, if the file has not been published yet
+    :return: the load report, None if the file was unchanged and False if the load failed
+    """
+    filestring = legal_filestring(month)
+    probe = wait_for_publication(filestring, max_wait_seconds=wait_seconds)
+    if not probe['changed'] and not force:
+        logger.info(f'{filestring} is unchanged since it was last loaded, skipping')
+        return
+    logger.info(f'sending request with filestring: {filestring}')
+
+    t0 = time.time()
+    list_of_fragments = prepare_legal_fragments(filestring, pipelined=pipelined,
+                                                remote_version=probe['etag'] or probe['last_modified'])
+    t1 = time.time()
+    download_time = round(t1 - t0)
+    logger.info(f'download and processing time: {download_time}')
+
+    owns_sink = sink is None
+    if owns_sink:
+        sink = MySQLSink()
+    try:
+        t0 = time.time()
+        load_report = load_legal_fragments(list_of_fragments, sink, filestring[:7])
+        batch_times = load_report['batch_times']
+        record_applied_version(filestring, probe)
         t1 = time.time()
         time_taken = t1 - t0
         logger.info('total time for processing: {}'.format(time_taken))
-        avg_time_taken = round(sum(fragment_times) / (len(fragment_times)-1), 2)
-        logger.info('average fragment processing time: {}'.format(avg_time_taken))
+        # the writes are re-batched, so a batch is not a fragment
+        avg_time_taken = round(sum(batch_times) / max(len(batch_times), 1), 2)
+        avg_fragment_time = round(time_taken / max(load_report['fragments'], 1), 2)
+        logger.info('average batch processing time: {}, per fragment: {}'.format(avg_time_taken, avg_fragment_time))
 
 
         pipeline_messenger(
             title='Sirene Stock Unite Legale Pipeline has run',
-            text=f'time taken: {time_taken}\n average time per fragment: {avg_time_taken}',
+            text=f'time taken: {time_taken}\n average time per batch: {avg_time_taken} over {len(batch_times)} batches, per fragment: {avg_fragment_time}\n {describe_report(load_report)}\n peak memory: {describe_peaks()}',
             notification_type='pass'
         )
+        return load_report
     except Exception as e:
         pipeline_messenger(
             title='Sirene Stock Unite Legale Pipeline has failed',
             text= f'Error in file: {filestring} - {e}',
             notification_type='fail'
         )
+        return False
+    finally:
+        if owns_sink:
+            sink.close()
 
 if __name__ == '__main__':
     run_legal()
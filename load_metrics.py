@@ -0,0 +1,182 @@
+"""
+per-statement metrics of the database load
+
+every statement the MySQL sink runs for a fragment goes through LoadMetrics.execute, which records the rows
+affected, the warnings it raised and the change in a few status counters: Handler_write and Handler_update tell
+inserts from updates (an insert ... on duplicate key update counts 1 row affected per insert, 2 per update and 0
+for an unchanged row), lock_time_ms shows time this connection lost waiting on locks and Innodb_buffer_pool_reads
+time lost on disk reads. Innodb_buffer_pool_reads is server wide, the other counters are for this session: the
+lock time is read from performance_schema because Innodb_row_lock_time is only kept server wide and would count
+the waits of every other writer.
+
+at the end of each file the records are written to the pipeline_load_metrics table and to
+load_reports/<run_id>.json, the run id being <month>_<kind>_<timestamp>
+"""
+import datetime
+import json
+import logging
+import os
+import time
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+report_dir = 'load_reports'
+status_counters = ['Handler_write', 'Handler_update', 'Handler_delete', 'Handler_read_key', 'Innodb_buffer_pool_reads']
+max_warnings_kept = 5
+
+
+def session_lock_seconds(cursor) -> float:
+    """
+    time the statements of this connection have spent waiting on locks, row lock waits included since MySQL 8.0.28
+    :param cursor:
+    :return: cumulative seconds
+    """
+    cursor.execute(
+        """
+        select coalesce(sum(sum_lock_time), 0)
+        from performance_schema.events_statements_summary_by_thread_by_event_name
+        where thread_id = ps_current_thread_id()
+        """
+    )
+    row = cursor.fetchone()
+    # picoseconds
+    return int(row[0]) / 1e12 if row else 0.0
+
+
+class LoadMetrics:
+    """
+    collects a record per statement for one file load
+    """
+
+    def __init__(self, cursor, db, kind: str, month: str):
+        self.cursor = cursor
+        self.db = db
+        self.kind = kind
+        self.month = month
+        self.run_id = f'{month}_{kind}_{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}'
+        self.fragment = 0
+        self.records = []
+        self.status_overhead = self.measure_status_overhead()
+
+    def next_fragment(self) -> None:
+        self.fragment += 1
+
+    def read_status(self) -> dict:
+        placeholders = ', '.join(['%s'] * len(status_counters))
+        self.cursor.execute(f"""show session status where variable_name in ({placeholders})""", status_counters)
+        status = {name: int(value) for name, value in self.cursor.fetchall()}
+        status['lock_time_ms'] = round(session_lock_seconds(self.cursor) * 1000)
+        return status
+
+    def measure_status_overhead(self) -> dict:
+        """
+        reading the status counters moves some of them (show status materialises a temporary table),
+        measure that once so it can be taken out of every delta
+        :return:
+        """
+        first = self.read_status()
+        second = self.read_status()
+        return {name: second[name] - first.get(name, 0) for name in second}
+
+    def record(self, statement: str, seconds: float, rows_affected: int, warnings: list = None,
+               status_delta: dict = None) -> dict:
+        record = {'run_id': self.run_id,
+                  'kind': self.kind,
+                  'month': self.month,
+                  'fragment': self.fragment,
+                  'statement': statement,
+                  'rows_affected': rows_affected,
+                  'seconds': round(seconds, 3),
+                  'warning_count': len(warnings or []),
+                  'warnings': (warnings or [])[:max_warnings_kept],
+                  'status_delta': status_delta or {},
+                  'recorded_at': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        self.records.append(record)
+        return record
+
+    def execute(self, statement: str, sql: str, params=None) -> int:
+        """
+        run and commit a statement, recording its metrics
+        :param statement: short name of the statement, e.g. geo_location_upsert
+        :param sql:
+        :param params:
+        :return: rows affected
+        """
+        status_before = self.read_status()
+        t0 = time.time()
+        self.cursor.execute(sql, params)
+        rows_affected = self.cursor.rowcount
+        # warnings have to be read before any other statement resets them
+        self.cursor.execute("""show warnings""")
+        warnings = [f'{level} {code}: {message}' for level, code, message in self.cursor.fetchall()]
+        self.db.commit()
+        seconds = time.time() - t0
+        status_after = self.read_status()
+        status_delta = {name: max(value - status_before.get(name, 0) - self.status_overhead.get(name, 0), 0)
+                        for name, value in status_after.items()}
+        self.record(statement, seconds, rows_affected, warnings, status_delta)
+        if warnings:
+            logger.warning(f'{statement} raised {len(warnings)} warnings, first: {warnings[0]}')
+        return rows_affected
+
+    def summary(self) -> dict:
+        """
+        :return: per statement totals of rows, seconds, warnings and counter deltas
+        """
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['statement'], {'count': 0, 'rows_affected': 0, 'seconds': 0.0,
+                                                            'warning_count': 0, 'status_delta': {}})
+            total['count'] += 1
+            total['rows_affected'] += record['rows_affected']
+            total['seconds'] = round(total['seconds'] + record['seconds'], 3)
+            total['warning_count'] += record['warning_count']
+            for name, delta in record['status_delta'].items():
+                total['status_delta'][name] = total['status_delta'].get(name, 0) + delta
+        return totals
+
+    def flush(self) -> str:
+        """
+        write the records to pipeline_load_metrics and the local json report
+        :return: path of the json report
+        """
+        os.makedirs(report_dir, exist_ok=True)
+        report_path = os.path.join(report_dir, f'{self.run_id}.json')
+        with open(report_path, 'w') as f:
+            json.dump({'run_id': self.run_id, 'kind': self.kind, 'month': self.month,
+                       'summary': self.summary(), 'statements': self.records}, f, indent=2)
+
+        self.cursor.execute(
+            """
+            create table if not exists pipeline_load_metrics (
+            id bigint auto_increment primary key,
+            run_id varchar(64) not null,
+            kind varchar(16) not null,
+            month varchar(7) not null,
+            fragment int not null,
+            statement varchar(64) not null,
+            rows_affected bigint,
+            seconds double,
+            warning_count int,
+            warnings text,
+            status_delta json,
+            recorded_at datetime,
+            key run_id (run_id))
+            """
+        )
+        self.cursor.executemany(
+            """
+            insert into pipeline_load_metrics
+            (run_id, kind, month, fragment, statement, rows_affected, seconds, warning_count, warnings,
+            status_delta, recorded_at)
+            values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """,
+            [(record['run_id'], record['kind'], record['month'], record['fragment'], record['statement'],
+              record['rows_affected'], record['seconds'], record['warning_count'], json.dumps(record['warnings']),
+              json.dumps(record['status_delta']), record['recorded_at']) for record in self.records]
+        )
+        self.db.commit()
+        logger.info(f'{len(self.records)} statement metrics written to pipeline_load_metrics and {report_path}')
+        return report_path
@@ -0,0 +1,406 @@
+"""
+read-only SIREN/SIRET lookup service over the latest cleaned snapshot
+
+    python lookup_service.py build --lake sirene_lake --month 2024-01
+    python lookup_service.py serve --port 8080
+
+build turns a month of the parquet lake written by ParquetSink (or a pair of cleaned csv/parquet files) into
+lookup/<month>/: the keys as sorted int64 arrays and each field as an array, strings as an offsets array and a
+utf-8 byte array. the arrays are memory mapped by the service, so a lookup is a binary search with
+np.searchsorted and a few slices, and several service processes share the same pages. a month is built in a
+hidden directory next to it, manifest.json written last, and renamed into place, so arrays a running service has
+mapped are never rewritten under it.
+
+    GET  /siren/<siren>     legal unit with its head office
+    GET  /siret/<siret>     establishment with its legal unit
+    POST /lookup            {"siren": [...], "siret": [...]}, up to max_batch keys
+    GET  /health
+
+the service checks the lookup directory every reload_seconds and swaps in a newer complete month, or a rebuild of
+its month, without a restart, requests in flight finish on the snapshot they started with
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import polars as pl
+import pyarrow as pa
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+lookup_dir = os.environ.get('sirene_lookup_dir', 'lookup')
+max_batch = 10000
+
+# field name in the response -> cleaned column
+legal_fields = {'name': 'LegalEntityName',
+                'naf': 'NAFCategory',
+                'legal_category': 'LegalCategory',
+                'status': 'company_status',
+                'date_created': 'DateCreated',
+                'head_office_nic': 'NICAssignment'}
+etab_fields = {'address_line_1': 'address_line_1',
+               'address_line_2': 'address_line_2',
+               'post_code': 'AddressPostcode',
+               'town': 'AddressMunicipalityLabel',
+               'naf': 'APETCode',
+               'office_type': 'registered_office_type',
+               'status': 'AdministrativeStatus'}
+etab_float_fields = ['latitude', 'longitude']
+
+
+def scan_source(path: str) -> pl.LazyFrame:
+    if path.endswith('.csv'):
+        return pl.scan_csv(path, infer_schema_length=0)
+    return pl.scan_parquet(path)
+
+
+def write_string_array(directory: str, name: str, series: pl.Series) -> None:
+    """
+    write a string column as <name>_offsets.npy and <name>_data.npy, taken straight from the arrow buffers
+    :param directory:
+    :param name:
+    :param series:
+    :return:
+    """
+    array = series.cast(pl.Utf8).fill_null('').to_arrow().cast(pa.large_string())
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    _, offsets_buffer, data_buffer = array.buffers()
+    offsets = np.frombuffer(offsets_buffer, dtype=np.int64)[array.offset:array.offset + len(array) + 1]
+    data = np.frombuffer(data_buffer, dtype=np.uint8) if data_buffer is not None else np.zeros(0, dtype=np.uint8)
+    np.save(os.path.join(directory, f'{name}_offsets.npy'), offsets - offsets[0])
+    np.save(os.path.join(directory, f'{name}_data.npy'), data[offsets[0]:offsets[-1]])
+
+
+def write_keyed_arrays(directory: str, pldf: pl.DataFrame, key: str, fields: dict, float_fields: list) -> int:
+    """
+    :param directory:
+    :param pldf: must have an int64 column named key
+    :param key:
+    :param fields: response field -> string column
+    :param float_fields:
+    :return: number of keys written
+    """
+    pldf = pldf.filter(pl.col(key).is_not_null()).unique(subset=key, keep='last').sort(key)
+    np.save(os.path.join(directory, f'{key}.npy'), pldf[key].to_numpy())
+    for field, column in fields.items():
+        write_string_array(directory, field, pldf[column] if column in pldf.columns
+                           else pl.Series([''] * len(pldf)))
+    for field in float_fields:
+        values = pldf[field].cast(pl.Float64) if field in pldf.columns else pl.Series([None] * len(pldf),
+                                                                                        dtype=pl.Float64)
+        np.save(os.path.join(directory, f'{field}.npy'), values.fill_null(np.nan).to_numpy())
+    return len(pldf)
+
+
+def build_snapshot(month: str, etab_source: str, legal_source: str, root: str = None) -> str:
+    """
+    :param month: YYYY-MM, names the snapshot
+    :param etab_source: cleaned etab rows, a csv, a parquet file or a parquet glob
+    :param legal_source: cleaned legal rows
+    :param root: lookup directory
+    :return: the snapshot directory
+    """
+    t0 = time.time()
+    root = root or lookup_dir
+    directory = os.path.join(root, month)
+    build_directory = os.path.join(root, f'.{month}.build.{os.getpid()}')
+    shutil.rmtree(build_directory, ignore_errors=True)
+    try:
+        legal_count, etab_count = write_snapshot_arrays(build_directory, month, etab_source, legal_source)
+    except Exception:
+        shutil.rmtree(build_directory, ignore_errors=True)
+        raise
+
+    # the directory a service has mapped is moved aside and unlinked, never truncated, its pages stay valid
+    # until the service swaps to the new build
+    old_directory = os.path.join(root, f'.{month}.old.{os.getpid()}')
+    if os.path.exists(directory):
+        os.replace(directory, old_directory)
+    os.replace(build_directory, directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+    logger.info(f'lookup snapshot {directory} built in {round(time.time() - t0)} seconds: '
+                f'{legal_count} legal units, {etab_count} establishments')
+    return directory
+
+
+def write_snapshot_arrays(directory: str, month: str, etab_source: str, legal_source: str) -> tuple:
+    """
+    :param directory: new directory the arrays are written to
+    :param month:
+    :param etab_source:
+    :param legal_source:
+    :return: number of legal units and establishments written
+    """
+    os.makedirs(os.path.join(directory, 'etab'))
+    os.makedirs(os.path.join(directory, 'legal'))
+
+    legal_columns = ['company_number'] + list(legal_fields.values())
+    legal_pldf = scan_source(legal_source)
+    legal_pldf = legal_pldf.select([column for column in legal_columns if column in legal_pldf.columns]) \
+        .with_columns(pl.col('company_number').cast(pl.Int64, strict=False).alias('siren')).collect()
+    legal_count = write_keyed_arrays(os.path.join(directory, 'legal'), legal_pldf, 'siren', legal_fields, [])
+    del legal_pldf
+
+    etab_columns = ['siret'] + list(etab_fields.values()) + etab_float_fields
+    etab_pldf = scan_source(etab_source)
+    etab_pldf = etab_pldf.select([column for column in etab_columns if column in etab_pldf.columns]) \
+        .with_columns(pl.col('siret').cast(pl.Int64, strict=False)).collect()
+    etab_count = write_keyed_arrays(os.path.join(directory, 'etab'), etab_pldf, 'siret', etab_fields,
+                                    etab_float_fields)
+    del etab_pldf
+
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump({'month': month, 'legal_units': legal_count, 'establishments': etab_count,
+                   'built_at': time.strftime('%Y-%m-%d %H:%M:%S')}, f)
+    return legal_count, etab_count
+
+
+def build_from_lake(month: str, lake_root: str, root: str = None) -> str:
+    """
+    build the snapshot of a month written by ParquetSink
+    :param month:
+    :param lake_root:
+    :param root: lookup directory
+    :return:
+    """
+    return build_snapshot(month,
+                          os.path.join(lake_root, 'sirene_stocketab', f'month={month}', '*', '*.parquet'),
+                          os.path.join(lake_root, 'sirene_stocklegal', f'month={month}', '*', '*.parquet'),
+                          root)
+
+
+def latest_snapshot(root: str = None):
+    """
+    :param root: lookup directory
+    :return: directory of the latest complete month, None if there is none
+    """
+    root = root or lookup_dir
+    if not os.path.isdir(root):
+        return None
+    # months being built or replaced are hidden
+    months = sorted(month for month in os.listdir(root)
+                    if not month.startswith('.') and os.path.exists(os.path.join(root, month, 'manifest.json')))
+    return os.path.join(root, months[-1]) if months else None
+
+
+class KeyedArrays:
+    """
+    memory mapped arrays of one snapshot table
+    """
+
+    def __init__(self, directory: str, key: str, fields: list, float_fields: list):
+        def load(name):
+            return np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+
+        self.keys = load(key)
+        self.strings = {field: (load(f'{field}_offsets'), load(f'{field}_data')) for field in fields}
+        self.floats = {field: load(field) for field in float_fields}
+
+    def find(self, keys: np.ndarray) -> np.ndarray:
+        """
+        :param keys: int64 keys
+        :return: row of each key, -1 when it is missing
+        """
+        positions = np.searchsorted(self.keys, keys)
+        positions = np.minimum(positions, len(self.keys) - 1) if len(self.keys) else np.zeros_like(keys)
+        found = (self.keys[positions] == keys) if len(self.keys) else np.zeros(len(keys), dtype=bool)
+        return np.where(found, positions, -1)
+
+    def row(self, position: int) -> dict:
+        record = {}
+        for field, (offsets, data) in self.strings.items():
+            record[field] = bytes(data[offsets[position]:offsets[position + 1]]).decode('utf-8')
+        for field, values in self.floats.items():
+            value = float(values[position])
+            record[field] = None if np.isnan(value) else value
+        return record
+
+
+def read_manifest(directory: str) -> dict:
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        return json.load(f)
+
+
+class LookupSnapshot:
+    """
+    legal units and establishments of one month
+    """
+
+    def __init__(self, directory: str):
+        self.manifest = read_manifest(directory)
+        self.directory = directory
+        self.month = self.manifest['month']
+        self.legal = KeyedArrays(os.path.join(directory, 'legal'), 'siren', list(legal_fields), [])
+        self.etab = KeyedArrays(os.path.join(directory, 'etab'), 'siret', list(etab_fields), etab_float_fields)
+
+    def lookup_siren(self, sirens: list) -> list:
+        """
+        :param sirens: ints
+        :return: a record with the head office establishment per siren, None when it is unknown
+        """
+        keys = np.asarray(sirens, dtype=np.int64)
+        positions = self.legal.find(keys)
+        records = [self.legal.row(position) if position >= 0 else None for position in positions]
+        head_office_sirets = [siren * 100000 + int(record['head_office_nic'])
+                              if record and record['head_office_nic'].isdigit() else -1
+                              for siren, record in zip(keys.tolist(), records)]
+        head_office_positions = self.etab.find(np.asarray(head_office_sirets, dtype=np.int64))
+        results = []
+        for siren, record, siret, position in zip(keys.tolist(), records, head_office_sirets,
+                                                  head_office_positions):
+            if record is None:
+                results.append(None)
+                continue
+            record = {'siren': f'{siren:09d}', **record}
+            record['head_office'] = {'siret': f'{siret:014d}', **self.etab.row(position)} if position >= 0 else None
+            results.append(record)
+        return results
+
+    def lookup_siret(self, sirets: list) -> list:
+        """
+        :param sirets: ints
+        :return: a record with its legal unit per siret, None when it is unknown
+        """
+        keys = np.asarray(sirets, dtype=np.int64)
+        positions = self.etab.find(keys)
+        legal_positions = self.legal.find(keys // 100000)
+        results = []
+        for siret, position, legal_position in zip(keys.tolist(), positions, legal_positions):
+            if position < 0:
+                results.append(None)
+                continue
+            record = {'siret': f'{siret:014d}', 'siren': f'{siret // 100000:09d}', **self.etab.row(position)}
+            if legal_position >= 0:
+                legal_record = self.legal.row(legal_position)
+                record['legal_unit'] = {'name': legal_record['name'], 'naf': legal_record['naf'],
+                                        'legal_category': legal_record['legal_category']}
+            else:
+                record['legal_unit'] = None
+            results.append(record)
+        return results
+
+
+def parse_keys(values: list, digits: int) -> list:
+    """
+    :param values: strings or ints
+    :param digits: 9 for a siren, 14 for a siret
+    :return: the keys as ints
+    """
+    keys = []
+    for value in values:
+        value = str(value).replace(' ', '')
+        if len(value) != digits or not value.isdigit():
+            raise ValueError(f'{value} is not a {digits} digit number')
+        keys.append(int(value))
+    return keys
+
+
+def create_app(root: str = None, reload_seconds: float = 60):
+    """
+    :param root: lookup directory
+    :param reload_seconds: how often to look for a newer month, 0 to never reload
+    :return: the flask app
+    """
+    from flask import Flask, jsonify, request  # optional, only needed to serve
+
+    directory = latest_snapshot(root)
+    if directory is None:
+        raise FileNotFoundError(f'no complete lookup snapshot in {root or lookup_dir}, run lookup_service.py build')
+    state = {'snapshot': LookupSnapshot(directory), 'loaded_at': time.strftime('%Y-%m-%d %H:%M:%S')}
+    logger.info(f'serving lookups from {directory}')
+
+    def reload_loop():
+        while True:
+            time.sleep(reload_seconds)
+            try:
+                directory = latest_snapshot(root)
+                if directory and (directory != state['snapshot'].directory or
+                                  read_manifest(directory) != state['snapshot'].manifest):
+                    # a plain reference swap, requests in flight keep the snapshot they hold
+                    state['snapshot'] = LookupSnapshot(directory)
+                    state['loaded_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
+                    logger.info(f'reloaded lookups from {directory}')
+            except Exception as e:
+                logger.error(f'lookup reload failed, still serving {state["snapshot"].month}: {e}')
+
+    if reload_seconds:
+        threading.Thread(target=reload_loop, daemon=True).start()
+
+    app = Flask(__name__)
+
+    def single_lookup(value: str, digits: int, lookup):
+        try:
+            keys = parse_keys([value], digits)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        snapshot = state['snapshot']
+        record = lookup(snapshot, keys)[0]
+        if record is None:
+            return jsonify({'error': f'{value} not found in {snapshot.month}'}), 404
+        return jsonify({'month': snapshot.month, **record})
+
+    @app.get('/siren/<siren>')
+    def siren_lookup(siren):
+        return single_lookup(siren, 9, LookupSnapshot.lookup_siren)
+
+    @app.get('/siret/<siret>')
+    def siret_lookup(siret):
+        return single_lookup(siret, 14, LookupSnapshot.lookup_siret)
+
+    @app.post('/lookup')
+    def batch_lookup():
+        body = request.get_json(silent=True) or {}
+        sirens = body.get('siren', [])
+        sirets = body.get('siret', [])
+        if len(sirens) + len(sirets) > max_batch:
+            return jsonify({'error': f'at most {max_batch} keys per request'}), 400
+        try:
+            siren_keys = parse_keys(sirens, 9)
+            siret_keys = parse_keys(sirets, 14)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        snapshot = state['snapshot']
+        return jsonify({'month': snapshot.month,
+                        'siren': dict(zip([f'{key:09d}' for key in siren_keys], snapshot.lookup_siren(siren_keys))),
+                        'siret': dict(zip([f'{key:014d}' for key in siret_keys],
+                                          snapshot.lookup_siret(siret_keys)))})
+
+    @app.get('/health')
+    def health():
+        snapshot = state['snapshot']
+        return jsonify({'month': snapshot.month, 'loaded_at': state['loaded_at'], **snapshot.manifest})
+
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SIREN/SIRET lookup service over the cleaned snapshot')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='build the lookup arrays of a month')
+    build_parser.add_argument('--month', required=True, help='YYYY-MM')
+    build_parser.add_argument('--lake', default='sirene_lake', help='parquet lake written by ParquetSink')
+    build_parser.add_argument('--etab', help='cleaned etab csv or parquet, instead of the lake')
+    build_parser.add_argument('--legal', help='cleaned legal csv or parquet, instead of the lake')
+    build_parser.add_argument('--lookup-dir', default=lookup_dir)
+    serve_parser = subparsers.add_parser('serve', help='serve lookups from the latest month')
+    serve_parser.add_argument('--lookup-dir', default=lookup_dir)
+    serve_parser.add_argument('--host', default='0.0.0.0')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    serve_parser.add_argument('--reload-seconds', type=float, default=60)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if args.etab and args.legal:
+            build_snapshot(args.month, args.etab, args.legal, args.lookup_dir)
+        else:
+            build_from_lake(args.month, args.lake, args.lookup_dir)
+    else:
+        create_app(args.lookup_dir, args.reload_seconds).run(host=args.host, port=args.port, threaded=True)
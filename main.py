@@ -1,15 +1,56 @@
 """
 runs both files
 """
+from archive import archive_month, describe_failures
 from etab_main import run_etab
+from head_office import run_head_office, describe_report
 from legal_main import run_legal
+from profiling import enable_profiling
+from lookup_service import build_from_lake
+from sinks import create_sink, lake_root
 from utils import pipeline_messenger
+import argparse
+import datetime
 import sys
 import traceback
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='load the monthly sirene stock files')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='rebuild sirene_stocketab and sirene_stocklegal in shadow tables and swap them in, '
+                             'rather than upserting into the live tables')
+    parser.add_argument('--sink', default='mysql',
+                        help='where to write the cleaned fragments: mysql, mysql:<env prefix>, duckdb:<path> or '
+                             'parquet:<directory>, several comma separated sinks are loaded from one parse')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='clean the stock files while they download rather than after download and unzip')
+    parser.add_argument('--force', action='store_true',
+                        help='load the stock files even if they are unchanged since the last run')
+    parser.add_argument('--wait-hours', type=float, default=0,
+                        help='if this month\'s files are not published yet, keep checking for this many hours')
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='RUN_DIR',
+                        help='profile each stage with cProfile and tracemalloc, writing to RUN_DIR '
+                             '(default profiles/<timestamp>). stages restored from the stage cache are not run '
+                             'and so are not profiled')
+    parser.add_argument('--profile-fragments', type=int, default=5,
+                        help='number of fragments of each file sent through the profiler')
+    parser.add_argument('--archive-bucket',
+                        help='after loading, upload the month\'s raw zips and any parquet partitions to this bucket')
+    parser.add_argument('--lookup-dir',
+                        help='after loading, build the month\'s SIREN/SIRET lookup snapshot in this directory from the '
+                             'parquet sink, a running lookup service picks it up')
+    args = parser.parse_args()
+    if args.profile is not None:
+        enable_profiling(args.profile or None, fragment_sample=args.profile_fragments)
+    sink = create_sink(args.sink, full_refresh=args.full_refresh)
+    if args.lookup_dir and lake_root(sink) is None:
+        parser.error('--lookup-dir builds the lookup snapshot from a parquet sink, add parquet:<directory> to --sink')
+
+    # the load report, None if the file was unchanged, False if it failed
+    etab_result = False
     try:
-        run_etab()
+        etab_result = run_etab(sink=sink, pipelined=args.pipelined, force=args.force or args.full_refresh,
+                               wait_seconds=args.wait_hours * 3600)
         pipeline_messenger(
             title='Sirene Data Transfer (Etab) Notification',
             text='Etab Pipeline has finished running',
@@ -24,8 +65,10 @@ if __name__ == '__main__':
             notification_type='fail'
         )
 
+    legal_result = False
     try:
-        run_legal()
+        legal_result = run_legal(sink=sink, pipelined=args.pipelined, force=args.force or args.full_refresh,
+                                 wait_seconds=args.wait_hours * 3600)
         pipeline_messenger(
             title='French Companies Data Transfer',
             text='Etab Pipeline has finished running',
@@ -40,3 +83,43 @@ if __name__ == '__main__':
             notification_type='fail'
         )
 
+    # the snapshots are taken at clean time, the mapping is only loaded for a month both loads reached
+    if etab_result is False or legal_result is False:
+        pipeline_messenger(
+            title='Sirene Head Office Notification',
+            text='head offices not resolved, the etab or legal load failed',
+            notification_type='notification'
+        )
+    else:
+        try:
+            head_office_report = run_head_office(sink, datetime.datetime.now().strftime('%Y-%m'),
+                                                 force=args.force or args.full_refresh)
+            if head_office_report:
+                pipeline_messenger(
+                    title='Sirene Head Office Notification',
+                    text=describe_report(head_office_report),
+                    notification_type='pass'
+                )
+        except Exception as e:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            traceback_str = traceback.format_exception(exc_type, exc_value, exc_traceback)
+            pipeline_messenger(
+                title='Sirene Head Office Notification',
+                text=str(traceback_str),
+                notification_type='fail'
+            )
+
+    sink.close()
+
+    if args.archive_bucket:
+        archive_summary = archive_month(datetime.datetime.now().strftime('%Y-%m'), args.archive_bucket,
+                                        lake_root=lake_root(sink))
+        if archive_summary['failures']:
+            pipeline_messenger(
+                title='Sirene Archive Notification',
+                text=describe_failures(archive_summary),
+                notification_type='fail'
+            )
+
+    if args.lookup_dir and (etab_result or legal_result):
+        build_from_lake(datetime.datetime.now().strftime('%Y-%m'), lake_root(sink), args.lookup_dir)
@@ -0,0 +1,196 @@
+"""
+memory budget for the cleaning stages
+
+the budget is sirene_memory_budget_mb if set, otherwise the container's cgroup memory limit. when the file to
+clean would not fit in the budget the cleaners read it in chunks with pl.read_csv_batched and append each cleaned
+chunk to the output, and whatever has to be kept until the end of the file (the live keys) goes through a
+SpillBuffer that moves it to parquet files in a temporary directory once RSS nears the budget.
+
+stages decorated with @guarded(name) sample RSS in a background thread, their peak is logged and kept in
+stage_peaks, and a notification is sent when RSS gets close to the budget so an OOM kill does not go unexplained
+"""
+import functools
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import polars as pl
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+spill_fraction = 0.7
+alert_fraction = 0.9
+# in-memory size of a cleaned frame relative to its csv on disk, measured on the stock files
+csv_expansion = 3.0
+chunk_rows = int(os.environ.get('sirene_chunk_rows', 500000))
+stage_peaks = {}
+
+
+def read_rss() -> int:
+    """
+    :return: resident set size of this process in bytes
+    """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def cgroup_memory_limit():
+    """
+    :return: the container's memory limit in bytes, None if it has none
+    """
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        if os.path.exists(path):
+            with open(path) as f:
+                value = f.read().strip()
+            # cgroup v1 reports an unlimited group as a huge number
+            if value != 'max' and int(value) < 1 << 60:
+                return int(value)
+    return None
+
+
+def memory_budget():
+    """
+    :return: memory budget in bytes, None when unbounded
+    """
+    if os.environ.get('sirene_memory_budget_mb'):
+        return int(float(os.environ['sirene_memory_budget_mb']) * 1024 * 1024)
+    return cgroup_memory_limit()
+
+
+def near_budget(fraction: float = spill_fraction) -> bool:
+    budget = memory_budget()
+    return budget is not None and read_rss() >= fraction * budget
+
+
+def fits_in_memory(path: str) -> bool:
+    """
+    whether a csv can be cleaned in one piece within the budget
+    :param path:
+    :return:
+    """
+    budget = memory_budget()
+    if budget is None:
+        return True
+    expected = read_rss() + os.path.getsize(path) * csv_expansion
+    return expected < spill_fraction * budget
+
+
+def read_csv_chunks(filename: str, read_options: dict, infer_rows: int = 10000):
+    """
+    read a csv in frames of about chunk_rows rows. the schema is inferred once from the first rows and passed
+    in full, read_csv_batched only keeps the columns named in a partial dtypes mapping
+    :param filename:
+    :param read_options: keyword arguments for pl.read_csv
+    :param infer_rows: rows read to infer the schema
+    :return:
+    """
+    schema = pl.read_csv(filename, n_rows=infer_rows, **read_options).schema
+    reader = pl.read_csv_batched(filename, batch_size=chunk_rows, **{**read_options, 'dtypes': schema})
+    while batches := reader.next_batches(1):
+        yield batches[0]
+
+
+class SpillBuffer:
+    """
+    collects frames in memory and moves them to parquet files on disk when RSS nears the budget
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.frames = []
+        self.spill_dir = None
+        self.spilled_files = []
+
+    def append(self, pldf: pl.DataFrame) -> None:
+        self.frames.append(pldf)
+        if near_budget():
+            self.spill()
+
+    def spill(self) -> None:
+        if not self.frames:
+            return
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix=f'{self.name}_spill_', dir='.')
+        path = os.path.join(self.spill_dir, f'{len(self.spilled_files):05d}.parquet')
+        pl.concat(self.frames).write_parquet(path)
+        self.spilled_files.append(path)
+        self.frames = []
+        logger.info(f'{self.name}: spilled to {path}, RSS {read_rss() / 1e6:.0f} MB')
+
+    def collect(self, unique: bool = False) -> pl.DataFrame:
+        """
+        :param unique: drop duplicate rows, done by the streaming engine when data has been spilled
+        :return: every appended frame
+        """
+        lazy_frames = [pl.scan_parquet(path) for path in self.spilled_files] + [pldf.lazy() for pldf in self.frames]
+        lazy_pldf = pl.concat(lazy_frames)
+        if unique:
+            lazy_pldf = lazy_pldf.unique()
+        return lazy_pldf.collect(streaming=bool(self.spilled_files))
+
+    def close(self) -> None:
+        self.frames = []
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+
+def guarded(stage: str, interval: float = 0.5):
+    """
+    decorator sampling RSS while a stage runs, recording its peak and alerting when it nears the budget
+    :param stage:
+    :param interval: seconds between samples
+    :return:
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            budget = memory_budget()
+            stop = threading.Event()
+            sample = {'peak': read_rss(), 'alerted': False}
+
+            def watch():
+                while not stop.wait(interval):
+                    rss = read_rss()
+                    sample['peak'] = max(sample['peak'], rss)
+                    if budget and not sample['alerted'] and rss > alert_fraction * budget:
+                        sample['alerted'] = True
+                        logger.warning(f'{stage}: RSS {rss / 1e6:.0f} MB is over {alert_fraction:.0%} '
+                                       f'of the {budget / 1e6:.0f} MB budget')
+                        from utils import pipeline_messenger, dispatcher
+                        pipeline_messenger(title=f'Sirene pipeline memory warning ({stage})',
+                                           text=f'RSS {rss / 1e6:.0f} MB of a {budget / 1e6:.0f} MB budget, '
+                                                f'the process may be killed',
+                                           notification_type='notification')
+                        dispatcher.flush(timeout=10)
+
+            watcher = threading.Thread(target=watch, daemon=True)
+            watcher.start()
+            t0 = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stop.set()
+                watcher.join()
+                peak = max(sample['peak'], read_rss())
+                stage_peaks[stage] = max(stage_peaks.get(stage, 0), peak)
+                budget_text = f' of {budget / 1e6:.0f} MB budget' if budget else ''
+                logger.info(f'{stage}: peak RSS {peak / 1e6:.0f} MB{budget_text} in {round(time.time() - t0)} seconds')
+        return wrapper
+    return decorator
+
+
+def describe_peaks() -> str:
+    """
+    one line summary of the peak RSS of each stage, for the pipeline notifications
+    :return:
+    """
+    return ', '.join(f'{stage} {peak / 1e6:.0f} MB' for stage, peak in stage_peaks.items())
@@ -0,0 +1,144 @@
+"""
+per-stage cProfile and tracemalloc profiling, switched on with main.py --profile
+
+stages decorated with @profiled(name) run as normal unless profiling has been enabled, then each call writes
+to the run directory:
+    <stage>_<n>.pstats              load with pstats or snakeviz
+    <stage>_<n>.collapsed           collapsed stacks, input for flamegraph.pl or speedscope
+    <stage>_<n>_allocations.txt     top allocation sites and peak traced memory
+and a line in summary.jsonl with the wall time and peak memory of the call.
+per-fragment stages are only profiled for the first few fragments, the rest run unprofiled
+"""
+import cProfile
+import functools
+import json
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+profile_settings = {'run_dir': None, 'fragment_sample': 5}
+call_counts = {}
+active_stage = []
+
+
+def enable_profiling(run_dir: str = None, fragment_sample: int = 5) -> str:
+    """
+    :param run_dir: defaults to profiles/<timestamp>
+    :param fragment_sample: number of calls profiled for per-fragment stages
+    :return: the run directory
+    """
+    run_dir = run_dir or os.path.join('profiles', time.strftime('%Y%m%d_%H%M%S'))
+    os.makedirs(run_dir, exist_ok=True)
+    profile_settings['run_dir'] = run_dir
+    profile_settings['fragment_sample'] = fragment_sample
+    call_counts.clear()
+    logger.info(f'profiling enabled, writing to {run_dir}')
+    return run_dir
+
+
+def profiling_enabled() -> bool:
+    return profile_settings['run_dir'] is not None
+
+
+def collapsed_stacks(stats: pstats.Stats, max_depth: int = 64) -> list:
+    """
+    rebuild approximate call stacks from the caller/callee edges of a profile. the time of a function is
+    split between its callers in proportion to the cumulative time each caller spent in it
+    :param stats:
+    :param max_depth:
+    :return: lines of 'frame;frame;frame microseconds'
+    """
+    def label(func):
+        filename, line, name = func
+        return f'{name} ({os.path.basename(filename)}:{line})' if line else name
+
+    callees = {}
+    for func, (_, _, _, cumulative_time, callers) in stats.stats.items():
+        for caller, (_, _, _, edge_cumulative_time) in callers.items():
+            callees.setdefault(caller, []).append((func, edge_cumulative_time))
+
+    lines = {}
+
+    def walk(func, stack, share):
+        _, _, own_time, cumulative_time, _ = stats.stats[func]
+        stack = stack + [label(func)]
+        micros = round(own_time * share * 1e6)
+        if micros:
+            key = ';'.join(stack)
+            lines[key] = lines.get(key, 0) + micros
+        if len(stack) >= max_depth or not cumulative_time:
+            return
+        for callee, edge_cumulative_time in callees.get(func, []):
+            if label(callee) in stack:
+                continue
+            callee_cumulative_time = stats.stats[callee][3]
+            if callee_cumulative_time:
+                walk(callee, stack, share * edge_cumulative_time / callee_cumulative_time)
+
+    roots = [func for func, values in stats.stats.items() if not values[4]]
+    for root in roots:
+        walk(root, [], 1.0)
+    return [f'{stack} {micros}' for stack, micros in lines.items()]
+
+
+def write_profile(stage: str, call_number: int, profiler: cProfile.Profile, snapshot: tracemalloc.Snapshot,
+                  wall_time: float, peak_memory: int) -> None:
+    run_dir = profile_settings['run_dir']
+    prefix = os.path.join(run_dir, f'{stage}_{call_number}')
+    profiler.dump_stats(f'{prefix}.pstats')
+
+    stats = pstats.Stats(profiler)
+    with open(f'{prefix}.collapsed', 'w') as f:
+        f.write('\n'.join(collapsed_stacks(stats)) + '\n')
+
+    top_allocations = snapshot.statistics('lineno')[:25]
+    with open(f'{prefix}_allocations.txt', 'w') as f:
+        f.write(f'peak traced memory: {peak_memory / 1e6:.1f} MB\n')
+        for allocation in top_allocations:
+            f.write(f'{allocation}\n')
+
+    with open(os.path.join(run_dir, 'summary.jsonl'), 'a') as f:
+        f.write(json.dumps({'stage': stage, 'call': call_number, 'wall_time': round(wall_time, 3),
+                            'peak_memory_mb': round(peak_memory / 1e6, 1)}) + '\n')
+    logger.info(f'profiled {stage} call {call_number}: {round(wall_time, 2)} seconds, '
+                f'peak {peak_memory / 1e6:.1f} MB, written to {prefix}.*')
+
+
+def profiled(stage: str, per_fragment: bool = False):
+    """
+    decorator running a stage under cProfile and tracemalloc when profiling is enabled
+    :param stage: name used for the output files
+    :param per_fragment: only profile the first fragment_sample calls
+    :return:
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if profile_settings['run_dir'] is None or active_stage:
+                return func(*args, **kwargs)
+            call_number = call_counts.get(stage, 0) + 1
+            call_counts[stage] = call_number
+            if per_fragment and call_number > profile_settings['fragment_sample']:
+                return func(*args, **kwargs)
+
+            active_stage.append(stage)
+            profiler = cProfile.Profile()
+            tracemalloc.start(25)
+            t0 = time.time()
+            try:
+                return profiler.runcall(func, *args, **kwargs)
+            finally:
+                wall_time = time.time() - t0
+                snapshot = tracemalloc.take_snapshot()
+                _, peak_memory = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                active_stage.pop()
+                write_profile(stage, call_number, profiler, snapshot, wall_time, peak_memory)
+        return wrapper
+    return decorator
@@ -0,0 +1,189 @@
+"""
+data quality profile of each monthly stock file, taken while it is cleaned
+
+the cleaners filter rows through a list of named rules and apply_filter_rules computes, in the same select, the
+rows each rule drops (in order, a row is counted against the first rule it fails) and the null count, [ND]
+count and a distinct count sketch of every source column. in chunked and pipelined mode every frame adds to
+the same QualityProfile, the distinct counts are k minimum values sketches of the column hashes, exact below
+sketch_size distinct values and within a few percent above.
+
+the cleaner writes the profile to quality/<kind>_profile.json as one of its stage outputs, record_profile then
+keeps it as quality_reports/<kind>/<month>.json and flags drift from the previous month's report: row counts,
+null and [ND] rates, drop rates and distinct counts moving by more than the thresholds below
+"""
+import json
+import logging
+import os
+
+import numpy as np
+import polars as pl
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+profile_dir = 'quality'
+# absolute so backfill workers running in their own month directories share the reports
+report_root = os.path.abspath(os.environ.get('sirene_quality_dir', 'quality_reports'))
+sketch_size = 1024
+# drift thresholds, rates are compared in percentage points and counts relative to the previous month
+rows_drift = 0.1
+rate_drift = 0.05
+distinct_drift = 0.5
+
+
+def profile_path(kind: str) -> str:
+    return os.path.join(profile_dir, f'{kind}_profile.json')
+
+
+def report_path(kind: str, month: str) -> str:
+    return os.path.join(report_root, kind, f'{month}.json')
+
+
+class QualityProfile:
+    """
+    null, [ND] and distinct counts per column and dropped rows per rule, accumulated over the frames of a file
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.rows_in = 0
+        self.rows_out = 0
+        self.drops = {}
+        self.nulls = {}
+        self.not_disclosed = {}
+        self.sketches = {}
+
+    def add(self, stats: dict, rule_names: list, columns: list) -> None:
+        """
+        :param stats: the row of the profiling select over one frame
+        :param rule_names:
+        :param columns:
+        :return:
+        """
+        self.rows_in += stats['_rows_in']
+        self.rows_out += stats['_rows_out']
+        for name in rule_names:
+            self.drops[name] = self.drops.get(name, 0) + stats[f'_drop_{name}']
+        for column in columns:
+            self.nulls[column] = self.nulls.get(column, 0) + stats[f'_null_{column}']
+            self.not_disclosed[column] = self.not_disclosed.get(column, 0) + (stats.get(f'_nd_{column}') or 0)
+            sketch = np.array(stats[f'_sketch_{column}'] or [], dtype=np.uint64)
+            if column in self.sketches:
+                sketch = np.union1d(self.sketches[column], sketch)[:sketch_size]
+            self.sketches[column] = sketch
+
+    def distinct(self, column: str) -> int:
+        sketch = self.sketches[column]
+        if len(sketch) < sketch_size:
+            return len(sketch)
+        # the k-th smallest of n uniform hashes sits near k / n of the hash range
+        return int((sketch_size - 1) / (float(sketch[sketch_size - 1]) / 2 ** 64))
+
+    def report(self) -> dict:
+        rows = max(self.rows_in, 1)
+        return {'kind': self.kind,
+                'rows_in': self.rows_in,
+                'rows_out': self.rows_out,
+                'drops': self.drops,
+                'columns': {column: {'null_rate': round(self.nulls[column] / rows, 4),
+                                     'nd_rate': round(self.not_disclosed[column] / rows, 4),
+                                     'distinct': self.distinct(column)}
+                            for column in self.nulls}}
+
+    def write(self) -> str:
+        os.makedirs(profile_dir, exist_ok=True)
+        with open(profile_path(self.kind), 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        logger.info(f'{self.kind} quality profile: {self.rows_in} rows in, {self.rows_out} out, drops {self.drops}')
+        return profile_path(self.kind)
+
+
+def apply_filter_rules(pldf: pl.DataFrame, rules: list, profile: QualityProfile = None) -> pl.DataFrame:
+    """
+    keep the rows passing every rule, profiling the frame in the same select when a profile is given
+    :param pldf: renamed source rows
+    :param rules: (name, expression) pairs, a row is kept when every expression is true
+    :param profile:
+    :return: the rows kept
+    """
+    keep = pl.lit(True)
+    drop_exprs = []
+    for name, rule in rules:
+        passed = rule.fill_null(False)
+        drop_exprs.append((keep & ~passed).sum().alias(f'_drop_{name}'))
+        keep = keep & passed
+    if profile is not None:
+        column_exprs = []
+        for column, dtype in pldf.schema.items():
+            column_exprs.append(pl.col(column).null_count().alias(f'_null_{column}'))
+            if dtype == pl.Utf8:
+                column_exprs.append((pl.col(column) == '[ND]').sum().alias(f'_nd_{column}'))
+            column_exprs.append(pl.col(column).drop_nulls().hash().unique().sort().head(sketch_size).implode()
+                                .alias(f'_sketch_{column}'))
+        stats = pldf.select([pl.count().alias('_rows_in'), keep.sum().alias('_rows_out')] + drop_exprs +
+                            column_exprs).row(0, named=True)
+        profile.add(stats, [name for name, _ in rules], pldf.columns)
+    return pldf.filter(keep)
+
+
+def drift_flags(report: dict, previous: dict) -> list:
+    """
+    :param report: this month's profile
+    :param previous: the previous month's profile
+    :return: a description of every measure that moved by more than its threshold
+    """
+    flags = []
+    if previous['rows_in'] and abs(report['rows_in'] / previous['rows_in'] - 1) > rows_drift:
+        flags.append(f'rows in {previous["rows_in"]} -> {report["rows_in"]}')
+    for name, dropped in report['drops'].items():
+        rate = dropped / max(report['rows_in'], 1)
+        previous_rate = previous['drops'].get(name, 0) / max(previous['rows_in'], 1)
+        if abs(rate - previous_rate) > rate_drift:
+            flags.append(f'{name} drop rate {previous_rate:.1%} -> {rate:.1%}')
+    for column, measures in report['columns'].items():
+        if column not in previous['columns']:
+            flags.append(f'{column} is new')
+            continue
+        previous_measures = previous['columns'][column]
+        for measure in ('null_rate', 'nd_rate'):
+            if abs(measures[measure] - previous_measures[measure]) > rate_drift:
+                flags.append(f'{column} {measure} {previous_measures[measure]:.1%} -> {measures[measure]:.1%}')
+        if previous_measures['distinct'] and \
+                abs(measures['distinct'] / previous_measures['distinct'] - 1) > distinct_drift:
+            flags.append(f'{column} distinct {previous_measures["distinct"]} -> {measures["distinct"]}')
+    flags.extend(f'{column} is missing' for column in previous['columns'] if column not in report['columns'])
+    return flags
+
+
+def record_profile(kind: str, month: str):
+    """
+    keep the profile of the month's cleaned file and flag drift from the latest earlier month
+    :param kind: etab or legal
+    :param month: YYYY-MM
+    :return: the report with its drift flags, None if the cleaner left no profile
+    """
+    if not os.path.exists(profile_path(kind)):
+        return None
+    with open(profile_path(kind)) as f:
+        report = json.load(f)
+    directory = os.path.join(report_root, kind)
+    os.makedirs(directory, exist_ok=True)
+    earlier_months = sorted(name[:-len('.json')] for name in os.listdir(directory)
+                            if name.endswith('.json') and name[:-len('.json')] < month)
+    report['month'] = month
+    report['compared_with'] = earlier_months[-1] if earlier_months else None
+    report['drift'] = []
+    if earlier_months:
+        with open(report_path(kind, earlier_months[-1])) as f:
+            report['drift'] = drift_flags(report, json.load(f))
+    with open(report_path(kind, month), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if report['drift']:
+        logger.warning(f'{kind} {month} drifted from {report["compared_with"]}: {"; ".join(report["drift"])}')
+        from utils import pipeline_messenger
+        pipeline_messenger(title=f'Sirene {kind} data quality drift ({month})',
+                           text=f'compared with {report["compared_with"]}: ' + '; '.join(report['drift']),
+                           notification_type='notification')
+    return report
@@ -0,0 +1,920 @@
+"""
+output sinks for the cleaned etab and legal fragments
+
+every sink takes the polars dataframe of a fragment, the MySQL sink upserts into the preprod tables as before,
+the DuckDB sink keeps the stock tables in a local database file, and the Parquet sink writes a partitioned
+columnar lake that analysts can query without going through the OLTP database
+
+a FanOutSink writes every fragment to several sinks at once, e.g. preprod and prod, from a single parse.
+
+a run calls begin(kind, month) once, write_etab/write_legal for each fragment, then finish(kind).
+once both files of a month are cleaned, write_head_offices(pldf, month) replaces the month's head office mapping.
+in work queue mode the coordinator calls begin and finish, and each worker calls join(kind, month, worker_id)
+before writing its share of the fragments and leave(kind) after
+
+the MySQL sink never alters a live table itself: begin fails if a live table lacks a column declared in
+staging_schema, and the columns are added by reviewing and running
+
+    python sinks.py migrate --env-prefix preprod --dry-run
+"""
+import argparse
+import datetime
+import hashlib
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+
+import polars as pl
+
+from address_dimensions import AddressDimensions, decoded_staging
+from company_names import load_company_names, names_path
+from full_refresh import prepare_shadow_table, load_staging_into_shadow, finalise_shadow_table
+from load_metrics import LoadMetrics, session_lock_seconds
+from stale_sync import sync_stale_etab, sync_stale_legal, pending_keys_path
+from staging_schema import (staging_tables, create_staging_table, conform_to_staging, conform_to_schema, column_list,
+                            column_names)
+from utils import connect_mysql, mysql_constring
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+head_office_slice_rows = 500000
+
+
+def current_month() -> str:
+    return datetime.datetime.now().strftime('%Y-%m')
+
+
+def live_columns(kind: str) -> dict:
+    """
+    :param kind: etab or legal
+    :return: live table -> declared column name -> column definition, for the tables a load of kind writes to
+    """
+    tables = {staging_tables[kind]['live_table']: dict(staging_tables[kind]['columns'])}
+    if kind == 'etab':
+        # coordinates converted from Lambert-93 by the cleaner
+        tables['geo_location'] = {'latitude': 'double', 'longitude': 'double'}
+    return tables
+
+
+def missing_columns(cursor, table: str, columns: dict) -> list:
+    """
+    :param cursor:
+    :param table:
+    :param columns: column name -> column definition
+    :return: the columns the table does not have
+    """
+    cursor.execute(
+        """
+        select column_name from information_schema.columns
+        where table_schema = database() and table_name = %s
+        """, (table,)
+    )
+    existing_columns = {row[0].lower() for row in cursor.fetchall()}
+    return [column for column in columns if column.lower() not in existing_columns]
+
+
+def check_live_columns(cursor, kind: str, env_prefix: str) -> None:
+    """
+    raise before loading if a live table lacks a declared column, the columns are added by the migrate command
+    rather than by a load
+    :param cursor:
+    :param kind:
+    :param env_prefix: database, for the command in the error
+    :return:
+    """
+    missing = {table: missing_columns(cursor, table, columns) for table, columns in live_columns(kind).items()}
+    missing = {table: columns for table, columns in missing.items() if columns}
+    if missing:
+        raise RuntimeError(f'live tables are missing declared columns {missing}, review and run '
+                           f'"python sinks.py migrate --env-prefix {env_prefix}" to add them')
+
+
+def migrate_live_tables(cursor, db, dry_run: bool = False) -> dict:
+    """
+    add the declared columns the live tables are missing, at the end of each table
+    :param cursor:
+    :param db:
+    :param dry_run: only log the statements
+    :return: table -> columns added
+    """
+    added = {}
+    for kind in staging_tables:
+        for table, columns in live_columns(kind).items():
+            missing = missing_columns(cursor, table, columns)
+            if not missing:
+                continue
+            add_clauses = ', '.join(f'add column `{column}` {columns[column]}' for column in missing)
+            logger.warning(f'{"would run" if dry_run else "running"}: alter table {table} {add_clauses}')
+            if not dry_run:
+                cursor.execute(f"""alter table {table} {add_clauses}""")
+                db.commit()
+            added[table] = missing
+    if not added:
+        logger.info('live tables have every declared column')
+    return added
+
+
+class Sink:
+    """
+    base class for fragment sinks
+    """
+    name = 'sink'
+    # set by FanOutSink when other sinks of the run still need this month's pending keys after this one's finish
+    shares_pending_keys = False
+
+    def begin(self, kind: str, month: str) -> None:
+        """
+        called once before the fragments of a file are written
+        :param kind: etab or legal
+        :param month: YYYY-MM of the stock file
+        :return:
+        """
+
+    def join(self, kind: str, month: str, worker_id: str) -> None:
+        """
+        called by a queue worker before it writes fragments of a file the coordinator has begun,
+        sinks whose begin only sets up per-process state can simply begin
+        :param kind:
+        :param month:
+        :param worker_id: unique across the workers of a run
+        :return:
+        """
+        self.begin(kind, month)
+
+    def leave(self, kind: str) -> None:
+        """
+        called by a queue worker once it has no more fragments of the file to write,
+        the whole-file steps are left to the coordinator's finish
+        :param kind:
+        :return:
+        """
+
+    def write_etab(self, pldf: pl.DataFrame) -> None:
+        raise NotImplementedError
+
+    def write_legal(self, pldf: pl.DataFrame) -> None:
+        raise NotImplementedError
+
+    def write_head_offices(self, pldf: pl.DataFrame, month: str) -> None:
+        """
+        replace the head office mapping with the month's, see head_office.py
+        :param pldf: one row per legal unit
+        :param month: YYYY-MM
+        :return:
+        """
+        raise NotImplementedError
+
+    def lock_wait_seconds(self) -> float:
+        """
+        cumulative time writes have spent waiting on row locks, sinks without locking report 0
+        :return:
+        """
+        return 0.0
+
+    def write_times(self, wait: bool = False):
+        """
+        rows, seconds and lock wait of each batch written in the background since the last call. sinks whose writes
+        are done when write_etab/write_legal return give None, the caller times them
+        :param wait: wait for the batches still queued
+        :return: list of (rows, seconds, lock_wait_seconds), or None
+        """
+        return None
+
+    def finish(self, kind: str) -> None:
+        """
+        called once after every fragment of a file has been written
+        :param kind:
+        :return:
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class MySQLSink(Sink):
+    """
+    writes each fragment to its staging table and upserts into the live preprod tables
+    """
+    name = 'mysql'
+
+    def __init__(self, full_refresh: bool = False, env_prefix: str = 'preprod'):
+        """
+        :param full_refresh: rebuild the stock tables in shadow tables and swap them in
+        :param env_prefix: database whose <env_prefix>_host etc. variables to connect with, e.g. preprod or prod
+        """
+        self.name = f'mysql:{env_prefix}'
+        self.env_prefix = env_prefix
+        # preprod keeps the original key snapshot names
+        self.key_target = None if env_prefix == 'preprod' else env_prefix
+        self.cursor, self.db = connect_mysql(env_prefix)
+        self.constring = mysql_constring(env_prefix)
+        self.full_refresh = full_refresh
+        self.refresh_states = {}
+        self.metrics = {}
+        self.staging_tables = {kind: staging['table'] for kind, staging in staging_tables.items()}
+        self.dimensions = None
+
+    def begin(self, kind: str, month: str) -> None:
+        self.metrics[kind] = LoadMetrics(self.cursor, self.db, kind, month)
+        # staging is created once per run from its declared schema, then appended to and truncated per fragment
+        check_live_columns(self.cursor, kind, self.env_prefix)
+        create_staging_table(self.cursor, self.db, kind, self.staging_tables[kind])
+        if kind == 'etab':
+            # address labels are staged as dimension ids, the file's labels are loaded once here
+            self.dimensions = AddressDimensions(self.cursor, self.db, self.metrics[kind])
+            self.dimensions.preload()
+        # in full refresh mode the stock table is rebuilt in a shadow table and swapped in by finish
+        if self.full_refresh:
+            live_table = 'sirene_stocketab' if kind == 'etab' else 'sirene_stocklegal'
+            self.refresh_states[kind] = prepare_shadow_table(self.cursor, self.db, live_table)
+
+    def write_etab(self, pldf: pl.DataFrame) -> None:
+        self.metrics['etab'].next_fragment()
+        staging = self.staging_tables['etab']
+        # the staging rows carry dimension ids, statements read the labels back through the decoded staging
+        decoded = decoded_staging(staging)
+        pldf = self.dimensions.encode(pldf)
+        # write to staging table
+        t0 = time.time()
+        conform_to_staging(pldf, 'etab').write_database(table_name=staging,
+                                                        connection_uri=self.constring, if_exists='append')
+        t1 = time.time()
+        self.metrics['etab'].record('staging_write', t1 - t0, len(pldf))
+        logger.info('Sending etab file to staging in {:.2f} seconds'.format(t1 - t0))
+
+        #  upsert to geolocation here # todo include filepath in last_modified_by
+        t0 = time.time()
+        self.metrics['etab'].execute('geo_location_upsert', f"""
+        insert ignore into geo_location (
+        address_1,
+        address_2,
+        town,
+        country,
+        post_code,
+        address_type,
+        organisation_id,
+        post_code_formatted,
+        md5_key,
+        latitude,
+        longitude,
+        date_last_modified,
+        last_modified_by)
+
+        select
+         address_line_1 as address_1,
+         address_line_2 as address_2,
+         AddressMunicipalityLabel as town,
+         'France' as country,
+         AddressPostcode as post_code,
+         registered_office_type as address_type,
+         id as organisation_id,
+         AddressPostcode as post_code_formatted,
+         geo_md5 as md5_key,
+         latitude,
+         longitude,
+         curdate() as date_last_modified,
+         'sirene_etab insert' as last_modified_by
+         from {decoded} staged
+
+         on duplicate key update
+        address_1 = address_line_1,
+        address_2 = address_line_2,
+        town = AddressMunicipalityLabel,
+        post_code = AddressPostcode,
+        address_type = registered_office_type,
+        post_code_formatted = AddressPostcode,
+        latitude = staged.latitude,
+        longitude = staged.longitude,
+        date_last_modified = CURDATE(),
+        last_modified_by = 'sirene_etab update'
+        """)
+        t1 = time.time()
+        logger.info('time taken for upsert to geo_location: {}'.format(round(t1 - t0)))
+
+        # upsert into larger stock etab table for debugging when needed, similar to rchis
+        t0 = time.time()
+        if 'etab' in self.refresh_states:
+            loaded_rows = load_staging_into_shadow(self.cursor, self.db, self.refresh_states['etab'],
+                                                   f'{decoded} staged', column_list('etab'))
+            self.metrics['etab'].record('shadow_load', time.time() - t0, loaded_rows)
+            self.metrics['etab'].execute('truncate_staging', f"""truncate table {staging}""")
+            t1 = time.time()
+            logger.info('time taken for load into shadow etab table: {}'.format(round(t1 - t0)))
+            return
+
+        self.metrics['etab'].execute(
+            'stocketab_upsert',
+            f"""
+        insert into sirene_stocketab ({column_list('etab')})
+        select {column_list('etab', 't2.')} from {decoded} t2
+        on duplicate key update
+        sirene_stocketab.company_number = t2.company_number,
+        sirene_stocketab.localnic = t2.localnic,
+        sirene_stocketab.siret = t2.siret,
+        sirene_stocketab.distributionStatus = t2.distributionStatus,
+        sirene_stocketab.EstablishmentDate = t2.EstablishmentDate,
+        sirene_stocketab.EmployeeCountCategory = t2.EmployeeCountCategory,
+        sirene_stocketab.EmployeeCountCategoryYear = t2.EmployeeCountCategoryYear,
+        sirene_stocketab.mainNAF = t2.mainNAF,
+        sirene_stocketab.LastNAFUpdate = t2.LastNAFUpdate,
+        sirene_stocketab.RegisteredOfficeBool = t2.RegisteredOfficeBool,
+        sirene_stocketab.PeriodNumber = t2.PeriodNumber,
+        sirene_stocketab.AddressBuildingBlock = t2.AddressBuildingBlock,
+        sirene_stocketab.AddressNumber = t2.AddressNumber,
+        sirene_stocketab.AddressNumberSubUnit = t2.AddressNumberSubUnit,
+        sirene_stocketab.AddressUniqueIdentifier = t2.AddressUniqueIdentifier,
+        sirene_stocketab.AddressLabel = t2.AddressLabel,
+        sirene_stocketab.AddressPostcode = t2.AddressPostcode,
+        sirene_stocketab.AddressMunicipalityLabel = t2.AddressMunicipalityLabel,
+        sirene_stocketab.AddressForeignMunicipality = t2.AddressForeignMunicipality,
+        sirene_stocketab.AddressPOBox = t2.AddressPOBox,
+        sirene_stocketab.AddressCommuneCode = t2.AddressCommuneCode,
+        sirene_stocketab.AddressCEDEXCode = t2.AddressCEDEXCode,
+        sirene_stocketab.AddressCEDEXLabel = t2.AddressCEDEXLabel,
+        sirene_stocketab.AddressOverseasCountryCode = t2.AddressOverseasCountryCode,
+        sirene_stocketab.AddressOverseasCountryLabel = t2.AddressOverseasCountryLabel,
+        sirene_stocketab.AddressBuildingBlock2 = t2.AddressBuildingBlock2,
+        sirene_stocketab.AddressNumber2 = t2.AddressNumber2,
+        sirene_stocketab.AddressNumberSubUnit2 = t2.AddressNumberSubUnit2,
+        sirene_stocketab.AddressUniqueIdentifier2 = t2.AddressUniqueIdentifier2,
+        sirene_stocketab.AddressLabel2 = t2.AddressLabel2,
+        sirene_stocketab.AddressPostcode2 = t2.AddressPostcode2,
+        sirene_stocketab.AddressMunicipalityLabel2 = t2.AddressMunicipalityLabel2,
+        sirene_stocketab.AddressForeignMunicipality2 = t2.AddressForeignMunicipality2,
+        sirene_stocketab.AddressPOBox2 = t2.AddressPOBox2,
+        sirene_stocketab.AddressCommuneCode2 = t2.AddressCommuneCode2,
+        sirene_stocketab.AddressCEDEXCode2 = t2.AddressCEDEXCode2,
+        sirene_stocketab.AddressCEDEXLabel2 = t2.AddressCEDEXLabel2,
+        sirene_stocketab.AddressOverseasCountryCode2 = t2.AddressOverseasCountryCode2,
+        sirene_stocketab.AddressOverseasCountryLabel2 = t2.AddressOverseasCountryLabel2,
+        sirene_stocketab.DateOfBusinessStart = t2.DateOfBusinessStart,
+        sirene_stocketab.AdministrativeStatus = t2.AdministrativeStatus,
+        sirene_stocketab.EstablishmentSign1 = t2.EstablishmentSign1,
+        sirene_stocketab.EstablishmentSign2 = t2.EstablishmentSign2,
+        sirene_stocketab.EstablishmentSign3 = t2.EstablishmentSign3,
+        sirene_stocketab.CommonCompanyName = t2.CommonCompanyName,
+        sirene_stocketab.APETCode = t2.APETCode,
+        sirene_stocketab.APETCodeCategory = t2.APETCodeCategory,
+        sirene_stocketab.EmploymentType = t2.EmploymentType,
+        sirene_stocketab.latitude = t2.latitude,
+        sirene_stocketab.longitude = t2.longitude,
+        sirene_stocketab.geo_md5 = t2.geo_md5,
+        sirene_stocketab.last_modified_date = t2.last_modified_date,
+        sirene_stocketab.last_modified_by = t2.last_modified_by
+
+            """
+        )
+        self.metrics['etab'].execute('truncate_staging', f"""truncate table {staging}""")
+        t1 = time.time()
+        logger.info('time taken for upsert to live etab table: {}'.format(round(t1 - t0)))
+
+    def write_legal(self, pldf: pl.DataFrame) -> None:
+        self.metrics['legal'].next_fragment()
+        staging = self.staging_tables['legal']
+        # sending polars dataframe to staging table
+        t0 = time.time()
+        conform_to_staging(pldf, 'legal').write_database(table_name=staging,
+                                                         connection_uri=self.constring, if_exists='append')
+        t1 = time.time()
+        self.metrics['legal'].record('staging_write', t1 - t0, len(pldf))
+
+        logger.info('time taken to write stock legal into staging: {}'.format(round(t1 - t0)))
+        # upsert into organisation
+        self.metrics['legal'].execute(
+            'organisation_upsert',
+            f"""
+            insert into organisation (
+        id,
+        company_number,
+        company_name,
+        company_status,
+        country,
+        date_formed,
+        company_type,
+        last_modified_by,
+        last_modified_date,
+        country_code)
+
+        select
+        id,
+        company_number,
+        LegalEntityName,
+        company_status,
+        country,
+        DateCreated,
+        company_type,
+        last_modified_by,
+        last_modified_date,
+        'FR' as country_code
+        from {staging}
+
+        on duplicate key update
+        company_name = LegalEntityName,
+        organisation.company_status = {staging}.company_status,
+        organisation.company_type = {staging}.company_type,
+        organisation.last_modified_by = {staging}.last_modified_by,
+        organisation.last_modified_date = {staging}.last_modified_date"""
+        )
+        t0 = time.time()
+
+        # insert naf code data into NAF code
+        self.metrics['legal'].execute(
+            'naf_code_upsert',
+            f"""
+            insert into naf_code (code, organisation_id, name_en, name_fr, last_modified_date, last_modified_by)
+
+            select  NAFCategory, id, t2.name_en, t2.name_fr, last_modified_date, last_modified_by
+            from {staging} t1
+            inner join naf_codes_translations t2
+            on t1.NAFCategory = t2.code
+
+            on duplicate key update last_modified_date = curdate(), last_modified_by = 'stock legal pipeline update'
+            """
+        )
+
+        t1 = time.time()
+        logger.info('time taken to insert NAF codes into staging: {}'.format(round(t1 - t0)))
+
+        # upsert staging table into main stock_legal table
+        t0 = time.time()
+        if 'legal' in self.refresh_states:
+            loaded_rows = load_staging_into_shadow(self.cursor, self.db, self.refresh_states['legal'],
+                                                   staging, column_list('legal'))
+            self.metrics['legal'].record('shadow_load', time.time() - t0, loaded_rows)
+            self.metrics['legal'].execute('truncate_staging', f"""truncate table {staging}""")
+            t1 = time.time()
+            logger.info('time taken to load into shadow legal table: {}'.format(round(t1 - t0)))
+            return
+
+        self.metrics['legal'].execute(
+            'stocklegal_upsert',
+            f"""
+            insert into sirene_stocklegal ({column_list('legal')})
+            select {column_list('legal', 't2.')} from {staging} t2
+            on duplicate key update
+        sirene_stocklegal.company_number = t2.company_number,
+        sirene_stocklegal.LegalUnitBroadcastID = t2.LegalUnitBroadcastID,
+        sirene_stocklegal.PurgeStatus = t2.PurgeStatus,
+        sirene_stocklegal.DateCreated = t2.DateCreated,
+        sirene_stocklegal.LegalAcronym = t2.LegalAcronym,
+        sirene_stocklegal.GenderOfPerson = t2.GenderOfPerson,
+        sirene_stocklegal.NaturalName1 = t2.NaturalName1,
+        sirene_stocklegal.NaturalName2 = t2.NaturalName2,
+        sirene_stocklegal.NaturalName3 = t2.NaturalName3,
+        sirene_stocklegal.NaturalName4 = t2.NaturalName4,
+        sirene_stocklegal.PreferredName = t2.PreferredName,
+        sirene_stocklegal.pseudonym = t2.pseudonym,
+        sirene_stocklegal.RNANumber = t2.RNANumber,
+        sirene_stocklegal.EmployeeCountCategory = t2.EmployeeCountCategory,
+        sirene_stocklegal.EmployeeCountCategoryDateUpdated = t2.EmployeeCountCategoryDateUpdated,
+        sirene_stocklegal.LegalUnitUpdated = t2.LegalUnitUpdated,
+        sirene_stocklegal.TimeAsLegalUnit = t2.TimeAsLegalUnit,
+        sirene_stocklegal.BusinessCategory = t2.BusinessCategory,
+        sirene_stocklegal.YearOfBusinessCategoryAssignment = t2.YearOfBusinessCategoryAssignment,
+        sirene_stocklegal.DateOfBusinessStart = t2.DateOfBusinessStart,
+        sirene_stocklegal.AdministrativeStatus = t2.AdministrativeStatus,
+        sirene_stocklegal.PersonBirthName = t2.PersonBirthName,
+        sirene_stocklegal.PersonUsedName = t2.PersonUsedName,
+        sirene_stocklegal.LegalEntityName = t2.LegalEntityName,
+        sirene_stocklegal.LegalEntityName1 = t2.LegalEntityName1,
+        sirene_stocklegal.LegalEntityName2 = t2.LegalEntityName2,
+        sirene_stocklegal.LegalEntityName3 = t2.LegalEntityName3,
+        sirene_stocklegal.LegalCategory = t2.LegalCategory,
+        sirene_stocklegal.NAFCategory = t2.NAFCategory,
+        sirene_stocklegal.ActiveLegalUnit = t2.ActiveLegalUnit,
+        sirene_stocklegal.NICAssignment = t2.NICAssignment,
+        sirene_stocklegal.SSEBool = t2.SSEBool,
+        sirene_stocklegal.MissionDrivenCompanyBool = t2.MissionDrivenCompanyBool,
+        sirene_stocklegal.EmployerNature = t2.EmployerNature,
+        sirene_stocklegal.country = t2.country,
+        sirene_stocklegal.country_code = t2.country_code,
+        sirene_stocklegal.last_modified_by = t2.last_modified_by,
+        sirene_stocklegal.last_modified_date = t2.last_modified_date
+            """
+        )
+        self.metrics['legal'].execute('truncate_staging', f"""truncate table {staging}""")
+        t1 = time.time()
+        logger.info('time taken to upsert into live tables: {}'.format(round(t1-t0)))
+
+    def write_head_offices(self, pldf: pl.DataFrame, month: str) -> None:
+        metrics = LoadMetrics(self.cursor, self.db, 'head_office', month)
+        self.cursor.execute(
+            """
+            create table if not exists sirene_head_office (
+            company_number varchar(9) primary key,
+            organisation_id varchar(16),
+            head_office_siret varchar(14),
+            geo_md5 varchar(32),
+            status varchar(32),
+            flagged_siret varchar(14),
+            month varchar(7),
+            key head_office_siret (head_office_siret),
+            key geo_md5 (geo_md5))
+            """
+        )
+        self.cursor.execute("""create table if not exists sirene_head_office_staging like sirene_head_office""")
+        self.cursor.execute("""truncate table sirene_head_office_staging""")
+        self.db.commit()
+
+        # the whole mapping goes through staging in slices, then into the live table in one statement
+        pldf = pldf.with_columns(pl.lit(month).alias('month'))
+        for offset in range(0, len(pldf), head_office_slice_rows):
+            metrics.next_fragment()
+            t0 = time.time()
+            pldf_slice = pldf.slice(offset, head_office_slice_rows)
+            pldf_slice.write_database(table_name='sirene_head_office_staging', connection_uri=self.constring,
+                                      if_exists='append')
+            metrics.record('staging_write', time.time() - t0, len(pldf_slice))
+        columns = ', '.join(pldf.columns)
+        metrics.execute(
+            'head_office_upsert',
+            f"""
+            insert into sirene_head_office ({columns})
+            select {columns} from sirene_head_office_staging
+            on duplicate key update
+            organisation_id = values(organisation_id),
+            head_office_siret = values(head_office_siret),
+            geo_md5 = values(geo_md5),
+            status = values(status),
+            flagged_siret = values(flagged_siret),
+            month = values(month)
+            """
+        )
+        # legal units that have left the file
+        metrics.execute(
+            'head_office_delete',
+            """
+            delete h from sirene_head_office h
+            left join sirene_head_office_staging s on s.company_number = h.company_number
+            where s.company_number is null
+            """
+        )
+        metrics.execute('truncate_staging', """truncate table sirene_head_office_staging""")
+        metrics.flush()
+
+    def join(self, kind: str, month: str, worker_id: str) -> None:
+        # workers load concurrently, so each gets its own staging table. the live tables were
+        # extended by the coordinator's begin, and queue mode does not do full refreshes
+        worker_hash = hashlib.md5(worker_id.encode('utf-8')).hexdigest()[:8]
+        self.staging_tables[kind] = f'{staging_tables[kind]["table"]}_{worker_hash}'
+        self.metrics[kind] = LoadMetrics(self.cursor, self.db, kind, month)
+        create_staging_table(self.cursor, self.db, kind, self.staging_tables[kind])
+        if kind == 'etab':
+            self.dimensions = AddressDimensions(self.cursor, self.db, self.metrics[kind])
+            self.dimensions.preload()
+
+    def leave(self, kind: str) -> None:
+        self.metrics.pop(kind).flush()
+        self.cursor.execute(f"""drop table if exists {self.staging_tables[kind]}""")
+        self.db.commit()
+        self.staging_tables[kind] = staging_tables[kind]['table']
+
+    def lock_wait_seconds(self) -> float:
+        # this connection's waits only, a server wide counter would charge this load with other writers' waits
+        return session_lock_seconds(self.cursor)
+
+    def finish(self, kind: str) -> None:
+        if kind in self.refresh_states:
+            finalise_shadow_table(self.cursor, self.db, self.refresh_states.pop(kind))
+        # remove addresses of closed establishments, flag organisations purged or dropped out of the file
+        if kind == 'etab':
+            sync_stale_etab(self.cursor, self.db, target=self.key_target, keep_pending=self.shares_pending_keys)
+        else:
+            sync_stale_legal(self.cursor, self.db, target=self.key_target, keep_pending=self.shares_pending_keys)
+            # the normalised names and blocking keys written by the legal cleaner, replaced in one swap
+            if os.path.exists(names_path()):
+                load_company_names(self.cursor, self.db, self.constring, self.metrics['legal'])
+        self.metrics.pop(kind).flush()
+
+    def close(self) -> None:
+        self.cursor.close()
+        self.db.close()
+
+
+class DuckDBSink(Sink):
+    """
+    keeps sirene_stocketab and sirene_stocklegal in a local DuckDB file, upserting on siret and company_number.
+    useful as a local stand-in for MySQL in tests and benchmarks
+    """
+    name = 'duckdb'
+    tables = {'etab': ('sirene_stocketab', 'siret'),
+              'legal': ('sirene_stocklegal', 'company_number')}
+
+    def __init__(self, path: str):
+        import duckdb  # optional, only needed for this sink
+        self.name = f'duckdb:{path}'
+        self.path = path
+        self.con = duckdb.connect(path)
+
+    def _upsert(self, kind: str, pldf: pl.DataFrame) -> None:
+        table, key = self.tables[kind]
+        t0 = time.time()
+        pldf = conform_to_schema(pldf, kind)
+        self.con.register('fragment', pldf.to_arrow())
+        self.con.execute(f"""create table if not exists {table} as select * from fragment limit 0""")
+        self.con.execute(f"""delete from {table} where {key} in (select {key} from fragment)""")
+        # by name, a table created by an earlier version may order its columns differently
+        columns = ', '.join(f'"{column}"' for column in column_names(kind))
+        self.con.execute(f"""insert into {table} ({columns}) select {columns} from fragment""")
+        self.con.unregister('fragment')
+        t1 = time.time()
+        logger.info(f'{len(pldf)} rows written to {self.path}:{table} in {round(t1 - t0, 2)} seconds')
+
+    def write_etab(self, pldf: pl.DataFrame) -> None:
+        self._upsert('etab', pldf)
+
+    def write_legal(self, pldf: pl.DataFrame) -> None:
+        self._upsert('legal', pldf)
+
+    def write_head_offices(self, pldf: pl.DataFrame, month: str) -> None:
+        self.con.register('mapping', pldf.with_columns(pl.lit(month).alias('month')).to_arrow())
+        self.con.execute("""create or replace table sirene_head_office as select * from mapping""")
+        self.con.unregister('mapping')
+        logger.info(f'{len(pldf)} head offices written to {self.path}:sirene_head_office')
+
+    def close(self) -> None:
+        self.con.close()
+
+
+class ParquetSink(Sink):
+    """
+    writes a partitioned parquet lake:
+    <root>/sirene_stocketab/month=YYYY-MM/dept=XX/part-NNNNN.parquet
+    <root>/sirene_stocklegal/month=YYYY-MM/legal_category=XX/part-NNNNN.parquet
+    <root>/sirene_head_office/month=YYYY-MM/part-00000.parquet
+    """
+    name = 'parquet'
+    datasets = {'etab': 'sirene_stocketab', 'legal': 'sirene_stocklegal', 'head_office': 'sirene_head_office'}
+
+    def __init__(self, root: str):
+        self.name = f'parquet:{root}'
+        self.root = root
+        self.months = {}
+        self.part_number = 0
+        self.part_prefix = ''
+
+    def month_dir(self, kind: str) -> str:
+        return os.path.join(self.root, self.datasets[kind], f'month={self.months.get(kind, current_month())}')
+
+    def begin(self, kind: str, month: str) -> None:
+        self.months[kind] = month
+        # a re-run of the same month replaces its partition
+        if os.path.exists(self.month_dir(kind)):
+            shutil.rmtree(self.month_dir(kind))
+
+    def join(self, kind: str, month: str, worker_id: str) -> None:
+        # the coordinator's begin has cleared the partition, workers only need part names that do not collide
+        self.months[kind] = month
+        self.part_prefix = hashlib.md5(worker_id.encode('utf-8')).hexdigest()[:8] + '-'
+
+    def _write_partitions(self, kind: str, pldf: pl.DataFrame, partition_name: str, partition_expr: pl.Expr) -> None:
+        t0 = time.time()
+        self.part_number += 1
+        # every part file of the dataset has the declared schema, so the parts can be scanned together
+        pldf = conform_to_schema(pldf, kind).with_columns(partition_expr.alias(partition_name))
+        for partition_value, partition_pldf in pldf.partition_by(partition_name, as_dict=True).items():
+            partition_dir = os.path.join(self.month_dir(kind), f'{partition_name}={partition_value}')
+            os.makedirs(partition_dir, exist_ok=True)
+            part_name = f'part-{self.part_prefix}{self.part_number:05d}.parquet'
+            partition_pldf.drop(partition_name).write_parquet(os.path.join(partition_dir, part_name),
+                                                              compression='zstd')
+        t1 = time.time()
+        logger.info(f'{len(pldf)} rows written to {self.month_dir(kind)} in {round(t1 - t0, 2)} seconds')
+
+    def write_etab(self, pldf: pl.DataFrame) -> None:
+        # partition by departement, the first two digits of the postcode
+        self._write_partitions('etab', pldf, 'dept',
+                               pl.col('AddressPostcode').cast(pl.Utf8).fill_null('').str.slice(0, 2)
+                               .str.rjust(2, '0'))
+
+    def write_legal(self, pldf: pl.DataFrame) -> None:
+        self._write_partitions('legal', pldf, 'legal_category',
+                               pl.col('LegalCategory').cast(pl.Utf8).fill_null('').str.slice(0, 2)
+                               .str.rjust(2, '0'))
+
+    def write_head_offices(self, pldf: pl.DataFrame, month: str) -> None:
+        self.months['head_office'] = month
+        if os.path.exists(self.month_dir('head_office')):
+            shutil.rmtree(self.month_dir('head_office'))
+        os.makedirs(self.month_dir('head_office'))
+        pldf.write_parquet(os.path.join(self.month_dir('head_office'), 'part-00000.parquet'), compression='zstd')
+        logger.info(f'{len(pldf)} head offices written to {self.month_dir("head_office")}')
+
+
+class SinkTarget:
+    """
+    one sink of a FanOutSink, fed from a bounded queue by its own thread. the first error stops the target
+    until the next file begins, the other targets carry on
+    """
+
+    def __init__(self, sink: Sink, max_pending: int):
+        self.sink = sink
+        self.calls = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.progress = {}
+        # (rows, seconds, lock_wait_seconds) of each batch written since the file began
+        self.batches = []
+        self.thread = threading.Thread(target=self.run, daemon=True, name=f'sink-{sink.name}')
+        self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            call = self.calls.get()
+            if call is None:
+                self.calls.task_done()
+                return
+            method, args = call
+            if self.error is None:
+                writing = method in ('write_etab', 'write_legal')
+                try:
+                    # the lock wait counter is read here, the sink's connection is only used by this thread
+                    lock_wait_t0 = self.sink.lock_wait_seconds() if writing else 0.0
+                    t0 = time.time()
+                    getattr(self.sink, method)(*args)
+                    if writing:
+                        seconds = time.time() - t0
+                        lock_wait = self.sink.lock_wait_seconds() - lock_wait_t0
+                        self.batches.append((len(args[0]), seconds, lock_wait))
+                        self.progress['batches'] = self.progress.get('batches', 0) + 1
+                        self.progress['rows'] = self.progress.get('rows', 0) + len(args[0])
+                        self.progress['seconds'] = round(self.progress.get('seconds', 0.0) + seconds, 2)
+                        self.progress['lock_wait'] = self.progress.get('lock_wait', 0.0) + lock_wait
+                except Exception as e:
+                    self.error = e
+                    logger.error(f'{self.sink.name} failed in {method}: {e}, skipping it for the rest of the file')
+            self.calls.task_done()
+
+    def submit(self, method: str, *args) -> None:
+        if self.error is None:
+            self.calls.put((method, args))
+
+    def wait(self) -> None:
+        self.calls.join()
+
+    def stop(self) -> None:
+        self.calls.put(None)
+        self.thread.join()
+
+
+class FanOutSink(Sink):
+    """
+    writes each fragment to several sinks concurrently, so one parse of the stock files loads every database.
+    a slow target falls up to max_pending fragments behind before it holds up the parse, and a failing target
+    is dropped for the rest of the file without stopping the others. finish raises once the healthy targets
+    have finished if any target failed, so the run is reported as failed and the file is loaded again next run
+    """
+    name = 'fanout'
+
+    def __init__(self, sinks: list, max_pending: int = 4):
+        self.name = 'fanout(' + ', '.join(sink.name for sink in sinks) + ')'
+        for sink in sinks:
+            sink.shares_pending_keys = True
+        self.targets = [SinkTarget(sink, max_pending) for sink in sinks]
+        # batches already returned by write_times
+        self.batches_reported = 0
+
+    def _broadcast(self, method: str, *args) -> None:
+        for target in self.targets:
+            target.submit(method, *args)
+
+    def _wait(self) -> None:
+        for target in self.targets:
+            target.wait()
+
+    def describe_progress(self) -> str:
+        return ', '.join(f'{target.sink.name}: {target.progress.get("rows", 0)} rows in '
+                         f'{target.progress.get("seconds", 0.0)}s' + (' (failed)' if target.error else '')
+                         for target in self.targets)
+
+    def _reset(self) -> None:
+        # every file gives each target a fresh start
+        for target in self.targets:
+            target.error = None
+            target.progress = {}
+            target.batches = []
+        self.batches_reported = 0
+
+    def begin(self, kind: str, month: str) -> None:
+        self._reset()
+        self._broadcast('begin', kind, month)
+        self._wait()
+
+    def join(self, kind: str, month: str, worker_id: str) -> None:
+        self._reset()
+        self._broadcast('join', kind, month, worker_id)
+        self._wait()
+
+    def leave(self, kind: str) -> None:
+        self._broadcast('leave', kind)
+        self._wait()
+
+    def write_etab(self, pldf: pl.DataFrame) -> None:
+        self._broadcast('write_etab', pldf)
+
+    def write_legal(self, pldf: pl.DataFrame) -> None:
+        self._broadcast('write_legal', pldf)
+
+    def lock_wait_seconds(self) -> float:
+        # the targets wait on their own databases, the slowest one holds up the parse
+        return max((target.progress.get('lock_wait', 0.0) for target in self.targets), default=0.0)
+
+    def write_times(self, wait: bool = False) -> list:
+        """
+        the writes are queued, so a batch is timed once every healthy target has written it, at the speed of the
+        slowest target
+        :param wait:
+        :return:
+        """
+        if wait:
+            self._wait()
+        healthy_targets = [target for target in self.targets if target.error is None]
+        if not healthy_targets:
+            return []
+        completed = min(len(target.batches) for target in healthy_targets)
+        times = []
+        for i in range(self.batches_reported, completed):
+            batch = [target.batches[i] for target in healthy_targets]
+            times.append((batch[0][0], max(seconds for _, seconds, _ in batch),
+                          max(lock_wait for _, _, lock_wait in batch)))
+        self.batches_reported = max(completed, self.batches_reported)
+        return times
+
+    def _raise_failures(self, what: str) -> None:
+        failed_targets = [target for target in self.targets if target.error is not None]
+        if failed_targets:
+            raise RuntimeError(f'{what} failed for ' +
+                               ', '.join(f'{target.sink.name} ({target.error})' for target in failed_targets) +
+                               f', the other targets were loaded: {self.describe_progress()}')
+
+    def write_head_offices(self, pldf: pl.DataFrame, month: str) -> None:
+        self._reset()
+        self._broadcast('write_head_offices', pldf, month)
+        self._wait()
+        self._raise_failures('head office load')
+
+    def finish(self, kind: str) -> None:
+        self._broadcast('finish', kind)
+        self._wait()
+        # the targets copied the pending keys to their own snapshots
+        if os.path.exists(pending_keys_path(kind)):
+            os.remove(pending_keys_path(kind))
+        logger.info(f'{kind} fan-out finished, {self.describe_progress()}')
+        self._raise_failures(f'{kind} load')
+
+    def close(self) -> None:
+        for target in self.targets:
+            target.stop()
+            target.sink.close()
+
+
+def lake_root(sink: Sink):
+    """
+    :param sink:
+    :return: directory of the parquet lake the sink writes to, directly or as one of its fan-out targets, or None
+    """
+    if isinstance(sink, ParquetSink):
+        return sink.root
+    if isinstance(sink, FanOutSink):
+        return next((target.sink.root for target in sink.targets if isinstance(target.sink, ParquetSink)), None)
+    return None
+
+
+def create_sink(spec: str, full_refresh: bool = False) -> Sink:
+    """
+    build a sink from a command line spec: mysql, mysql:<env prefix>, duckdb:<path> or parquet:<directory>.
+    several comma separated specs, e.g. mysql:preprod,mysql:prod, build a FanOutSink writing to all of them
+    :param spec:
+    :param full_refresh: only used by the mysql sinks
+    :return:
+    """
+    if ',' in spec:
+        return FanOutSink([create_sink(target_spec.strip(), full_refresh) for target_spec in spec.split(',')])
+    sink_type, _, location = spec.partition(':')
+    if sink_type == 'mysql':
+        return MySQLSink(full_refresh=full_refresh, env_prefix=location or 'preprod')
+    elif sink_type == 'duckdb':
+        return DuckDBSink(location or 'sirene.duckdb')
+    elif sink_type == 'parquet':
+        return ParquetSink(location or 'sirene_lake')
+    raise ValueError(f'Invalid sink: {spec}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='schema changes the sinks need, run before a load')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate', help='add the declared columns the live MySQL tables are '
+                                                           'missing')
+    migrate_parser.add_argument('--env-prefix', default='preprod')
+    migrate_parser.add_argument('--dry-run', action='store_true', help='log the alter statements without running them')
+    args = parser.parse_args()
+
+    cursor, db = connect_mysql(args.env_prefix)
+    try:
+        migrate_live_tables(cursor, db, dry_run=args.dry_run)
+    finally:
+        db.close()
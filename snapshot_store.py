@@ -0,0 +1,275 @@
+"""
+monthly snapshots of the cleaned stock files, for point-in-time lookups and month to month diffs
+
+    python snapshot_store.py show --siren 123456789 --month 2024-03
+    python snapshot_store.py diff --siren 123456789 --from 2024-03 --to 2024-06
+    python snapshot_store.py prune --keep-months 24 --max-size-gb 50
+
+every cleaned file is kept as snapshots/<kind>/<month>.parquet, zstd compressed and sorted on an int64 _key
+column (the siret for etab, the siren for legal) in row groups of row_group_rows rows. <month>.index.json next
+to it holds the min and max _key of each row group, so the rows of a siren are read from the one or two row
+groups that can hold them rather than from the whole snapshot. a siret starts with its siren, so the
+establishments of a siren are a contiguous _key range of the etab snapshot.
+
+the index is written last and marks a snapshot as complete. every column is kept as text, as in the cleaned csv,
+so snapshots taken before and after a change to the cleaners can still be compared
+"""
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+
+from memory_guard import fits_in_memory
+from stage_cache import file_digest
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+# absolute so backfill workers running in their own month directories share the store
+snapshot_root = os.path.abspath(os.environ.get('sirene_snapshot_dir', 'snapshots'))
+keep_months = int(os.environ.get('sirene_snapshot_keep_months', 24))
+max_size_gb = float(os.environ['sirene_snapshot_max_gb']) if os.environ.get('sirene_snapshot_max_gb') else None
+row_group_rows = 50000
+key_columns = {'etab': 'siret', 'legal': 'company_number'}
+kinds = list(key_columns)
+
+
+def snapshot_path(kind: str, month: str) -> str:
+    return os.path.join(snapshot_root, kind, f'{month}.parquet')
+
+
+def index_path(kind: str, month: str) -> str:
+    return os.path.join(snapshot_root, kind, f'{month}.index.json')
+
+
+def available_months(kind: str) -> list:
+    """
+    :param kind: etab or legal
+    :return: months with a complete snapshot, oldest first
+    """
+    directory = os.path.join(snapshot_root, kind)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name[:-len('.index.json')] for name in os.listdir(directory) if name.endswith('.index.json'))
+
+
+def read_index(kind: str, month: str) -> dict:
+    with open(index_path(kind, month)) as f:
+        return json.load(f)
+
+
+def write_snapshot(kind: str, month: str, source: str) -> str:
+    """
+    keep a cleaned csv as the month's snapshot, unless the snapshot was already taken from the same file
+    :param kind: etab or legal
+    :param month: YYYY-MM
+    :param source: cleaned csv
+    :return: path of the snapshot
+    """
+    path = snapshot_path(kind, month)
+    source_digest = file_digest(source)
+    if os.path.exists(index_path(kind, month)) and read_index(kind, month).get('source_digest') == source_digest:
+        logger.info(f'{kind} snapshot of {month} is up to date')
+        return path
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # a stale index would point into the new file's row groups
+    if os.path.exists(index_path(kind, month)):
+        os.remove(index_path(kind, month))
+    temp_path = f'{path}.{os.getpid()}'
+    lazy_pldf = pl.scan_csv(source, infer_schema_length=0) \
+        .with_columns(pl.col(key_columns[kind]).cast(pl.Int64, strict=False).alias('_key')) \
+        .filter(pl.col('_key').is_not_null()) \
+        .sort('_key')
+    if fits_in_memory(source):
+        lazy_pldf.collect().write_parquet(temp_path, compression='zstd', statistics=True,
+                                          row_group_size=row_group_rows)
+    else:
+        lazy_pldf.sink_parquet(temp_path, compression='zstd', statistics=True, row_group_size=row_group_rows)
+    os.replace(temp_path, path)
+
+    # the polars writer leaves min/max out of the column statistics, the bounds are read from the sorted keys
+    parquet_file = pq.ParquetFile(path)
+    metadata = parquet_file.metadata
+    row_groups = []
+    for i in range(metadata.num_row_groups):
+        keys = parquet_file.read_row_group(i, columns=['_key']).column('_key')
+        row_groups.append([keys[0].as_py(), keys[-1].as_py(), len(keys)])
+    index = {'kind': kind, 'month': month, 'rows': metadata.num_rows, 'bytes': os.path.getsize(path),
+             'source_digest': source_digest, 'row_groups': row_groups}
+    with open(index_path(kind, month), 'w') as f:
+        json.dump(index, f)
+    logger.info(f'{kind} snapshot of {month}: {metadata.num_rows} rows in {len(row_groups)} row groups, '
+                f'{os.path.getsize(path) / 1e6:.0f} MB')
+    apply_retention()
+    return path
+
+
+def key_range(kind: str, siren: int) -> tuple:
+    """
+    :param kind:
+    :param siren:
+    :return: first and last _key of the siren's rows
+    """
+    if kind == 'etab':
+        return siren * 100000, siren * 100000 + 99999
+    return siren, siren
+
+
+def read_siren(kind: str, month: str, siren: int) -> pl.DataFrame:
+    """
+    rows of a siren in a snapshot, read from the row groups whose key range can hold them
+    :param kind:
+    :param month:
+    :param siren:
+    :return:
+    """
+    low, high = key_range(kind, siren)
+    bounds = np.array([row_group[:2] for row_group in read_index(kind, month)['row_groups']],
+                      dtype=np.int64).reshape(-1, 2)
+    # row groups are in _key order, so both bounds are sorted
+    first = int(np.searchsorted(bounds[:, 1], low, side='left'))
+    last = int(np.searchsorted(bounds[:, 0], high, side='right'))
+    parquet_file = pq.ParquetFile(snapshot_path(kind, month))
+    if first >= last:
+        return pl.from_arrow(parquet_file.schema_arrow.empty_table())
+    table = parquet_file.read_row_groups(list(range(first, last)))
+    return pl.from_arrow(table).filter(pl.col('_key').is_between(low, high))
+
+
+def month_at(kind: str, month: str):
+    """
+    :param kind:
+    :param month: YYYY-MM
+    :return: the latest snapshot month at or before month, None if there is none
+    """
+    months = [available for available in available_months(kind) if available <= month]
+    return months[-1] if months else None
+
+
+def lookup_at(siren: int, month: str) -> dict:
+    """
+    the legal unit and establishments of a siren as they were in a month
+    :param siren:
+    :param month: YYYY-MM, the latest snapshot at or before it is used
+    :return: per kind, the snapshot month and its rows
+    """
+    result = {}
+    for kind in kinds:
+        snapshot_month = month_at(kind, month)
+        rows = read_siren(kind, snapshot_month, siren).drop('_key').to_dicts() if snapshot_month else []
+        result[kind] = {'month': snapshot_month, 'rows': rows}
+    return result
+
+
+def diff_rows(before: pl.DataFrame, after: pl.DataFrame, key: str) -> dict:
+    """
+    :param before:
+    :param after:
+    :param key: column identifying a row
+    :return: keys added and removed, and the changed columns of the rows in both, as column -> [before, after]
+    """
+    before_rows = {row[key]: row for row in before.drop('_key').to_dicts()} if not before.is_empty() else {}
+    after_rows = {row[key]: row for row in after.drop('_key').to_dicts()} if not after.is_empty() else {}
+    changed = {}
+    for row_key in sorted(before_rows.keys() & after_rows.keys()):
+        columns = before_rows[row_key].keys() | after_rows[row_key].keys()
+        changes = {column: [before_rows[row_key].get(column), after_rows[row_key].get(column)]
+                   for column in sorted(columns)
+                   if before_rows[row_key].get(column) != after_rows[row_key].get(column)}
+        if changes:
+            changed[row_key] = changes
+    return {'added': sorted(after_rows.keys() - before_rows.keys()),
+            'removed': sorted(before_rows.keys() - after_rows.keys()),
+            'changed': changed}
+
+
+def diff_siren(siren: int, from_month: str, to_month: str) -> dict:
+    """
+    what changed for a siren between two months
+    :param siren:
+    :param from_month: YYYY-MM
+    :param to_month: YYYY-MM
+    :return: per kind, the snapshot months compared and the diff of their rows
+    """
+    result = {}
+    for kind in kinds:
+        months = [month_at(kind, from_month), month_at(kind, to_month)]
+        before, after = [read_siren(kind, month, siren) if month else pl.DataFrame() for month in months]
+        result[kind] = {'months': months, **diff_rows(before, after, key_columns[kind])}
+    return result
+
+
+def apply_retention(keep: int = None, max_size_bytes: float = None) -> list:
+    """
+    remove the oldest snapshots of each kind beyond the newest keep months, then the oldest months of every kind
+    until the store is under max_size_bytes. the newest month is always kept
+    :param keep: defaults to sirene_snapshot_keep_months
+    :param max_size_bytes: defaults to sirene_snapshot_max_gb, no size limit if unset
+    :return: (kind, month) of the removed snapshots
+    """
+    keep = keep or keep_months
+    if max_size_bytes is None and max_size_gb is not None:
+        max_size_bytes = max_size_gb * 1e9
+
+    def remove(kind, month):
+        # the index goes first so a half removed snapshot is never read
+        for path in (index_path(kind, month), snapshot_path(kind, month)):
+            if os.path.exists(path):
+                os.remove(path)
+        removed.append((kind, month))
+
+    removed = []
+    for kind in kinds:
+        for month in available_months(kind)[:-keep]:
+            remove(kind, month)
+
+    if max_size_bytes is not None:
+        months = sorted({month for kind in kinds for month in available_months(kind)})
+        sizes = {(kind, month): os.path.getsize(snapshot_path(kind, month))
+                 for kind in kinds for month in available_months(kind)}
+        total = sum(sizes.values())
+        for month in months[:-1]:
+            if total <= max_size_bytes:
+                break
+            for kind in kinds:
+                if (kind, month) in sizes:
+                    total -= sizes[(kind, month)]
+                    remove(kind, month)
+    if removed:
+        logger.info(f'snapshot retention removed {", ".join(f"{kind} {month}" for kind, month in removed)}')
+    return removed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='point-in-time lookups and diffs over the monthly snapshots')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    show_parser = subparsers.add_parser('show', help='a siren as it was in a month')
+    show_parser.add_argument('--siren', type=int, required=True)
+    show_parser.add_argument('--month', required=True, help='YYYY-MM, the latest snapshot at or before it is used')
+    diff_parser = subparsers.add_parser('diff', help='what changed for a siren between two months')
+    diff_parser.add_argument('--siren', type=int, required=True)
+    diff_parser.add_argument('--from', dest='from_month', required=True, help='YYYY-MM')
+    diff_parser.add_argument('--to', dest='to_month', required=True, help='YYYY-MM')
+    write_parser = subparsers.add_parser('write', help='snapshot a cleaned csv')
+    write_parser.add_argument('--kind', choices=kinds, required=True)
+    write_parser.add_argument('--month', required=True)
+    write_parser.add_argument('--source', required=True)
+    prune_parser = subparsers.add_parser('prune', help='apply the retention policy')
+    prune_parser.add_argument('--keep-months', type=int, default=keep_months)
+    prune_parser.add_argument('--max-size-gb', type=float, default=max_size_gb)
+    args = parser.parse_args()
+
+    if args.command == 'show':
+        print(json.dumps(lookup_at(args.siren, args.month), indent=2, ensure_ascii=False))
+    elif args.command == 'diff':
+        print(json.dumps(diff_siren(args.siren, args.from_month, args.to_month), indent=2, ensure_ascii=False))
+    elif args.command == 'write':
+        write_snapshot(args.kind, args.month, args.source)
+    else:
+        apply_retention(args.keep_months, args.max_size_gb * 1e9 if args.max_size_gb else None)
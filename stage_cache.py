@@ -0,0 +1,276 @@
+"""
+content-addressed cache for the download, unzip, clean and split stages
+
+each stage's outputs are stored under a key made of the sha256 of its input files, the source code of the stage
+and its parameters, so a re-run reuses every stage whose inputs and code are unchanged and recomputes the rest.
+artifacts are hard linked into the cache (copied if the cache is on another filesystem), restoring them is cheap.
+a hard linked working copy shares its content with the cache entry, so a later writer opening it in place would
+change the entry too: every output's sha256 is stored with the entry and checked when it is restored, and an entry
+that no longer matches is dropped and the stage run again
+
+list or evict cache entries with
+    python stage_cache.py list
+    python stage_cache.py evict --max-size-gb 50 --older-than-days 60
+"""
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import inspect
+import json
+import logging
+import os
+import shutil
+import time
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+# absolute so the cache is shared by backfill workers running in their own month directories
+cache_dir = os.path.abspath(os.environ.get('sirene_cache_dir', '.stage_cache'))
+digest_file = os.path.join(cache_dir, 'digests.json')
+
+
+def load_digests() -> dict:
+    if not os.path.exists(digest_file):
+        return {}
+    with open(digest_file) as f:
+        return json.load(f)
+
+
+@contextlib.contextmanager
+def digests_locked():
+    """
+    hold an exclusive lock on digests.json, backfill processes share the cache and would lose each other's entries
+    between a load and a save
+    :return:
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(f'{digest_file}.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def save_digests(digests: dict) -> None:
+    """
+    :param digests: loaded while holding digests_locked
+    :return:
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_file = f'{digest_file}.{os.getpid()}'
+    with open(temp_file, 'w') as f:
+        json.dump(digests, f)
+    os.replace(temp_file, digest_file)
+
+
+def file_digest(path: str) -> str:
+    """
+    sha256 of a file, remembered against its size and modification time so multi-GB inputs
+    are only hashed once
+    :param path:
+    :return:
+    """
+    stat = os.stat(path)
+    digests = load_digests()
+    remembered = digests.get(os.path.abspath(path))
+    if remembered and remembered[0] == stat.st_size and remembered[1] == stat.st_mtime_ns:
+        return remembered[2]
+
+    t0 = time.time()
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(8 * 1024 * 1024):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    logger.info(f'hashed {path} in {round(time.time() - t0)} seconds')
+
+    with digests_locked():
+        digests = load_digests()
+        digests[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns, digest]
+        save_digests(digests)
+    return digest
+
+
+def code_version(*code_objects) -> str:
+    """
+    hash of the source code of the functions or modules that make up a stage
+    :param code_objects:
+    :return:
+    """
+    sha = hashlib.sha256()
+    for code_object in code_objects:
+        sha.update(inspect.getsource(code_object).encode('utf-8'))
+    return sha.hexdigest()[:16]
+
+
+def stage_key(stage: str, input_paths: list, params: dict, code: str) -> str:
+    key_material = json.dumps({'stage': stage,
+                               'inputs': [file_digest(path) for path in input_paths],
+                               'params': params,
+                               'code': code}, sort_keys=True, default=str)
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+
+def link_or_copy(source: str, destination: str) -> None:
+    if os.path.exists(destination):
+        if os.path.samefile(source, destination):
+            return
+        os.remove(destination)
+    if os.path.dirname(destination):
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def entry_dir(stage: str, key: str) -> str:
+    return os.path.join(cache_dir, stage, key)
+
+
+def read_meta(entry: str) -> dict:
+    with open(os.path.join(entry, 'meta.json')) as f:
+        return json.load(f)
+
+
+def write_meta(entry: str, meta: dict) -> None:
+    with open(os.path.join(entry, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def entry_is_intact(entry: str) -> bool:
+    """
+    check the stored outputs still have the content they were cached with, an entry whose hard linked working copy
+    was written in place has changed and is removed
+    :param entry:
+    :return:
+    """
+    meta = read_meta(entry)
+    changed_files = [stored_name for stored_name, digest in zip(meta['files'], meta.get('digests', []))
+                     if not os.path.exists(os.path.join(entry, stored_name))
+                     or file_digest(os.path.join(entry, stored_name)) != digest]
+    if not changed_files:
+        return True
+    logger.warning(f'{entry} no longer matches its outputs ({", ".join(changed_files[:3])}), removing it')
+    shutil.rmtree(entry)
+    return False
+
+
+def run_cached_stage(stage: str, func, input_paths: list, params: dict, code_from: list) -> list:
+    """
+    return the outputs of a stage from the cache, or run it and cache its outputs
+    :param stage: stage name, e.g. clean_etab
+    :param func: callable taking no arguments that runs the stage and returns the output path(s)
+    :param input_paths: files the stage reads, their content is part of the key
+    :param params: parameters that change the stage output
+    :param code_from: functions or modules whose source is part of the key
+    :return: list of output paths
+    """
+    key = stage_key(stage, input_paths, params, code_version(*code_from))
+    entry = entry_dir(stage, key)
+
+    if os.path.exists(os.path.join(entry, 'meta.json')) and entry_is_intact(entry):
+        meta = read_meta(entry)
+        for stored_name, output_path in zip(meta['files'], meta['outputs']):
+            link_or_copy(os.path.join(entry, stored_name), output_path)
+        meta['last_used'] = time.time()
+        write_meta(entry, meta)
+        logger.info(f'{stage}: reusing {len(meta["outputs"])} cached outputs from {entry}')
+        return meta['outputs']
+
+    logger.info(f'{stage}: no cache entry for key {key[:16]}, running stage')
+    outputs = func()
+    outputs = [outputs] if isinstance(outputs, str) else list(outputs)
+    # hashed at their working path, where the next stage hashes them as its inputs anyway
+    digests = [file_digest(output_path) for output_path in outputs]
+
+    temp_entry = f'{entry}.tmp{os.getpid()}'
+    os.makedirs(temp_entry, exist_ok=True)
+    stored_names = []
+    for i, output_path in enumerate(outputs):
+        stored_name = f'{i:05d}_{os.path.basename(output_path)}'
+        link_or_copy(output_path, os.path.join(temp_entry, stored_name))
+        stored_names.append(stored_name)
+    write_meta(temp_entry, {'stage': stage,
+                            'params': params,
+                            'inputs': [os.path.abspath(path) for path in input_paths],
+                            'outputs': outputs,
+                            'files': stored_names,
+                            'digests': digests,
+                            'created': time.time(),
+                            'last_used': time.time()})
+    # publish the entry in one step so a crash never leaves a half written entry behind
+    if os.path.exists(entry):
+        shutil.rmtree(entry)
+    os.replace(temp_entry, entry)
+    return outputs
+
+
+def list_entries() -> list:
+    """
+    :return: cache entries with their stage, key, size in bytes, creation and last use times
+    """
+    entries = []
+    if not os.path.exists(cache_dir):
+        return entries
+    for stage in sorted(os.listdir(cache_dir)):
+        stage_dir = os.path.join(cache_dir, stage)
+        if not os.path.isdir(stage_dir):
+            continue
+        for key in os.listdir(stage_dir):
+            entry = os.path.join(stage_dir, key)
+            if not os.path.exists(os.path.join(entry, 'meta.json')):
+                continue
+            meta = read_meta(entry)
+            size = sum(os.path.getsize(os.path.join(entry, name)) for name in meta['files'])
+            entries.append({'stage': stage, 'key': key, 'path': entry, 'size': size,
+                            'created': meta['created'], 'last_used': meta['last_used'],
+                            'params': meta['params']})
+    return entries
+
+
+def evict(max_size_bytes: int = None, older_than_seconds: float = None) -> list:
+    """
+    remove entries not used for older_than_seconds, then the least recently used entries
+    until the cache is under max_size_bytes
+    :param max_size_bytes:
+    :param older_than_seconds:
+    :return: evicted entries
+    """
+    entries = sorted(list_entries(), key=lambda entry: entry['last_used'])
+    evicted = []
+    now = time.time()
+    total_size = sum(entry['size'] for entry in entries)
+    for entry in entries:
+        too_old = older_than_seconds is not None and now - entry['last_used'] > older_than_seconds
+        too_big = max_size_bytes is not None and total_size > max_size_bytes
+        if too_old or too_big:
+            shutil.rmtree(entry['path'])
+            total_size -= entry['size']
+            evicted.append(entry)
+            logger.info(f'evicted {entry["stage"]}/{entry["key"][:16]} ({entry["size"] / 1e9:.2f} GB)')
+    return evicted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='list or evict stage cache entries')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list')
+    evict_parser = subparsers.add_parser('evict')
+    evict_parser.add_argument('--max-size-gb', type=float)
+    evict_parser.add_argument('--older-than-days', type=float)
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for entry in list_entries():
+            print(f'{entry["stage"]:<16} {entry["key"][:16]} {entry["size"] / 1e9:8.2f} GB  '
+                  f'created {time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["created"]))}  '
+                  f'last used {time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["last_used"]))}  '
+                  f'{json.dumps(entry["params"])}')
+    else:
+        evict(max_size_bytes=int(args.max_size_gb * 1e9) if args.max_size_gb is not None else None,
+              older_than_seconds=args.older_than_days * 86400 if args.older_than_days is not None else None)
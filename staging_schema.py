@@ -0,0 +1,268 @@
+"""
+declared schema of the staging tables
+
+the staging tables are created once per run from these declarations, with each column taking the type it has in
+the live table so the upsert never converts or truncates a value, and are then reused. each fragment is appended
+and the table is truncated after its upsert, so no fragment causes DDL or a metadata lock. the same declarations
+give the explicit column lists used to move rows from staging into the live tables, so a column added to the
+live table (e.g. by sinks.py migrate) can never shift the positional mapping of an insert ... select *.
+every sink casts the fragments to the declared types, a column that is empty in one fragment would otherwise be
+read as text there and as a number in the next.
+
+the etab address labels are staged as dimension ids (see address_dimensions), staged_columns gives the columns
+actually created in staging while the declarations keep the live column names
+"""
+import logging
+
+import polars as pl
+
+from address_dimensions import dimension_columns, id_column
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+# columns of the cleaned StockEtablissement fragments, in order
+etab_staging_columns = [
+    ('company_number', 'varchar(9)'),
+    ('localnic', 'varchar(5)'),
+    ('siret', 'varchar(14)'),
+    ('distributionStatus', 'varchar(1)'),
+    ('EstablishmentDate', 'varchar(10)'),
+    ('EmployeeCountCategory', 'varchar(2)'),
+    ('EmployeeCountCategoryYear', 'varchar(4)'),
+    ('mainNAF', 'varchar(8)'),
+    ('LastNAFUpdate', 'varchar(19)'),
+    ('RegisteredOfficeBool', 'varchar(5)'),
+    ('PeriodNumber', 'varchar(4)'),
+    ('LastAddressNumber', 'varchar(8)'),
+    ('DateOfLastAddressNumber', 'varchar(8)'),
+    ('InstitutionAddressID', 'varchar(64)'),
+    ('LambertCoordinateX', 'varchar(24)'),
+    ('LambertCoordinateY', 'varchar(24)'),
+    ('AddressBuildingBlock', 'varchar(255)'),
+    ('AddressNumber', 'varchar(8)'),
+    ('AddressNumberSubUnit', 'varchar(4)'),
+    ('AddressUniqueIdentifier', 'varchar(8)'),
+    ('AddressLabel', 'varchar(255)'),
+    ('AddressPostcode', 'varchar(5)'),
+    ('AddressMunicipalityLabel', 'varchar(100)'),
+    ('AddressForeignMunicipality', 'varchar(100)'),
+    ('AddressPOBox', 'varchar(100)'),
+    ('AddressCommuneCode', 'varchar(5)'),
+    ('AddressCEDEXCode', 'varchar(9)'),
+    ('AddressCEDEXLabel', 'varchar(100)'),
+    ('AddressOverseasCountryCode', 'varchar(5)'),
+    ('AddressOverseasCountryLabel', 'varchar(100)'),
+    ('AddressBuildingBlock2', 'varchar(255)'),
+    ('AddressNumber2', 'varchar(8)'),
+    ('AddressNumberSubUnit2', 'varchar(4)'),
+    ('AddressUniqueIdentifier2', 'varchar(8)'),
+    ('AddressLabel2', 'varchar(255)'),
+    ('AddressPostcode2', 'varchar(5)'),
+    ('AddressMunicipalityLabel2', 'varchar(100)'),
+    ('AddressForeignMunicipality2', 'varchar(100)'),
+    ('AddressPOBox2', 'varchar(100)'),
+    ('AddressCommuneCode2', 'varchar(5)'),
+    ('AddressCEDEXCode2', 'varchar(9)'),
+    ('AddressCEDEXLabel2', 'varchar(100)'),
+    ('AddressOverseasCountryCode2', 'varchar(5)'),
+    ('AddressOverseasCountryLabel2', 'varchar(100)'),
+    ('DateOfBusinessStart', 'varchar(10)'),
+    ('AdministrativeStatus', 'varchar(1)'),
+    ('EstablishmentSign1', 'varchar(100)'),
+    ('EstablishmentSign2', 'varchar(100)'),
+    ('EstablishmentSign3', 'varchar(100)'),
+    ('CommonCompanyName', 'varchar(255)'),
+    ('APETCode', 'varchar(8)'),
+    ('APETCodeCategory', 'varchar(8)'),
+    ('EmploymentType', 'varchar(1)'),
+    ('id', 'varchar(32)'),
+    ('latitude', 'double'),
+    ('longitude', 'double'),
+    ('geo_md5', 'varchar(32)'),
+    ('address_line_1', 'varchar(255)'),
+    ('address_line_2', 'varchar(255)'),
+    ('registered_office_type', 'varchar(32)'),
+    ('last_modified_by', 'varchar(255)'),
+    ('last_modified_date', 'datetime'),
+]
+
+# columns of the cleaned StockUniteLegale fragments, in order
+legal_staging_columns = [
+    ('company_number', 'varchar(9)'),
+    ('LegalUnitBroadcastID', 'varchar(1)'),
+    ('PurgeStatus', 'varchar(5)'),
+    ('DateCreated', 'varchar(10)'),
+    ('LegalAcronym', 'varchar(100)'),
+    ('GenderOfPerson', 'varchar(2)'),
+    ('NaturalName1', 'varchar(100)'),
+    ('NaturalName2', 'varchar(100)'),
+    ('NaturalName3', 'varchar(100)'),
+    ('NaturalName4', 'varchar(100)'),
+    ('PreferredName', 'varchar(100)'),
+    ('pseudonym', 'varchar(255)'),
+    ('RNANumber', 'varchar(10)'),
+    ('EmployeeCountCategory', 'varchar(2)'),
+    ('EmployeeCountCategoryDateUpdated', 'varchar(4)'),
+    ('LegalUnitUpdated', 'varchar(19)'),
+    ('TimeAsLegalUnit', 'varchar(4)'),
+    ('BusinessCategory', 'varchar(3)'),
+    ('YearOfBusinessCategoryAssignment', 'varchar(4)'),
+    ('DateOfBusinessStart', 'varchar(10)'),
+    ('AdministrativeStatus', 'varchar(1)'),
+    ('PersonBirthName', 'varchar(100)'),
+    ('PersonUsedName', 'varchar(100)'),
+    ('LegalEntityName', 'varchar(255)'),
+    ('LegalEntityName1', 'varchar(255)'),
+    ('LegalEntityName2', 'varchar(255)'),
+    ('LegalEntityName3', 'varchar(255)'),
+    ('LegalCategory', 'varchar(4)'),
+    ('NAFCategory', 'varchar(8)'),
+    ('ActiveLegalUnit', 'varchar(8)'),
+    ('NICAssignment', 'varchar(5)'),
+    ('SSEBool', 'varchar(1)'),
+    ('MissionDrivenCompanyBool', 'varchar(1)'),
+    ('EmployerNature', 'varchar(1)'),
+    ('company_type', 'varchar(64)'),
+    ('id', 'varchar(32)'),
+    ('country', 'varchar(32)'),
+    ('country_code', 'varchar(2)'),
+    ('company_status', 'varchar(16)'),
+    ('EmployeeCount', 'varchar(32)'),
+    ('last_modified_by', 'varchar(255)'),
+    ('last_modified_date', 'datetime'),
+]
+
+staging_tables = {
+    'etab': {'table': 'sirene_stocketab_staging',
+             'live_table': 'sirene_stocketab',
+             'columns': etab_staging_columns,
+             'indexes': ['siret', 'geo_md5']},
+    'legal': {'table': 'sirene_stocklegal_staging',
+              'live_table': 'sirene_stocklegal',
+              'columns': legal_staging_columns,
+              'indexes': ['company_number', 'NAFCategory']},
+}
+
+
+def column_names(kind: str) -> list:
+    return [column for column, _ in staging_tables[kind]['columns']]
+
+
+def staged_columns(kind: str) -> list:
+    """
+    :param kind:
+    :return: (name, type) of the staging table, dimension labels replaced by their bigint id
+    """
+    if kind != 'etab':
+        return staging_tables[kind]['columns']
+    return [(id_column(column), 'bigint') if column in dimension_columns else (column, definition)
+            for column, definition in staging_tables[kind]['columns']]
+
+
+def column_list(kind: str, prefix: str = '') -> str:
+    """
+    comma separated, quoted column names for an explicit insert or select list
+    :param kind: etab or legal
+    :param prefix: table alias, e.g. t2.
+    :return:
+    """
+    return ', '.join(f'{prefix}`{column}`' for column in column_names(kind))
+
+
+def live_column_types(cursor, table: str) -> dict:
+    """
+    :param cursor:
+    :param table:
+    :return: lowercased column name -> column type, e.g. varchar(14), as the live table has it
+    """
+    cursor.execute(
+        """
+        select column_name, column_type from information_schema.columns
+        where table_schema = database() and table_name = %s
+        """, (table,)
+    )
+    return {column.lower(): column_type.decode('utf-8') if isinstance(column_type, (bytes, bytearray))
+            else column_type for column, column_type in cursor.fetchall()}
+
+
+def create_staging_table(cursor, db, kind: str, table: str = None) -> None:
+    """
+    (re)create a staging table from its declaration, called once at the start of a run. declared columns take
+    their type from the live table, a declared type that differs is logged so the declaration can be corrected
+    :param cursor:
+    :param db:
+    :param kind: etab or legal
+    :param table: defaults to the declared name, queue workers each create their own copy
+    :return:
+    """
+    staging = staging_tables[kind]
+    table = table or staging['table']
+    live_types = live_column_types(cursor, staging['live_table'])
+    columns = []
+    for column, definition in staged_columns(kind):
+        live_type = live_types.get(column.lower())
+        if live_type and live_type.lower() != definition.lower():
+            logger.warning(f'{column} is declared {definition} but is {live_type} in {staging["live_table"]}, '
+                           f'staging it as {live_type}')
+            definition = live_type
+        columns.append((column, definition))
+    column_definitions = [f'`{column}` {definition}' for column, definition in columns]
+    index_definitions = [f'key `{column}` (`{column}`)' for column in staging['indexes']]
+    cursor.execute(f"""drop table if exists {table}""")
+    cursor.execute(f"""create table {table} ({', '.join(column_definitions + index_definitions)})""")
+    db.commit()
+    logger.info(f'created {table} with {len(column_definitions)} declared columns')
+
+
+def polars_type(definition: str) -> pl.PolarsDataType:
+    """
+    :param definition: declared MySQL column type
+    :return: the polars type fragments are cast to, datetimes are kept as the text the cleaned csv holds
+    """
+    if definition == 'double':
+        return pl.Float64
+    if definition == 'bigint':
+        return pl.Int64
+    return pl.Utf8
+
+
+def conform_columns(pldf: pl.DataFrame, kind: str, columns: list) -> pl.DataFrame:
+    """
+    select the columns in their declared order and cast to their declared types, adding any the fragment is
+    missing as null. columns that are not declared are dropped, with a warning
+    :param pldf:
+    :param kind:
+    :param columns: (name, type) pairs
+    :return:
+    """
+    missing_columns = [column for column, _ in columns if column not in pldf.columns]
+    if missing_columns:
+        logger.warning(f'{kind} fragment is missing {missing_columns}, staging them as null')
+    declared_names = {column for column, _ in columns}
+    dropped_columns = [column for column in pldf.columns if column not in declared_names]
+    if dropped_columns:
+        logger.warning(f'{kind} fragment has undeclared columns {dropped_columns}, they are not loaded, '
+                       f'declare them in staging_schema to keep them')
+    return pldf.select([pl.col(column).cast(polars_type(definition), strict=False) if column in pldf.columns
+                        else pl.lit(None, dtype=polars_type(definition)).alias(column)
+                        for column, definition in columns])
+
+
+def conform_to_staging(pldf: pl.DataFrame, kind: str) -> pl.DataFrame:
+    """
+    :param pldf: for etab, with its labels already encoded to dimension ids
+    :param kind:
+    :return: the fragment with the staging table's columns and types
+    """
+    return conform_columns(pldf, kind, staged_columns(kind))
+
+
+def conform_to_schema(pldf: pl.DataFrame, kind: str) -> pl.DataFrame:
+    """
+    :param pldf: cleaned fragment, with its address labels
+    :param kind:
+    :return: the fragment with the declared columns and types of the live table
+    """
+    return conform_columns(pldf, kind, staging_tables[kind]['columns'])
@@ -0,0 +1,166 @@
+"""
+propagates closed establishments and purged legal units to geo_location, organisation and naf_code
+
+the cleaners write the set of keys that are live this month (geo_md5 for etab, organisation id for legal) to
+key_snapshots/<kind>_keys_pending.parquet. once the fragments have been loaded, that set is anti-joined in polars
+against the set applied last month, and the keys that disappeared or were closed are deleted or flagged in bounded
+chunks using the indexed key columns, so no full table scan is needed.
+
+when one run loads several databases each keeps its own applied snapshot, <kind>_keys_<target>.parquet, so a
+database that missed a month is compared against the last month it actually applied
+"""
+import logging
+import os
+import shutil
+
+import polars as pl
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+snapshot_dir = 'key_snapshots'
+
+
+def pending_keys_path(kind: str) -> str:
+    return os.path.join(snapshot_dir, f'{kind}_keys_pending.parquet')
+
+
+def applied_keys_path(kind: str, target: str = None) -> str:
+    """
+    :param kind:
+    :param target: database the snapshot was applied to, None for preprod whose snapshots keep their original name
+    :return:
+    """
+    suffix = f'_{target}' if target else ''
+    return os.path.join(snapshot_dir, f'{kind}_keys{suffix}.parquet')
+
+
+def write_pending_keys(pldf: pl.DataFrame, kind: str, key_column: str) -> None:
+    """
+    write the live keys of a cleaned file, to be compared with last month's once the load has finished
+    :param pldf: cleaned dataframe
+    :param kind: etab or legal
+    :param key_column:
+    :return:
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    keys = pldf.select(pl.col(key_column).cast(pl.Utf8).alias('key')).unique()
+    keys.write_parquet(pending_keys_path(kind))
+    logger.info(f'{len(keys)} live {kind} keys written to {pending_keys_path(kind)}')
+
+
+def compute_stale_keys(kind: str, target: str = None) -> list:
+    """
+    anti-join last month's applied keys against this month's pending keys
+    :param kind:
+    :param target:
+    :return: keys that were live last month but are closed or missing this month
+    """
+    if not os.path.exists(applied_keys_path(kind, target)):
+        logger.info(f'no applied {kind} key snapshot found, nothing to compare against')
+        return []
+    previous_keys = pl.read_parquet(applied_keys_path(kind, target))
+    current_keys = pl.read_parquet(pending_keys_path(kind))
+    stale_keys = previous_keys.join(current_keys, on='key', how='anti')
+    logger.info(f'{len(stale_keys)} of {len(previous_keys)} {kind} keys are no longer live')
+    return stale_keys['key'].to_list()
+
+
+def apply_in_chunks(cursor, db, statement: str, keys: list, chunk_size: int = 5000) -> int:
+    """
+    run a statement containing a single {placeholders} marker for an 'in (...)' list over the keys,
+    one bounded chunk and commit at a time so locks are held briefly
+    :param cursor:
+    :param db:
+    :param statement:
+    :param keys:
+    :param chunk_size:
+    :return: total rows affected
+    """
+    affected_rows = 0
+    for i in range(0, len(keys), chunk_size):
+        chunk = keys[i:i + chunk_size]
+        placeholders = ', '.join(['%s'] * len(chunk))
+        cursor.execute(statement.format(placeholders=placeholders), chunk)
+        affected_rows += cursor.rowcount
+        db.commit()
+    return affected_rows
+
+
+def promote_pending_keys(kind: str, target: str = None, keep_pending: bool = False) -> None:
+    """
+    the pending keys become the keys to compare next month's file against
+    :param kind:
+    :param target:
+    :param keep_pending: copy rather than move, when other databases still have to sync against them
+    :return:
+    """
+    if keep_pending:
+        shutil.copyfile(pending_keys_path(kind), applied_keys_path(kind, target))
+    else:
+        os.replace(pending_keys_path(kind), applied_keys_path(kind, target))
+
+
+def sync_stale_etab(cursor, db, chunk_size: int = 5000, target: str = None, keep_pending: bool = False) -> int:
+    """
+    remove geo_location rows of establishments that have closed or disappeared from the stock file
+    :param cursor:
+    :param db:
+    :param chunk_size:
+    :param target: database being synced, see applied_keys_path
+    :param keep_pending: leave the pending keys for the other databases of the run
+    :return: number of geo_location rows deleted
+    """
+    if not os.path.exists(pending_keys_path('etab')):
+        logger.info('no pending etab keys, skipping stale sync')
+        return 0
+    stale_keys = compute_stale_keys('etab', target)
+    deleted_rows = apply_in_chunks(
+        cursor, db,
+        """
+        delete from geo_location
+        where md5_key in ({placeholders})
+        and last_modified_by like 'sirene_etab%%'
+        """,
+        stale_keys, chunk_size)
+    logger.info(f'{deleted_rows} closed addresses removed from geo_location')
+    promote_pending_keys('etab', target, keep_pending)
+    return deleted_rows
+
+
+def sync_stale_legal(cursor, db, chunk_size: int = 5000, target: str = None, keep_pending: bool = False) -> int:
+    """
+    flag organisations that were purged or have dropped out of the stock file as inactive
+    and remove their naf codes
+    :param cursor:
+    :param db:
+    :param chunk_size:
+    :param target: database being synced, see applied_keys_path
+    :param keep_pending: leave the pending keys for the other databases of the run
+    :return: number of organisation rows flagged
+    """
+    if not os.path.exists(pending_keys_path('legal')):
+        logger.info('no pending legal keys, skipping stale sync')
+        return 0
+    stale_keys = compute_stale_keys('legal', target)
+    flagged_rows = apply_in_chunks(
+        cursor, db,
+        """
+        update organisation
+        set company_status = 'Inactive',
+        last_modified_by = 'sirene purge sync',
+        last_modified_date = curdate()
+        where id in ({placeholders})
+        """,
+        stale_keys, chunk_size)
+    deleted_rows = apply_in_chunks(
+        cursor, db,
+        """
+        delete from naf_code
+        where organisation_id in ({placeholders})
+        """,
+        stale_keys, chunk_size)
+    logger.info(f'{flagged_rows} organisations flagged inactive, {deleted_rows} naf codes removed')
+    promote_pending_keys('legal', target, keep_pending)
+    return flagged_rows
@@ -0,0 +1,233 @@
+"""
+pipelined download -> inflate -> csv batches
+
+the monthly zip is streamed from files.data.gouv.fr, written to disk as it arrives (so an interrupted download
+can be resumed) and fed through bounded queues to a streaming inflater and then to an incremental csv batch
+reader, so the cleaner can start on the first rows while the rest of the file is still downloading.
+
+each stage runs in its own thread, the socket reads, file writes and zlib all release the GIL
+"""
+import io
+import logging
+import os
+import queue
+import struct
+import threading
+import zlib
+
+import polars as pl
+import requests
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+files_url = 'https://files.data.gouv.fr/insee-sirene/'
+download_chunk_size = 1024 * 1024
+queue_size = 64
+end_of_stream = None
+
+
+class ZipStreamInflater:
+    """
+    inflates the first member of a zip file from a stream of bytes, using the local file header
+    rather than the central directory at the end of the file
+    """
+    local_header_signature = b'PK\x03\x04'
+    local_header_size = 30
+
+    def __init__(self):
+        self.buffer = b''
+        self.name = None
+        self.decompressor = None
+        self.method = None
+        self.remaining = None
+        self.finished = False
+
+    def _read_header(self) -> bool:
+        if len(self.buffer) < self.local_header_size:
+            return False
+        if self.buffer[:4] != self.local_header_signature:
+            raise ValueError('stream is not a zip file')
+        (flags, method, compressed_size,
+         name_length, extra_length) = struct.unpack('<2xHH8xI4xHH', self.buffer[4:self.local_header_size])
+        data_start = self.local_header_size + name_length + extra_length
+        if len(self.buffer) < data_start:
+            return False
+        self.name = self.buffer[self.local_header_size:self.local_header_size + name_length].decode('utf-8')
+        logger.info(f'streaming zip member {self.name}')
+        if method == 8:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif method == 0 and not flags & 0x08:
+            self.remaining = compressed_size
+        else:
+            raise ValueError(f'unsupported zip member for streaming, method {method}, flags {flags}')
+        self.method = method
+        self.buffer = self.buffer[data_start:]
+        return True
+
+    def feed(self, data: bytes) -> bytes:
+        """
+        add compressed bytes, returns whatever could be inflated so far
+        :param data:
+        :return:
+        """
+        if self.finished:
+            return b''
+        self.buffer += data
+        if self.method is None and not self._read_header():
+            return b''
+        data, self.buffer = self.buffer, b''
+        if self.method == 8:
+            output = self.decompressor.decompress(data)
+            self.finished = self.decompressor.eof
+            return output
+        output = data[:self.remaining]
+        self.remaining -= len(output)
+        self.finished = self.remaining == 0
+        return output
+
+
+def iter_zip_source(filestring: str):
+    """
+    yield the bytes of the zip, from disk if it has already been downloaded, otherwise from the http stream
+    while appending to <filestring>.part, which is renamed to filestring once complete.
+    a leftover .part file is resumed with a range request
+    :param filestring:
+    :return:
+    """
+    if os.path.exists(filestring):
+        logger.info(f'{filestring} found on disk, streaming from file')
+        with open(filestring, 'rb') as f:
+            while chunk := f.read(download_chunk_size):
+                yield chunk
+        return
+
+    part_file = filestring + '.part'
+    resume_from = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    headers = {'Range': f'bytes={resume_from}-'} if resume_from else {}
+    r = requests.get(files_url + filestring, stream=True, verify=False, headers=headers)
+    if r.status_code not in (200, 206):
+        logger.error('status code: {}'.format(r.status_code))
+        raise requests.exceptions.HTTPError(f'{r.status_code} when downloading {filestring}')
+
+    if r.status_code == 206:
+        logger.info(f'resuming {filestring} from byte {resume_from}')
+        with open(part_file, 'rb') as f:
+            while chunk := f.read(download_chunk_size):
+                yield chunk
+    else:
+        resume_from = 0
+
+    with open(part_file, 'ab' if resume_from else 'wb') as f:
+        for chunk in r.iter_content(chunk_size=download_chunk_size):
+            f.write(chunk)
+            yield chunk
+    os.replace(part_file, filestring)
+    logger.info('file successfully downloaded')
+
+
+def split_complete_rows(buffer: bytes) -> int:
+    """
+    position just after the last newline in the buffer that is not inside a quoted field
+    :param buffer:
+    :return: 0 if the buffer holds no complete row
+    """
+    position = buffer.rfind(b'\n')
+    while position != -1 and buffer.count(b'"', 0, position) % 2:
+        position = buffer.rfind(b'\n', 0, position)
+    return position + 1
+
+
+class StreamingCSVBatches:
+    """
+    download, inflate and cut the csv into batches of roughly batch_bytes, each batch is returned as bytes
+    starting with the csv header so it can be parsed on its own with pl.read_csv
+    """
+
+    def __init__(self, filestring: str, batch_bytes: int = 64 * 1024 * 1024):
+        self.filestring = filestring
+        self.batch_bytes = batch_bytes
+        self.compressed_queue = queue.Queue(maxsize=queue_size)
+        self.inflated_queue = queue.Queue(maxsize=queue_size)
+        self.member_name = None
+        self.error = None
+        self.threads = [threading.Thread(target=self._download, daemon=True),
+                        threading.Thread(target=self._inflate, daemon=True)]
+
+    def _download(self) -> None:
+        try:
+            for chunk in iter_zip_source(self.filestring):
+                self.compressed_queue.put(chunk)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.compressed_queue.put(end_of_stream)
+
+    def _inflate(self) -> None:
+        inflater = ZipStreamInflater()
+        try:
+            while (chunk := self.compressed_queue.get()) is not end_of_stream:
+                inflated = inflater.feed(chunk)
+                self.member_name = inflater.name
+                if inflated:
+                    self.inflated_queue.put(inflated)
+            if not inflater.finished and self.error is None:
+                self.error = ValueError(f'{self.filestring} ended before the end of the compressed data')
+        except Exception as e:
+            self.error = e
+            # keep draining so the download thread is never blocked on a full queue
+            while self.compressed_queue.get() is not end_of_stream:
+                pass
+        finally:
+            self.inflated_queue.put(end_of_stream)
+
+    def __iter__(self):
+        for thread in self.threads:
+            thread.start()
+
+        header = None
+        pending = []
+        pending_size = 0
+        while (data := self.inflated_queue.get()) is not end_of_stream:
+            pending.append(data)
+            pending_size += len(data)
+            if pending_size < self.batch_bytes:
+                continue
+            buffer = b''.join(pending)
+            if header is None:
+                header, buffer = buffer[:buffer.index(b'\n') + 1], buffer[buffer.index(b'\n') + 1:]
+            cut = split_complete_rows(buffer)
+            pending = [buffer[cut:]]
+            pending_size = len(pending[0])
+            if cut:
+                yield header + buffer[:cut]
+
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+        buffer = b''.join(pending)
+        if header is None and buffer:
+            header, buffer = buffer[:buffer.index(b'\n') + 1], buffer[buffer.index(b'\n') + 1:]
+        if buffer.strip():
+            yield header + buffer
+
+
+def iter_csv_frames(batches, read_options: dict):
+    """
+    parse each csv batch into a polars dataframe, the schema inferred for the first batch is used for the
+    rest so every batch comes out with the same column types
+    :param batches: iterable of csv bytes, each starting with the header
+    :param read_options: keyword arguments for pl.read_csv
+    :return:
+    """
+    schema = None
+    for batch in batches:
+        if schema is None:
+            pldf = pl.read_csv(io.BytesIO(batch), **read_options)
+            schema = pldf.schema
+        else:
+            pldf = pl.read_csv(io.BytesIO(batch), **{**read_options, 'dtypes': schema})
+        yield pldf
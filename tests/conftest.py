@@ -0,0 +1,84 @@
+import os
+import random
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive  # noqa: E402
+import quality_profile  # noqa: E402
+import snapshot_store  # noqa: E402
+import stage_cache  # noqa: E402
+import utils  # noqa: E402
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """
+    run in an empty directory, with the stores that default to absolute paths moved into it and notifications
+    written to messages.jsonl rather than posted
+    """
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(tmp_path / 'fragments')
+    monkeypatch.setattr(stage_cache, 'cache_dir', str(tmp_path / '.stage_cache'))
+    monkeypatch.setattr(stage_cache, 'digest_file', str(tmp_path / '.stage_cache' / 'digests.json'))
+    monkeypatch.setattr(snapshot_store, 'snapshot_root', str(tmp_path / 'snapshots'))
+    monkeypatch.setattr(quality_profile, 'report_root', str(tmp_path / 'quality_reports'))
+    monkeypatch.setattr(archive, 'raw_dir', str(tmp_path / 'raw_zips'))
+    monkeypatch.setattr(utils.dispatcher, 'url', f'file:{tmp_path / "messages.jsonl"}')
+    monkeypatch.setattr(utils.dispatcher, 'coalesce_seconds', 0)
+    return tmp_path
+
+
+def write_zip(path, member: str, columns: list, rows: list) -> str:
+    lines = [','.join(columns)] + [','.join(row.get(column, '') for column in columns) for row in rows]
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr(member, '\n'.join(lines) + '\n')
+    return str(path)
+
+
+def etab_rows(n: int, seed: int = 0) -> list:
+    random.seed(seed)
+    rows = []
+    for i in range(n):
+        siren = f'{100000000 + i}'
+        rows.append({'siren': siren, 'nic': '00012', 'siret': siren + '00012',
+                     'etablissementSiege': 'true' if i % 2 else 'false',
+                     'codePostalEtablissement': random.choice(['75001', '13002', '69003']),
+                     'etatAdministratifEtablissement': 'F' if i % 3 == 0 else 'A',
+                     'libelleCommuneEtablissement': random.choice(['PARIS 1', 'MARSEILLE 2', 'LYON 3']),
+                     'typeVoieEtablissement': random.choice(['RUE', 'AV', 'BD']),
+                     'libelleVoieEtablissement': 'DE LA PAIX',
+                     'numeroVoieEtablissement': str(random.randint(1, 200)),
+                     'coordonneeLambertAbscisseEtablissement': str(652000 + random.randint(-1000, 1000)),
+                     'coordonneeLambertOrdonneeEtablissement': str(6862000 + random.randint(-1000, 1000))})
+    return rows
+
+
+def legal_rows(n: int) -> list:
+    return [{'siren': f'{100000000 + i}', 'denominationUniteLegale': f'SOCIETE {i} SARL',
+             'categorieJuridiqueUniteLegale': ['5499', '5710', '1000', '5499'][i % 4],
+             'etatAdministratifUniteLegale': 'A', 'trancheEffectifsUniteLegale': '01', 'nicSiegeUniteLegale': '00012'}
+            for i in range(n)]
+
+
+@pytest.fixture
+def etab_zip(workdir):
+    import etab_clean_func
+
+    def make(month: str = '2024-01', n: int = 300, seed: int = 0) -> str:
+        return write_zip(workdir / f'{month}-01-StockEtablissement_utf8.zip', 'StockEtablissement_utf8.csv',
+                         list(etab_clean_func.unite_etab_cols), etab_rows(n, seed))
+    return make
+
+
+@pytest.fixture
+def legal_zip(workdir):
+    import legal_clean_func
+
+    def make(month: str = '2024-01', n: int = 300) -> str:
+        return write_zip(workdir / f'{month}-01-StockUniteLegale_utf8.zip', 'StockUniteLegale_utf8.csv',
+                         list(legal_clean_func.unite_legale_cols), legal_rows(n))
+    return make
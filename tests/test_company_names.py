@@ -0,0 +1,32 @@
+import polars as pl
+import pytest
+
+from company_names import NameMatcher, add_name_keys, company_name_rows, signature_columns, trigrams
+
+
+def name_keys(names: list) -> pl.DataFrame:
+    return add_name_keys(pl.DataFrame({'normalised_name': names}))
+
+
+@pytest.mark.parametrize('name', ['A', 'AB', 'ABC', 'AB CD'])
+def test_short_names_get_signatures(name):
+    keys = name_keys([name])
+    assert keys.select(signature_columns).null_count().sum(axis=1)[0] == 0
+
+
+def test_signatures_are_the_minhash_of_the_padded_trigrams():
+    # the same trigram set, whatever the runs it was extracted from, gives the same signatures
+    assert trigrams('AB') == {' AB', 'AB '}
+    keys = name_keys(['AB', 'AB'])
+    assert keys[0, 'sig_1'] == keys[1, 'sig_1']
+    assert keys[0, 'sig_1'] != name_keys(['AC'])[0, 'sig_1']
+
+
+def test_two_letter_acronym_is_matched():
+    legal = pl.DataFrame({'company_number': ['100000001', '100000002'],
+                          'LegalEntityName': ['BOULANGERIE MARTIN SARL', 'PHARMACIE DU CENTRE'],
+                          'LegalAcronym': ['BM', None]})
+    matcher = NameMatcher(company_name_rows(legal))
+    matches = matcher.match(['bm'])[0]['matches']
+    assert [match['company_number'] for match in matches] == ['100000001']
+    assert matches[0]['score'] == 1.0
@@ -0,0 +1,34 @@
+import mmap
+
+import polars as pl
+import pytest
+
+from download_files import find_fragment_offsets, split_file
+
+
+def write_csv(path, rows):
+    pl.DataFrame(rows).write_csv(path)
+    return str(path)
+
+
+def test_split_keeps_quoted_newlines_in_one_row(workdir):
+    notes = [f'note {i}' if i % 7 else f'line one of {i}\nline two, with a "quote"' for i in range(100)]
+    source = write_csv(workdir / 'StockEtablissement_clean.csv', {'siret': list(range(100)), 'note': notes})
+    fragments = split_file(source, linecount=10)
+    assert len(fragments) > 1
+    rows = pl.concat([pl.read_csv(fragment) for fragment in fragments])
+    assert rows.frame_equal(pl.read_csv(source))
+
+
+@pytest.mark.parametrize('window', [8, 64, 1024 * 1024])
+def test_fragment_offsets_count_rows_across_windows(tmp_path, window):
+    source = write_csv(tmp_path / 'rows.csv', {'siret': list(range(25)), 'note': ['x\ny' if i == 9 else 'z'
+                                                                                    for i in range(25)]})
+    with open(source, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header_end, ranges = find_fragment_offsets(mm, 10, window=window)
+        assert mm[:header_end] == b'siret,note\n'
+        assert ranges[0][0] == header_end and ranges[-1][1] == len(mm)
+        assert all(end == next_start for (_, end), (next_start, _) in zip(ranges, ranges[1:]))
+        # the tenth newline is inside the quotes of row 9, so the boundary moves to the end of that row
+        assert [mm[start:end].count(b'\n') for start, end in ranges] == [11, 10, 5]
+        assert mm[ranges[0][0]:ranges[0][1]].endswith(b'9,"x\ny"\n')
@@ -0,0 +1,49 @@
+import os
+import sys
+import threading
+import time
+
+import polars as pl
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fragment_loader import run_fragment_pipeline  # noqa: E402
+
+
+def read_fragment(fragment):
+    return pl.DataFrame({'fragment': [fragment] * 10})
+
+
+def test_failing_write_is_raised_promptly():
+    def write_fragment(pldf):
+        raise RuntimeError('write failed')
+
+    t0 = time.time()
+    with pytest.raises(RuntimeError, match='write failed'):
+        run_fragment_pipeline([f'fragment_{i}' for i in range(20)], read_fragment, write_fragment, prefetch=2,
+                              remove_fragments=False)
+    assert time.time() - t0 < 5
+    assert threading.active_count() == 1
+
+
+def test_failing_read_is_raised_after_the_prepared_fragments():
+    written = []
+
+    def failing_read(fragment):
+        if fragment == 'fragment_3':
+            raise ValueError('bad fragment')
+        return read_fragment(fragment)
+
+    with pytest.raises(ValueError, match='bad fragment'):
+        run_fragment_pipeline([f'fragment_{i}' for i in range(20)], failing_read, written.append, prefetch=2,
+                              remove_fragments=False)
+    assert [pldf['fragment'][0] for pldf in written] == ['fragment_0', 'fragment_1', 'fragment_2']
+
+
+def test_every_fragment_is_written_in_order():
+    written = []
+    report = run_fragment_pipeline([f'fragment_{i}' for i in range(5)], read_fragment, written.append, prefetch=1,
+                                   remove_fragments=False)
+    assert [pldf['fragment'][0] for pldf in written] == [f'fragment_{i}' for i in range(5)]
+    assert report['batches'] == 5
@@ -0,0 +1,114 @@
+import re
+
+import pytest
+
+from full_refresh import finalise_shadow_table, load_staging_into_shadow, prepare_shadow_table, rollback_full_refresh
+
+
+class FakeMySQL:
+    """
+    just enough of MySQL for the shadow table statements: tables are a row count and a list of secondary indexes
+    """
+
+    def __init__(self, tables: dict):
+        self.tables = {name: dict(table) for name, table in tables.items()}
+        self.session = {'unique_checks': 1, 'foreign_key_checks': 1, 'transaction_isolation': 'REPEATABLE-READ'}
+        self.result = []
+        self.rowcount = -1
+        self.commits = 0
+
+    def execute(self, sql, params=None):
+        sql = ' '.join(sql.split())
+        if match := re.match(r'drop table if exists (\w+)', sql):
+            self.tables.pop(match[1], None)
+        elif match := re.match(r'create table (\w+) like (\w+)', sql):
+            self.tables[match[1]] = {'rows': 0, 'indexes': list(self.tables[match[2]]['indexes'])}
+        elif 'information_schema.statistics' in sql:
+            self.result = [(index, 1, index.split('_')[0], None, 'BTREE')
+                           for index in self.tables[params[0]]['indexes']]
+        elif match := re.match(r'alter table (\w+) (.*)', sql):
+            table = self.tables[match[1]]
+            for action, name in re.findall(r'(drop|add) (?:\w+ )?index `(\w+)`', match[2]):
+                if action == 'drop':
+                    table['indexes'].remove(name)
+                else:
+                    table['indexes'].append(name)
+        elif sql.startswith('select @@session'):
+            self.result = [tuple(self.session.values())]
+        elif match := re.match(r'set session (\w+) = (.*)', sql):
+            value = params[0] if params else match[2].strip("'")
+            self.session[match[1]] = int(value) if str(value).isdigit() else value
+        elif match := re.match(r'insert into (\w+) .*from (\w+)$', sql):
+            self.rowcount = self.tables[match[2]]['rows']
+            self.tables[match[1]]['rows'] += self.rowcount
+        elif match := re.match(r'select count\(\*\) from (\w+)', sql):
+            self.result = [(self.tables[match[1]]['rows'],)]
+        elif match := re.match(r'rename table (.*)', sql):
+            renames = [pair.split(' to ') for pair in match[1].split(', ')]
+            moved = {old: self.tables.pop(old) for old, _ in renames}
+            for old, new in renames:
+                self.tables[new] = moved[old]
+        else:
+            raise AssertionError(f'unexpected statement: {sql}')
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result[0]
+
+    def commit(self):
+        self.commits += 1
+
+
+def live_database(live_rows: int = 100, staging_rows: int = 100) -> FakeMySQL:
+    return FakeMySQL({'sirene_stocketab': {'rows': live_rows, 'indexes': ['geo_md5', 'company_number']},
+                      'sirene_stocketab_staging': {'rows': staging_rows, 'indexes': []}})
+
+
+def test_shadow_table_is_loaded_without_indexes_and_swapped_in():
+    mysql = live_database(live_rows=100, staging_rows=50)
+    state = prepare_shadow_table(mysql, mysql, 'sirene_stocketab')
+    assert mysql.tables['sirene_stocketab_shadow']['indexes'] == []
+    assert mysql.session['unique_checks'] == 0
+    for _ in range(2):
+        load_staging_into_shadow(mysql, mysql, state, 'sirene_stocketab_staging', '`siret`')
+    finalise_shadow_table(mysql, mysql, state)
+
+    assert mysql.tables['sirene_stocketab'] == {'rows': 100, 'indexes': ['geo_md5', 'company_number']}
+    assert mysql.tables['sirene_stocketab_old']['rows'] == 100
+    assert 'sirene_stocketab_shadow' not in mysql.tables
+    assert mysql.session['unique_checks'] == 1
+    assert mysql.session['transaction_isolation'] == 'REPEATABLE-READ'
+
+
+def test_small_shadow_table_is_not_swapped():
+    mysql = live_database(live_rows=100, staging_rows=50)
+    state = prepare_shadow_table(mysql, mysql, 'sirene_stocketab')
+    load_staging_into_shadow(mysql, mysql, state, 'sirene_stocketab_staging')
+    with pytest.raises(ValueError, match='less than 90%'):
+        finalise_shadow_table(mysql, mysql, state)
+    assert mysql.tables['sirene_stocketab']['rows'] == 100
+    assert 'sirene_stocketab_old' not in mysql.tables
+
+
+def test_lost_rows_stop_the_swap():
+    mysql = live_database()
+    state = prepare_shadow_table(mysql, mysql, 'sirene_stocketab')
+    load_staging_into_shadow(mysql, mysql, state, 'sirene_stocketab_staging')
+    state['loaded_rows'] += 1
+    with pytest.raises(ValueError, match='were loaded'):
+        finalise_shadow_table(mysql, mysql, state)
+
+
+def test_rollback_restores_the_previous_generation():
+    mysql = live_database(live_rows=100, staging_rows=120)
+    state = prepare_shadow_table(mysql, mysql, 'sirene_stocketab')
+    load_staging_into_shadow(mysql, mysql, state, 'sirene_stocketab_staging')
+    finalise_shadow_table(mysql, mysql, state)
+    assert mysql.tables['sirene_stocketab']['rows'] == 120
+
+    rollback_full_refresh(mysql, mysql, 'sirene_stocketab')
+    assert mysql.tables['sirene_stocketab']['rows'] == 100
+    assert mysql.tables['sirene_stocketab_shadow']['rows'] == 120
+    assert 'sirene_stocketab_old' not in mysql.tables
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import numpy as np
+import polars as pl
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geo_projection import lambert93_to_wgs84, add_wgs84_columns  # noqa: E402
+
+# (x, y, latitude, longitude), projected with PROJ's EPSG:2154 -> EPSG:4326
+reference_points = [
+    (700000.0, 6600000.0, 46.5, 3.0),  # projection origin
+    (652469.02, 6862035.26, 48.8566000, 2.3521999),  # Paris
+    (1045000.0, 6300000.0, 43.7148171, 7.2820960),  # Nice
+    (350000.0, 6750000.0, 47.7571314, -1.6742952),  # Ille-et-Vilaine
+    (1200000.0, 6150000.0, 42.2774427, 9.0568890),  # Corsica
+]
+
+
+@pytest.mark.parametrize('x, y, expected_latitude, expected_longitude', reference_points)
+def test_reference_points(x, y, expected_latitude, expected_longitude):
+    latitude, longitude = lambert93_to_wgs84(np.array([x]), np.array([y]))
+    assert latitude[0] == pytest.approx(expected_latitude, abs=1e-6)
+    assert longitude[0] == pytest.approx(expected_longitude, abs=1e-6)
+
+
+def test_placeholder_and_missing_coordinates_are_null():
+    pldf = pl.DataFrame({'LambertCoordinateX': ['652469.02', '0', None, '[ND]'],
+                         'LambertCoordinateY': ['6862035.26', '0', '6862035.26', '6862035.26']})
+    pldf = add_wgs84_columns(pldf, batch_size=2)
+    assert pldf['latitude'][0] == pytest.approx(48.8566, abs=1e-6)
+    assert pldf['latitude'][1:].null_count() == 3
+    assert pldf['longitude'][1:].null_count() == 3
@@ -0,0 +1,67 @@
+import os
+
+import polars as pl
+
+from head_office import build_report, report_path, resolve_head_offices, run_head_office
+from sinks import Sink
+from snapshot_store import write_snapshot
+
+etab = pl.DataFrame({
+    'siret': ['10000000100001', '10000000200001', '10000000300001', '10000000300002', '10000000400002',
+              '90000000100001', '10000000600001', '10000000600002'],
+    'company_number': ['100000001', '100000002', '100000003', '100000003', '100000004', '900000001', '100000006',
+                       '100000006'],
+    'RegisteredOfficeBool': ['true', 'false', 'false', 'true', 'false', 'true', 'true', 'true'],
+    'geo_md5': [f'geo{i}' for i in range(8)]})
+legal = pl.DataFrame({
+    'company_number': ['100000001', '100000002', '100000003', '100000004', '100000005', '100000006'],
+    'id': [f'org{i}' for i in range(1, 7)],
+    # 100000004 names a closed establishment, 100000005 has no nic, nics may have lost their leading zeros
+    'NICAssignment': ['1', '00001', '00001', '00001', None, '00001']})
+
+
+def statuses(mapping: pl.DataFrame) -> dict:
+    return dict(zip(mapping['company_number'], mapping['status']))
+
+
+def test_every_legal_unit_gets_a_status():
+    mapping, orphans = resolve_head_offices(etab.lazy(), legal.lazy())
+    assert statuses(mapping) == {'100000001': 'matched', '100000002': 'not_flagged_in_etab',
+                                 '100000003': 'flagged_elsewhere', '100000004': 'head_office_missing',
+                                 '100000005': 'no_nic', '100000006': 'matched'}
+    matched = mapping.filter(pl.col('company_number') == '100000001').row(0, named=True)
+    assert (matched['head_office_siret'], matched['geo_md5'], matched['organisation_id']) == \
+           ('10000000100001', 'geo0', 'org1')
+    assert orphans['company_number'].to_list() == ['900000001']
+
+    report = build_report(mapping, orphans, '2024-01', {})
+    assert report['counts']['unknown_legal_unit'] == 1
+    assert report['counts']['several_flagged'] == 1
+    assert report['samples']['flagged_elsewhere'][0]['flagged_siret'] == '10000000300002'
+
+
+class RecordingSink(Sink):
+    def __init__(self):
+        self.loads = []
+
+    def write_head_offices(self, pldf, month):
+        self.loads.append((month, pldf))
+
+
+def test_mapping_is_loaded_once_per_pair_of_snapshots(workdir):
+    sink = RecordingSink()
+    assert run_head_office(sink, '2024-01') is None
+    etab.write_csv('etab.csv')
+    legal.write_csv('legal.csv')
+    write_snapshot('etab', '2024-01', 'etab.csv')
+    write_snapshot('legal', '2024-01', 'legal.csv')
+
+    report = run_head_office(sink, '2024-01')
+    assert report['counts']['matched'] == 2
+    assert os.path.exists(report_path('2024-01'))
+    month, loaded = sink.loads[0]
+    assert month == '2024-01' and len(loaded) == 6 and 'flagged_count' not in loaded.columns
+
+    assert run_head_office(sink, '2024-01') is None
+    assert run_head_office(sink, '2024-01', force=True) is not None
+    assert len(sink.loads) == 2
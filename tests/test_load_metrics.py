@@ -0,0 +1,102 @@
+import json
+from decimal import Decimal
+
+from load_metrics import LoadMetrics, status_counters
+
+
+class FakeCursor:
+    """
+    a session whose status counters move as statements run, each show status itself writes one temporary row
+    """
+
+    def __init__(self, effects):
+        self.effects = effects
+        self.status = {name: 100 for name in status_counters}
+        self.lock_picoseconds = 0
+        self.rowcount = -1
+        self.result = []
+        self.warnings = []
+        self.inserted = []
+
+    def execute(self, sql, params=None):
+        if sql.startswith('show session status'):
+            self.status['Handler_write'] += 1
+            self.result = [(name, str(value)) for name, value in self.status.items()]
+        elif 'performance_schema' in sql:
+            self.result = [(Decimal(self.lock_picoseconds),)]
+        elif sql.startswith('show warnings'):
+            self.result = self.warnings
+        elif sql in self.effects:
+            effect = self.effects[sql]
+            self.rowcount = effect['rows']
+            for name, delta in effect.get('status', {}).items():
+                self.status[name] += delta
+            self.lock_picoseconds += int(effect.get('lock_seconds', 0) * 1e12)
+            self.warnings = effect.get('warnings', [])
+        else:
+            self.result = []
+
+    def executemany(self, sql, rows):
+        self.inserted.extend(rows)
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+
+class FakeDB:
+    def commit(self):
+        pass
+
+
+upsert = 'insert into sirene_stocketab select * from staging on duplicate key update x = values(x)'
+truncate = 'truncate table staging'
+
+
+def fake_cursor():
+    return FakeCursor({
+        upsert: {'rows': 5, 'status': {'Handler_write': 3, 'Handler_update': 1}, 'lock_seconds': 0.25,
+                 'warnings': [('Warning', 1265, f'Data truncated for column x at row {i}') for i in range(8)]},
+        truncate: {'rows': 0}})
+
+
+def test_execute_records_rows_warnings_and_session_deltas():
+    cursor = fake_cursor()
+    metrics = LoadMetrics(cursor, FakeDB(), 'etab', '2024-01')
+    # the status reads themselves write a temporary row, which is measured once and taken out of every delta
+    assert metrics.status_overhead['Handler_write'] == 1
+
+    assert metrics.execute('upsert', upsert) == 5
+    record = metrics.records[-1]
+    assert record['rows_affected'] == 5
+    assert record['status_delta']['Handler_write'] == 3
+    assert record['status_delta']['Handler_update'] == 1
+    assert record['status_delta']['Handler_delete'] == 0
+    assert record['status_delta']['lock_time_ms'] == 250
+    assert record['warning_count'] == 8
+    assert record['warnings'][0] == 'Warning 1265: Data truncated for column x at row 0'
+    assert len(record['warnings']) == 5
+
+
+def test_summary_totals_per_statement(workdir):
+    cursor = fake_cursor()
+    metrics = LoadMetrics(cursor, FakeDB(), 'etab', '2024-01')
+    for _ in range(2):
+        metrics.next_fragment()
+        metrics.execute('upsert', upsert)
+        metrics.execute('truncate_staging', truncate)
+
+    summary = metrics.summary()
+    assert summary['upsert']['count'] == 2
+    assert summary['upsert']['rows_affected'] == 10
+    assert summary['upsert']['warning_count'] == 16
+    assert summary['upsert']['status_delta']['lock_time_ms'] == 500
+    assert summary['truncate_staging']['status_delta']['Handler_write'] == 0
+
+    report_path = metrics.flush()
+    with open(report_path) as f:
+        report = json.load(f)
+    assert [record['fragment'] for record in report['statements']] == [1, 1, 2, 2]
+    assert len(cursor.inserted) == 4
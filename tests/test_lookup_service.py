@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import polars as pl
+import pytest
+
+from lookup_service import (KeyedArrays, LookupSnapshot, build_snapshot, latest_snapshot, parse_keys,
+                            write_keyed_arrays)
+
+
+def test_keyed_arrays_round_trip(tmp_path):
+    pldf = pl.DataFrame({'siren': [300, 100, None, 200, 100],
+                         'name': ['TROIS', 'UN', 'NONE', None, 'UN BIS'],
+                         'town': ['Orléans', 'Évry', '', 'Nîmes', 'Évry'],
+                         'latitude': [1.5, None, 0.0, 2.5, 3.5]})
+    # a slice starts part way into the arrow buffers
+    assert write_keyed_arrays(str(tmp_path), pldf.slice(0, 5), 'siren', {'name': 'name', 'town': 'town'},
+                              ['latitude', 'longitude']) == 3
+    arrays = KeyedArrays(str(tmp_path), 'siren', ['name', 'town'], ['latitude', 'longitude'])
+    assert arrays.find(np.array([100, 150, 300, 400, 50], dtype=np.int64)).tolist() == [0, -1, 2, -1, -1]
+    # the last of duplicate keys is kept, null strings and missing columns read back as empty or None
+    assert arrays.row(0) == {'name': 'UN BIS', 'town': 'Évry', 'latitude': 3.5, 'longitude': None}
+    assert arrays.row(1) == {'name': '', 'town': 'Nîmes', 'latitude': 2.5, 'longitude': None}
+
+
+def test_empty_arrays_find_nothing(tmp_path):
+    write_keyed_arrays(str(tmp_path), pl.DataFrame({'siren': pl.Series([], dtype=pl.Int64),
+                                                    'name': pl.Series([], dtype=pl.Utf8)}),
+                       'siren', {'name': 'name'}, [])
+    arrays = KeyedArrays(str(tmp_path), 'siren', ['name'], [])
+    assert arrays.find(np.array([1, 2], dtype=np.int64)).tolist() == [-1, -1]
+
+
+def write_sources(directory, name: str = 'BOULANGERIE MARTIN'):
+    pl.DataFrame({'company_number': ['100000001', '100000002'], 'LegalEntityName': [name, 'PHARMACIE'],
+                  'NAFCategory': ['10.71C', '47.73Z'], 'LegalCategory': ['5499', '5710'],
+                  'NICAssignment': ['00012', '']}).write_csv(os.path.join(directory, 'legal.csv'))
+    pl.DataFrame({'siret': ['10000000100012', '10000000100020', '10000000200011'],
+                  'AddressPostcode': ['75001', '75002', '13002'],
+                  'latitude': [48.86, None, 43.30], 'longitude': [2.34, None, 5.37]}) \
+        .write_csv(os.path.join(directory, 'etab.csv'))
+    return os.path.join(directory, 'etab.csv'), os.path.join(directory, 'legal.csv')
+
+
+def test_snapshot_lookups(tmp_path):
+    directory = build_snapshot('2024-01', *write_sources(str(tmp_path)), root=str(tmp_path / 'lookup'))
+    snapshot = LookupSnapshot(directory)
+    martin, pharmacie, unknown = snapshot.lookup_siren([100000001, 100000002, 100000003])
+    assert martin['name'] == 'BOULANGERIE MARTIN'
+    assert martin['head_office']['siret'] == '10000000100012'
+    assert martin['head_office']['latitude'] == 48.86
+    assert pharmacie['head_office'] is None
+    assert unknown is None
+
+    establishment, = snapshot.lookup_siret([10000000100020])
+    assert establishment['post_code'] == '75002' and establishment['latitude'] is None
+    assert establishment['legal_unit'] == {'name': 'BOULANGERIE MARTIN', 'naf': '10.71C', 'legal_category': '5499'}
+
+
+def test_rebuild_replaces_the_month_and_hides_partial_builds(tmp_path):
+    root = str(tmp_path / 'lookup')
+    etab_source, legal_source = write_sources(str(tmp_path))
+    build_snapshot('2024-01', etab_source, legal_source, root=root)
+    etab_source, legal_source = write_sources(str(tmp_path), name='MARTIN ET FILS')
+    directory = build_snapshot('2024-01', etab_source, legal_source, root=root)
+    assert LookupSnapshot(directory).lookup_siren([100000001])[0]['name'] == 'MARTIN ET FILS'
+    assert sorted(os.listdir(root)) == ['2024-01']
+
+    os.makedirs(os.path.join(root, '.2024-02.build.1'))
+    assert latest_snapshot(root) == directory
+
+
+def test_parse_keys():
+    assert parse_keys(['100 000 001', 100000002], 9) == [100000001, 100000002]
+    with pytest.raises(ValueError, match='is not a 14 digit number'):
+        parse_keys(['1000000010001'], 14)
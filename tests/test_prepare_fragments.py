@@ -0,0 +1,40 @@
+import os
+
+import polars as pl
+
+import snapshot_store
+import quality_profile
+from etab_main import prepare_etab_fragments, read_etab_fragment
+from legal_main import prepare_legal_fragments, read_legal_fragment
+
+
+def test_etab_clean_split_snapshot_uncached(workdir, etab_zip):
+    etab_zip('2024-01', n=300)
+    fragments = prepare_etab_fragments('2024-01-01-StockEtablissement_utf8.zip')
+    rows = pl.concat([read_etab_fragment(fragment) for fragment in fragments], how='diagonal')
+    # every third establishment is closed
+    assert len(rows) == 200
+    assert snapshot_store.read_index('etab', '2024-01')['rows'] == 200
+    assert os.path.exists(quality_profile.report_path('etab', '2024-01'))
+    assert not os.path.exists('StockEtablissement_clean.csv')
+
+
+def test_etab_second_run_reuses_the_cache(workdir, etab_zip):
+    etab_zip('2024-01', n=300)
+    first = prepare_etab_fragments('2024-01-01-StockEtablissement_utf8.zip')
+    first_rows = pl.concat([read_etab_fragment(fragment) for fragment in first], how='diagonal')
+    for fragment in first:
+        os.remove(fragment)
+    second = prepare_etab_fragments('2024-01-01-StockEtablissement_utf8.zip')
+    second_rows = pl.concat([read_etab_fragment(fragment) for fragment in second], how='diagonal')
+    assert first_rows.drop('last_modified_date').frame_equal(second_rows.drop('last_modified_date'))
+
+
+def test_legal_clean_split_snapshot_uncached(workdir, legal_zip):
+    legal_zip('2024-01', n=300)
+    fragments = prepare_legal_fragments('2024-01-01-StockUniteLegale_utf8.zip')
+    rows = pl.concat([read_legal_fragment(fragment) for fragment in fragments], how='diagonal')
+    assert len(rows) > 0
+    assert snapshot_store.read_index('legal', '2024-01')['rows'] == len(rows)
+    assert os.path.exists(quality_profile.report_path('legal', '2024-01'))
+    assert not os.path.exists('StockUniteLegale_clean.csv')
@@ -0,0 +1,75 @@
+import json
+
+import polars as pl
+
+import utils
+from quality_profile import (QualityProfile, apply_filter_rules, drift_flags, record_profile, report_path,
+                             sketch_size)
+
+rules = [('closed', pl.col('state') == 'A'), ('no_postcode', pl.col('postcode').is_not_null())]
+
+
+def frame(n: int, closed_every: int = 4) -> pl.DataFrame:
+    return pl.DataFrame({'state': ['F' if i % closed_every == 0 else 'A' for i in range(n)],
+                         'postcode': [None if i % 5 == 0 else '[ND]' if i % 5 == 1 else f'{i:05d}'
+                                      for i in range(n)]})
+
+
+def test_rules_count_each_row_against_its_first_failure():
+    profile = QualityProfile('etab')
+    kept = apply_filter_rules(frame(20), rules, profile)
+    # rows 0, 4, 8, 12 and 16 are closed, 5, 10 and 15 are open without a postcode, 0 only counts as closed
+    assert len(kept) == 12
+    assert profile.drops == {'closed': 5, 'no_postcode': 3}
+    assert profile.nulls['postcode'] == 4
+    assert profile.not_disclosed['postcode'] == 4
+    assert profile.not_disclosed['state'] == 0
+
+
+def test_profile_accumulates_over_frames():
+    profile = QualityProfile('etab')
+    for _ in range(2):
+        apply_filter_rules(frame(20), rules, profile)
+    report = profile.report()
+    assert (report['rows_in'], report['rows_out']) == (40, 24)
+    assert report['columns']['postcode'] == {'null_rate': 0.2, 'nd_rate': 0.2, 'distinct': 13}
+    assert report['columns']['state']['distinct'] == 2
+
+
+def test_distinct_count_is_estimated_above_the_sketch_size():
+    profile = QualityProfile('etab')
+    apply_filter_rules(pl.DataFrame({'siret': list(range(20000))}), [], profile)
+    assert len(profile.sketches['siret']) == sketch_size
+    assert abs(profile.distinct('siret') / 20000 - 1) < 0.15
+
+
+def report(rows_in=1000, closed=100, null_rate=0.1, distinct=500, columns=('postcode',)) -> dict:
+    return {'rows_in': rows_in, 'drops': {'closed': closed},
+            'columns': {column: {'null_rate': null_rate, 'nd_rate': 0.0, 'distinct': distinct} for column in columns}}
+
+
+def test_drift_flags_only_moves_beyond_the_thresholds():
+    assert drift_flags(report(rows_in=1050, null_rate=0.12, distinct=600), report()) == []
+    flags = drift_flags(report(rows_in=1200, closed=240, null_rate=0.3, distinct=100, columns=('siret',)), report())
+    assert flags == ['rows in 1000 -> 1200', 'closed drop rate 10.0% -> 20.0%', 'siret is new',
+                     'postcode is missing']
+    assert drift_flags(report(null_rate=0.3, distinct=100), report()) == ['postcode null_rate 10.0% -> 30.0%',
+                                                                         'postcode distinct 500 -> 100']
+
+
+def test_record_profile_compares_with_the_latest_earlier_month(workdir):
+    for month, n in [('2024-01', 200), ('2024-02', 200), ('2024-03', 400)]:
+        profile = QualityProfile('etab')
+        apply_filter_rules(frame(n, closed_every=4 if month < '2024-03' else 2), rules, profile)
+        profile.write()
+        recorded = record_profile('etab', month)
+    assert recorded['compared_with'] == '2024-02'
+    assert 'rows in 200 -> 400' in recorded['drift']
+    assert 'closed drop rate 25.0% -> 50.0%' in recorded['drift']
+
+    with open(report_path('etab', '2024-02')) as f:
+        assert json.load(f)['drift'] == []
+    utils.dispatcher.flush()
+    with open(workdir / 'messages.jsonl') as f:
+        messages = [json.loads(line) for line in f]
+    assert [message['title'] for message in messages] == ['Sirene etab data quality drift (2024-03)']
@@ -0,0 +1,62 @@
+import time
+
+import polars as pl
+
+from fragment_loader import run_fragment_pipeline
+from sinks import FanOutSink, Sink
+
+
+class TimedSink(Sink):
+    def __init__(self, name, seconds_per_write, lock_wait_per_write=0.0):
+        self.name = name
+        self.seconds_per_write = seconds_per_write
+        self.lock_wait_per_write = lock_wait_per_write
+        self.lock_wait = 0.0
+        self.rows = 0
+
+    def write_etab(self, pldf):
+        time.sleep(self.seconds_per_write)
+        self.lock_wait += self.lock_wait_per_write
+        self.rows += len(pldf)
+
+    def lock_wait_seconds(self):
+        return self.lock_wait
+
+
+def test_fan_out_batches_are_timed_at_the_slowest_target():
+    fast, slow = TimedSink('fast', 0.0, 0.1), TimedSink('slow', 0.3, 0.5)
+    sink = FanOutSink([fast, slow], max_pending=8)
+    sink.begin('etab', '2024-01')
+    try:
+        report = run_fragment_pipeline([f'fragment_{i}' for i in range(4)],
+                                       lambda fragment: pl.DataFrame({'siret': list(range(10))}),
+                                       sink.write_etab, remove_fragments=False,
+                                       lock_wait_seconds=sink.lock_wait_seconds, write_times=sink.write_times)
+    finally:
+        sink.close()
+    # the writes are only queued, so write_etab returns at once, but every batch took the slow target 0.3s
+    assert report['batches'] == 4
+    assert report['consumer_busy'] < 0.3
+    # the report waits for the queued batches
+    assert report['wall_time'] >= 1.2
+    assert slow.rows == fast.rows == 40
+    assert sink.lock_wait_seconds() == 2.0
+
+
+def test_fan_out_write_times_reports_each_batch_once():
+    fast, slow = TimedSink('fast', 0.0), TimedSink('slow', 0.2)
+    sink = FanOutSink([fast, slow])
+    sink.begin('etab', '2024-01')
+    try:
+        for _ in range(3):
+            sink.write_etab(pl.DataFrame({'siret': [1, 2]}))
+        times = sink.write_times(wait=True)
+        assert [rows for rows, _, _ in times] == [2, 2, 2]
+        assert min(seconds for _, seconds, _ in times) >= 0.2
+        assert sink.write_times() == []
+    finally:
+        sink.close()
+
+
+def test_synchronous_sinks_are_timed_by_the_caller():
+    assert Sink().write_times() is None
@@ -0,0 +1,73 @@
+import os
+
+import polars as pl
+
+import snapshot_store
+from snapshot_store import (apply_retention, available_months, diff_siren, lookup_at, read_index, read_siren,
+                            write_snapshot)
+
+
+def write_etab_csv(path, sirens: list, city: str = 'PARIS') -> str:
+    # three establishments per siren, out of key order
+    rows = [{'siret': f'{siren}{nic:05d}', 'company_number': str(siren), 'AddressMunicipalityLabel': city}
+            for nic in (3, 1, 2) for siren in sirens]
+    pl.DataFrame(rows).write_csv(path)
+    return str(path)
+
+
+def write_legal_csv(path, sirens: list, name: str = 'SOCIETE') -> str:
+    pl.DataFrame({'company_number': [str(siren) for siren in sirens],
+                  'LegalEntityName': [f'{name} {siren}' for siren in sirens]}).write_csv(path)
+    return str(path)
+
+
+def test_siren_rows_are_read_from_their_row_groups(workdir, monkeypatch):
+    monkeypatch.setattr(snapshot_store, 'row_group_rows', 10)
+    sirens = list(range(100000000, 100000040))
+    write_snapshot('etab', '2024-01', write_etab_csv(workdir / 'etab.csv', sirens))
+    index = read_index('etab', '2024-01')
+    assert index['rows'] == 120
+    assert len(index['row_groups']) == 12
+    assert all(low <= high for low, high, _ in index['row_groups'])
+
+    # the 4th siren's establishments straddle the first two row groups
+    rows = read_siren('etab', '2024-01', 100000003)
+    assert rows['siret'].to_list() == ['10000000300001', '10000000300002', '10000000300003']
+    assert read_siren('etab', '2024-01', 999999999).is_empty()
+
+
+def test_unchanged_source_is_not_rewritten(workdir):
+    source = write_legal_csv(workdir / 'legal.csv', [100000001])
+    path = write_snapshot('legal', '2024-01', source)
+    modified = os.path.getmtime(path)
+    write_snapshot('legal', '2024-01', source)
+    assert os.path.getmtime(path) == modified
+
+
+def test_lookup_and_diff_use_the_latest_snapshot_at_or_before_the_month(workdir):
+    write_snapshot('legal', '2024-01', write_legal_csv(workdir / 'jan.csv', [100000001, 100000002]))
+    write_snapshot('legal', '2024-03', write_legal_csv(workdir / 'mar.csv', [100000001], name='RENAMED'))
+    write_snapshot('etab', '2024-01', write_etab_csv(workdir / 'etab_jan.csv', [100000001]))
+    write_snapshot('etab', '2024-03', write_etab_csv(workdir / 'etab_mar.csv', [100000001], city='LYON'))
+
+    found = lookup_at(100000001, '2024-02')
+    assert found['legal']['month'] == '2024-01'
+    assert found['legal']['rows'][0]['LegalEntityName'] == 'SOCIETE 100000001'
+    assert lookup_at(100000001, '2023-12')['legal'] == {'month': None, 'rows': []}
+
+    diff = diff_siren(100000001, '2024-01', '2024-06')
+    assert diff['legal']['months'] == ['2024-01', '2024-03']
+    assert diff['legal']['changed'] == {'100000001': {'LegalEntityName': ['SOCIETE 100000001',
+                                                                           'RENAMED 100000001']}}
+    assert diff['etab']['changed']['10000000100001'] == {'AddressMunicipalityLabel': ['PARIS', 'LYON']}
+    assert diff_siren(100000002, '2024-01', '2024-03')['legal']['removed'] == ['100000002']
+
+
+def test_retention_keeps_the_newest_months(workdir):
+    for month in ['2024-01', '2024-02', '2024-03']:
+        write_snapshot('legal', month, write_legal_csv(workdir / f'{month}.csv', [100000001], name=month))
+    assert apply_retention(keep=2) == [('legal', '2024-01')]
+    assert available_months('legal') == ['2024-02', '2024-03']
+    # the newest month survives any size limit
+    apply_retention(keep=2, max_size_bytes=0)
+    assert available_months('legal') == ['2024-03']
@@ -0,0 +1,92 @@
+import multiprocessing
+import os
+
+import stage_cache
+from stage_cache import evict, file_digest, list_entries, load_digests, run_cached_stage
+
+
+def write(path, content: str) -> str:
+    with open(path, 'w') as f:
+        f.write(content)
+    return str(path)
+
+
+def read(path) -> str:
+    with open(path) as f:
+        return f.read()
+
+
+class CountedStage:
+    """
+    upper cases input.txt into output.txt, counting its runs
+    """
+
+    def __init__(self):
+        self.runs = 0
+
+    def __call__(self) -> str:
+        self.runs += 1
+        return write('output.txt', read('input.txt').upper())
+
+
+def test_second_run_restores_the_outputs(workdir):
+    write('input.txt', 'abc')
+    stage = CountedStage()
+    assert run_cached_stage('upper', stage, ['input.txt'], {}, [CountedStage]) == ['output.txt']
+    os.remove('output.txt')
+    assert run_cached_stage('upper', stage, ['input.txt'], {}, [CountedStage]) == ['output.txt']
+    assert stage.runs == 1
+    assert read('output.txt') == 'ABC'
+
+
+def test_inputs_and_params_are_part_of_the_key(workdir):
+    write('input.txt', 'abc')
+    stage = CountedStage()
+    run_cached_stage('upper', stage, ['input.txt'], {'n': 1}, [CountedStage])
+    run_cached_stage('upper', stage, ['input.txt'], {'n': 2}, [CountedStage])
+    write('input.txt', 'abd')
+    run_cached_stage('upper', stage, ['input.txt'], {'n': 2}, [CountedStage])
+    assert stage.runs == 3
+    assert read('output.txt') == 'ABD'
+    assert len(list_entries()) == 3
+
+
+def test_output_written_in_place_does_not_poison_the_cache(workdir):
+    write('input.txt', 'abc')
+    stage = CountedStage()
+    run_cached_stage('upper', stage, ['input.txt'], {}, [CountedStage])
+    # the working copy is hard linked to the cache entry, a writer opening it in place changes the entry too
+    with open('output.txt', 'w') as f:
+        f.write('overwritten')
+    os.remove('output.txt')
+    run_cached_stage('upper', stage, ['input.txt'], {}, [CountedStage])
+    assert stage.runs == 2
+    assert read('output.txt') == 'ABC'
+    run_cached_stage('upper', stage, ['input.txt'], {}, [CountedStage])
+    assert stage.runs == 2
+
+
+def hash_files(paths: list) -> None:
+    for path in paths:
+        file_digest(path)
+
+
+def test_concurrent_processes_keep_every_digest(workdir):
+    paths = [write(f'file_{i}.txt', str(i)) for i in range(60)]
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=hash_files, args=(paths[i::4],)) for i in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert len(load_digests()) == 60
+
+
+def test_evict_removes_the_least_recently_used(workdir):
+    write('input.txt', 'abc')
+    for n in range(3):
+        run_cached_stage('upper', CountedStage(), ['input.txt'], {'n': n}, [CountedStage])
+    evicted = evict(max_size_bytes=3)
+    assert [entry['params'] for entry in evicted] == [{'n': 0}, {'n': 1}]
+    assert [entry['params'] for entry in list_entries()] == [{'n': 2}]
+    assert os.path.isdir(stage_cache.cache_dir)
@@ -0,0 +1,41 @@
+from staging_schema import create_staging_table, staged_columns
+
+
+class FakeCursor:
+    def __init__(self, live_types):
+        self.live_types = live_types
+        self.statements = []
+        self.rows = []
+
+    def execute(self, statement, params=None):
+        self.statements.append(statement)
+        self.rows = list(self.live_types.items()) if 'information_schema.columns' in statement else []
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeDB:
+    def commit(self):
+        pass
+
+
+def created_columns(cursor) -> dict:
+    create = next(statement for statement in cursor.statements if statement.startswith('create table'))
+    body = create[create.index('(') + 1:create.rindex(')')].split(', key ')[0]
+    definitions = [definition.strip('`').split('` ') for definition in body.split(', `')]
+    return {column: definition for column, definition in definitions}
+
+
+def test_staging_takes_the_live_column_types():
+    cursor = FakeCursor({'company_number': 'varchar(9)', 'RegisteredOfficeBool': 'tinyint(1)',
+                         'AddressPostcode': b'varchar(10)', 'latitude': 'double'})
+    create_staging_table(cursor, FakeDB(), 'etab')
+    columns = created_columns(cursor)
+    assert columns['RegisteredOfficeBool'] == 'tinyint(1)'
+    assert columns['AddressPostcode'] == 'varchar(10)'
+    assert columns['latitude'] == 'double'
+    # columns the live table does not report keep their declaration, as do the dimension ids
+    assert columns['siret'] == 'varchar(14)'
+    assert columns['last_modified_date'] == 'datetime'
+    assert list(columns) == [column for column, _ in staged_columns('etab')]
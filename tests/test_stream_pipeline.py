@@ -0,0 +1,59 @@
+import io
+import zipfile
+
+import polars as pl
+import pytest
+
+import stream_pipeline
+from stream_pipeline import StreamingCSVBatches, ZipStreamInflater, iter_csv_frames, split_complete_rows
+
+csv_bytes = b'siret,note\n' + b''.join(f'{i},"row {i}\nsecond line, quoted"\n'.encode() for i in range(2000))
+
+
+def zip_bytes(compression: int) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression) as zip_file:
+        zip_file.writestr('StockEtablissement_utf8.csv', csv_bytes)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('compression', [zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED])
+def test_inflater_streams_the_first_member_in_small_chunks(compression):
+    data = zip_bytes(compression)
+    inflater = ZipStreamInflater()
+    # chunks smaller than the local header exercise the partial header path
+    output = b''.join(inflater.feed(data[i:i + 7]) for i in range(0, len(data), 7))
+    assert inflater.name == 'StockEtablissement_utf8.csv'
+    assert inflater.finished
+    assert output == csv_bytes
+
+
+def test_inflater_rejects_other_streams():
+    with pytest.raises(ValueError, match='not a zip file'):
+        ZipStreamInflater().feed(b'x' * 64)
+
+
+def test_complete_rows_end_outside_quotes():
+    buffer = b'1,"a\nb"\n2,"c\nd'
+    assert buffer[:split_complete_rows(buffer)] == b'1,"a\nb"\n'
+    assert split_complete_rows(b'1,"no newline yet') == 0
+    assert split_complete_rows(b'1,"a\nb') == 0
+
+
+def test_batches_parse_to_the_whole_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(stream_pipeline, 'download_chunk_size', 256)
+    (tmp_path / 'stock.zip').write_bytes(zip_bytes(zipfile.ZIP_DEFLATED))
+    batches = list(StreamingCSVBatches('stock.zip', batch_bytes=4096))
+    assert len(batches) > 5
+    assert all(batch.startswith(b'siret,note\n') for batch in batches)
+    frames = list(iter_csv_frames(batches, {}))
+    assert pl.concat(frames).frame_equal(pl.read_csv(io.BytesIO(csv_bytes)))
+
+
+def test_truncated_zip_raises(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = zip_bytes(zipfile.ZIP_DEFLATED)
+    (tmp_path / 'stock.zip').write_bytes(data[:len(data) // 2])
+    with pytest.raises(ValueError, match='ended before the end of the compressed data'):
+        list(StreamingCSVBatches('stock.zip', batch_bytes=4096))
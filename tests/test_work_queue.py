@@ -0,0 +1,65 @@
+import work_queue
+from work_queue import WorkQueue, describe_fragment, fragment_bytes, wait_for_run
+
+
+def publish(tmp_path, n: int = 2):
+    paths = []
+    for i in range(n):
+        path = tmp_path / f'fragment_{i}.csv'
+        path.write_text(f'siret\n{i}\n')
+        paths.append(str(path))
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite'))
+    run_id = queue.publish('etab', '2024-01', [describe_fragment(path) for path in paths])
+    return queue, run_id
+
+
+def test_descriptor_prepends_the_header_to_a_byte_range(tmp_path):
+    path = tmp_path / 'stock.csv'
+    path.write_bytes(b'siret\n1\n2\n3\n')
+    descriptor = describe_fragment(str(path), start=8, end=10, header_end=6)
+    assert fragment_bytes(descriptor) == b'siret\n2\n'
+
+
+def test_fragments_are_leased_once_and_acked(tmp_path):
+    queue, run_id = publish(tmp_path)
+    first, second = queue.lease('worker-a'), queue.lease('worker-b')
+    assert first['id'] != second['id']
+    assert queue.lease('worker-c') is None
+    queue.ack(first['id'], 'worker-a')
+    queue.fail(second['id'], 'worker-b', 'connection reset')
+    assert queue.progress(run_id) == {'pending': 1, 'leased': 0, 'done': 1, 'failed': 0}
+    assert queue.lease('worker-c')['id'] == second['id']
+
+
+def test_expired_leases_are_reclaimed_then_failed(tmp_path, monkeypatch):
+    monkeypatch.setattr(work_queue, 'lease_seconds', -1)
+    queue, run_id = publish(tmp_path, n=1)
+    for attempt in range(work_queue.max_attempts):
+        fragment = queue.lease(f'worker-{attempt}')
+        assert fragment['attempts'] == attempt
+        # a worker that died holding the lease cannot renew or ack it once it is reclaimed
+        queue.reclaim_expired()
+        assert not queue.renew(fragment['id'], f'worker-{attempt}')
+    assert queue.progress(run_id)['failed'] == 1
+    assert queue.failures(run_id)[0][3] == 'lease expired on every attempt'
+    assert queue.lease('worker-late') is None
+
+
+def test_wait_for_run_reclaims_leases_of_dead_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr(work_queue, 'lease_seconds', -1)
+    queue, run_id = publish(tmp_path, n=1)
+    for attempt in range(work_queue.max_attempts):
+        queue.lease(f'worker-{attempt}')
+        queue.reclaim_expired()
+    queue.lease('worker-dead')
+    # no worker is left, the coordinator's own reclaim ends the run
+    progress = wait_for_run(queue, run_id, poll_seconds=0.01, timeout_seconds=60)
+    assert progress['failed'] == 1
+
+
+def test_wait_for_run_abandons_a_stalled_run(tmp_path):
+    queue, run_id = publish(tmp_path)
+    queue.lease('worker-stalled')
+    progress = wait_for_run(queue, run_id, poll_seconds=0.01, timeout_seconds=0.05)
+    assert progress == {'pending': 0, 'leased': 0, 'done': 0, 'failed': 2}
+    assert {failure[3] for failure in queue.failures(run_id)} == {'run timed out, no worker loaded the fragment'}
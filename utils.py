@@ -1,7 +1,11 @@
 from datetime import datetime
 
+import atexit
+import functools
 import mysql.connector
 import os
+import queue
+import threading
 import requests
 import json
 import boto3
@@ -9,57 +13,208 @@ import time
 import re
 import logging
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
-def connect_preprod():
+def connect_mysql(env_prefix: str = 'preprod'):
+    """
+    connect to the database configured by <env_prefix>_host, <env_prefix>_admin_user, <env_prefix>_admin_pass
+    and <env_prefix>_database, e.g. preprod or prod
+    :param env_prefix:
+    :return: cursor, db
+    """
     db = mysql.connector.connect(
-        host=os.environ.get('preprod_host'),
-        user=os.environ.get('preprod_admin_user'),
-        passwd=os.environ.get('preprod_admin_pass'),
-        database=os.environ.get('preprod_database'),
+        host=os.environ.get(f'{env_prefix}_host'),
+        user=os.environ.get(f'{env_prefix}_admin_user'),
+        passwd=os.environ.get(f'{env_prefix}_admin_pass'),
+        database=os.environ.get(f'{env_prefix}_database'),
     )
 
     cursor = db.cursor()
     return cursor, db
 
+
+def connect_preprod():
+    return connect_mysql('preprod')
+
+
+def mysql_constring(env_prefix: str = 'preprod') -> str:
+    return f'mysql://{os.environ.get(f"{env_prefix}_admin_user")}:{os.environ.get(f"{env_prefix}_admin_pass")}' \
+           f'@{os.environ.get(f"{env_prefix}_host")}:3306/{os.environ.get(f"{env_prefix}_database")}'
+
+
 # required for polars
-constring = f'mysql://{os.environ.get("preprod_admin_user")}:{os.environ.get("preprod_admin_pass")}@{os.environ.get("preprod_host")}:3306/{os.environ.get("preprod_database")}'
+constring = mysql_constring('preprod')
 
-def pipeline_messenger(title, text, notification_type):
+messenger_colours = {
+    'pass': '#00c400',
+    'fail': '#c40000',
+    'notification': '#0000c4'
+}
+
+# a file:<path> url appends the cards to a local file instead, for tests and local runs
+messenger_url = os.environ.get(
+    'pipeline_messenger_url',
+    "https://tdworldwide.webhook.office.com/webhookb2/d5d1f4d1-2858-48a6-8156-5abf78a31f9b@7fe14ab6-8f5d-4139-84bf-cd8aed0ee6b9/IncomingWebhook/76b5bd9cd81946338da47e0349ba909d/c5995f3f-7ce7-4f13-8dba-0b4a7fc2c546")
+
+
+class MessageDispatcher:
+    """
+    sends pipeline notifications from a background thread so a slow or unreachable webhook never holds up a run.
+    messages with the same title and type queued within coalesce_seconds of each other are sent as one card,
+    each post has a timeout and is retried with backoff, and anything still queued is flushed at exit
+    """
+
+    def __init__(self, url: str, timeout: float = 10, retries: int = 3, backoff: float = 2,
+                 coalesce_seconds: float = 2):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.coalesce_seconds = coalesce_seconds
+        self.queue = queue.Queue()
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def _ensure_started(self) -> None:
+        # a forked worker process does not inherit the parent's thread, so start one per process
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.queue = queue.Queue()
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def send(self, title: str, text: str, notification_type: str) -> None:
+        self._ensure_started()
+        self.queue.put((title, text, notification_type))
+
+    def retry_seconds(self) -> float:
+        """
+        :return: longest time a single post can take, every attempt timing out and backing off in between
+        """
+        return self.retries * self.timeout + sum(self.backoff ** attempt for attempt in range(1, self.retries))
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        wait until every queued message has been sent or given up on
+        :param timeout: defaults to long enough for every queued message to exhaust its retries
+        :return: False if messages were still queued after timeout seconds
+        """
+        if self.thread is None or self.pid != os.getpid():
+            return True
+        if timeout is None:
+            timeout = self.coalesce_seconds + self.retry_seconds() * max(self.queue.qsize(), 1)
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def _run(self) -> None:
+        while True:
+            messages = [self.queue.get()]
+            # gather whatever else arrives within the coalescing window
+            deadline = time.time() + self.coalesce_seconds
+            while not isinstance(messages[-1], threading.Event) and (remaining := deadline - time.time()) > 0:
+                try:
+                    messages.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
 
+            flush_events = [message for message in messages if isinstance(message, threading.Event)]
+            grouped = {}
+            for message in messages:
+                if not isinstance(message, threading.Event):
+                    title, text, notification_type = message
+                    grouped.setdefault((title, notification_type), []).append(text)
+            for (title, notification_type), texts in grouped.items():
+                if len(texts) > 1:
+                    title = f'{title} ({len(texts)} messages)'
+                # whatever goes wrong with one message, the thread carries on with the rest
+                try:
+                    self._post(title, '\n\n'.join(texts), notification_type)
+                except Exception as e:
+                    logger.error(f'notification {title} dropped: {e!r}')
+            for event in flush_events:
+                event.set()
 
-    messenger_colours = {
-        'pass': '#00c400',
-        'fail': '#c40000',
-        'notification': '#0000c4'
-    }
+    def _post(self, title: str, text: str, notification_type: str) -> None:
+        payload = json.dumps({
+            "@type": "MessageCard",
+            "themeColor": messenger_colours[notification_type],
+            "title": title,
+            "text": text,
+            "markdown": True
+        })
+        if self.url.startswith('file:'):
+            with open(self.url[len('file:'):], 'a') as f:
+                f.write(payload + '\n')
+            return
 
+        headers = {
+            'Content-Type': 'application/json'
+        }
+        for attempt in range(1, self.retries + 1):
+            try:
+                r = requests.request("POST", self.url, headers=headers, data=payload, timeout=self.timeout)
+                if r.status_code < 500:
+                    if r.status_code >= 400:
+                        logger.error(f'notification {title} rejected with status {r.status_code}')
+                    return
+                logger.warning(f'notification {title} failed with status {r.status_code}, attempt {attempt}')
+            except requests.exceptions.RequestException as e:
+                logger.warning(f'notification {title} failed with {e}, attempt {attempt}')
+            if attempt < self.retries:
+                time.sleep(self.backoff ** attempt)
+        logger.error(f'notification {title} dropped after {self.retries} attempts')
+
+
+dispatcher = MessageDispatcher(messenger_url)
+atexit.register(dispatcher.flush)
+
+
+def pipeline_messenger(title, text, notification_type):
+    """
+    queue a notification card, it is sent in the background by the dispatcher
+    :param title:
+    :param text:
+    :param notification_type: pass, fail or notification
+    :return:
+    """
     if notification_type not in messenger_colours.keys():
         raise ValueError(f'Invalid notification type: {notification_type}')
+    dispatcher.send(title, text, notification_type)
+
+
+# multipart transfers of the multi-GB stock files, parts are sent on max_concurrency threads
+transfer_config = TransferConfig(multipart_threshold=64 * 1024 * 1024,
+                                 multipart_chunksize=64 * 1024 * 1024,
+                                 max_concurrency=10,
+                                 use_threads=True)
+
 
-    url = "https://tdworldwide.webhook.office.com/webhookb2/d5d1f4d1-2858-48a6-8156-5abf78a31f9b@7fe14ab6-8f5d-4139-84bf-cd8aed0ee6b9/IncomingWebhook/76b5bd9cd81946338da47e0349ba909d/c5995f3f-7ce7-4f13-8dba-0b4a7fc2c546"
-    payload = json.dumps({
-        "@type": "MessageCard",
-        "themeColor": messenger_colours[notification_type],
-        "title": title,
-        "text": text,
-        "markdown": True
-    })
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    requests.request("POST", url, headers=headers, data=payload)
+@functools.lru_cache(maxsize=None)
+def s3_client() -> boto3.client:
+    """
+    one client per process, shared by every transfer. set aws_endpoint_url to use MinIO or another
+    S3 compatible store
+    :return:
+    """
+    return boto3.client('s3',
+                        aws_access_key_id=os.environ.get('aws_access_key_id_data_services'),
+                        aws_secret_access_key=os.environ.get('aws_secret_key_data_services'),
+                        region_name=os.environ.get('aws_region'),
+                        endpoint_url=os.environ.get('aws_endpoint_url'),
+                        config=Config(max_pool_connections=50, retries={'max_attempts': 5, 'mode': 'adaptive'})
+                        )
 
 
 def create_s3_connection() -> boto3.client:
-    s3client = boto3.client('s3',
-                            aws_access_key_id=os.environ.get('aws_access_key_id_data_services'),
-                            aws_secret_access_key=os.environ.get('aws_secret_key_data_services'),
-                            region_name=os.environ.get('aws_region')
-                            )
-    buckets = s3client.list_buckets()
-    return s3client
+    return s3_client()
 
 
 def download_file(client: boto3, filename: str, target_bucket: str, local_folder: str='') -> None:
@@ -77,23 +232,26 @@ def download_file(client: boto3, filename: str, target_bucket: str, local_folder
                                                                                               filename))
     t0 = time.time()
     destination_folder = local_folder + '/' + filename
-    client.download_file(Filename=destination_folder, Bucket=target_bucket, Key=filename)
+    client.download_file(Filename=destination_folder, Bucket=target_bucket, Key=filename, Config=transfer_config)
     t1 = time.time()
     logger.info(f'download took {round(t1 - t0)} seconds')
 
 
-def upload_file(client: boto3.client, filename: str, target_bucket: str) -> None:
+def upload_file(client: boto3.client, filename: str, target_bucket: str, key: str = None) -> None:
     """
     send a file to s3 bucket
     :param target_bucket:
     :param client:
     :param filename:
+    :param key: defaults to the file name without its folders
     :return:
     """
 
     # remove folders to provide just filename when uploading
     target_file_name = re.search(r".*/([^/]+)$", filename)
-    if target_file_name:
+    if key:
+        target_file_name = key
+    elif target_file_name:
         target_file_name = target_file_name.group(1)
     else:
         target_file_name = filename
@@ -101,10 +259,56 @@ def upload_file(client: boto3.client, filename: str, target_bucket: str) -> None
     logger.info('uploading {} to {} as {}'.format(filename, target_bucket, target_file_name))
 
     t0 = time.time()
-    client.upload_file(Filename=filename, Bucket=target_bucket, Key=target_file_name)
+    client.upload_file(Filename=filename, Bucket=target_bucket, Key=target_file_name, Config=transfer_config)
     t1 = time.time()
     logger.info(f'upload took {round(t1 - t0)} seconds, check {target_bucket} for {target_file_name}')
 
+
+def transfer_batch(transfers: list, max_workers: int = 4, client: boto3.client = None) -> dict:
+    """
+    run many uploads and downloads in parallel, each of them multipart with transfer_config
+    :param transfers: dicts with direction (upload or download), filename, bucket and key
+    :param max_workers: files transferred at the same time
+    :param client: defaults to s3_client()
+    :return: files, bytes, seconds, throughput in MB/s and the transfers that failed
+    """
+    client = client or s3_client()
+
+    def transfer(item: dict) -> int:
+        if item['direction'] == 'upload':
+            client.upload_file(Filename=item['filename'], Bucket=item['bucket'], Key=item['key'],
+                               Config=transfer_config)
+        elif item['direction'] == 'download':
+            if os.path.dirname(item['filename']):
+                os.makedirs(os.path.dirname(item['filename']), exist_ok=True)
+            client.download_file(Filename=item['filename'], Bucket=item['bucket'], Key=item['key'],
+                                 Config=transfer_config)
+        else:
+            raise ValueError(f'Invalid transfer direction: {item["direction"]}')
+        return os.path.getsize(item['filename'])
+
+    t0 = time.time()
+    transferred_bytes = 0
+    transferred_files = 0
+    failures = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(transfer, item): item for item in transfers}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                transferred_bytes += future.result()
+                transferred_files += 1
+            except Exception as e:
+                logger.error(f'{item["direction"]} of {item["filename"]} to {item["bucket"]}/{item["key"]} failed: {e}')
+                failures.append({**item, 'error': str(e)})
+    seconds = time.time() - t0
+    throughput = transferred_bytes / 1e6 / seconds if seconds else 0
+    logger.info(f'{transferred_files} files, {transferred_bytes / 1e6:.1f} MB transferred in {round(seconds, 2)} '
+                f'seconds ({throughput:.1f} MB/s), {len(failures)} failed')
+    return {'files': transferred_files, 'bytes': transferred_bytes, 'seconds': seconds,
+            'throughput_mb_s': throughput, 'failures': failures}
+
+
 def return_file_date() -> str:
     """
     get the date for a file, where the day is the 1st.
@@ -125,4 +329,4 @@ def unzip_file(filename: str) -> str:
         zip_ref.close()
     return output
 if __name__ == '__main__':
-    upload_file(s3_conn, filename, 'iqblade-data-services-sirene-incoming-files')
+    upload_file(create_s3_connection(), filename, 'iqblade-data-services-sirene-incoming-files')
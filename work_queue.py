@@ -0,0 +1,459 @@
+"""
+coordinator/worker mode, spreading the fragments of the stock files over several nodes
+
+    python work_queue.py coordinate --queue /shared/work_queue.sqlite --kinds etab legal
+    python work_queue.py work --queue /shared/work_queue.sqlite --sink mysql
+
+the coordinator downloads, cleans and splits each file as a normal run does, in a working directory every node
+can read, and publishes a descriptor per fragment to a durable queue: the path, the byte range to read (the
+header up to header_end, then start to end) and the sha256 of those bytes. workers lease one fragment at a
+time, check its checksum, write it through their sink and acknowledge it. a worker renews its lease while it
+works, so a lease that expires means the worker died: the fragment goes back to the queue for another worker,
+and is marked failed once it has been leased max_attempts times. the coordinator reclaims expired leases too
+while it waits, and fails whatever is left after run_timeout_seconds, so a run whose workers all died still
+ends. the loads are upserts, so a fragment written twice after a worker died between its write and its
+acknowledgement does no harm.
+
+once every fragment of a file is acknowledged the coordinator runs the whole-file steps through finish (the
+stale key sync), records the applied version and removes the fragments.
+
+the queue is a SQLite file, which needs a filesystem with working locks: a local disk when the workers are
+processes on one host, NFS v4 or EFS across hosts
+"""
+import argparse
+import datetime
+import hashlib
+import io
+import logging
+import mmap
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from download_files import wait_for_publication, record_applied_version
+from etab_main import prepare_etab_fragments, read_etab_fragment, etab_filestring
+from legal_main import prepare_legal_fragments, read_legal_fragment, legal_filestring
+from sinks import create_sink
+from utils import pipeline_messenger
+
+format_str = "[%(levelname)s: %(lineno)d] %(message)s"
+logging.basicConfig(level=logging.INFO, format=format_str)
+logger = logging.getLogger(__name__)
+
+queue_path = os.environ.get('sirene_queue_path', 'work_queue.sqlite')
+lease_seconds = 900
+max_attempts = 3
+run_timeout_seconds = float(os.environ.get('sirene_queue_run_timeout_hours', 12)) * 3600
+
+
+def fragment_bytes(descriptor: dict) -> bytes:
+    """
+    header and rows of a fragment descriptor
+    :param descriptor: path, header_end, start and end
+    :return:
+    """
+    with open(descriptor['path'], 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return mm[:descriptor['header_end']] + mm[descriptor['start']:descriptor['end']]
+
+
+def describe_fragment(path: str, start: int = 0, end: int = None, header_end: int = 0) -> dict:
+    """
+    descriptor of a byte range of a csv, by default the whole of a fragment file
+    :param path:
+    :param start:
+    :param end: defaults to the end of the file
+    :param header_end: end of the header to prepend, 0 when the range already starts with it
+    :return:
+    """
+    descriptor = {'path': os.path.abspath(path), 'header_end': header_end, 'start': start,
+                  'end': os.path.getsize(path) if end is None else end}
+    descriptor['checksum'] = hashlib.sha256(fragment_bytes(descriptor)).hexdigest()
+    return descriptor
+
+
+class WorkQueue:
+    """
+    fragment queue in a SQLite file shared by the coordinator and the workers
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or queue_path
+        # every statement is its own transaction unless begun explicitly, leases take the write lock up front
+        self.con = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.con.executescript(
+            """
+            create table if not exists runs (
+            run_id text primary key,
+            kind text not null,
+            month text not null,
+            published_at text,
+            finished_at text);
+
+            create table if not exists fragments (
+            id integer primary key autoincrement,
+            run_id text not null,
+            kind text not null,
+            month text not null,
+            path text not null,
+            header_end integer not null,
+            start integer not null,
+            end integer not null,
+            checksum text not null,
+            state text not null default 'pending',
+            worker text,
+            lease_expires real,
+            attempts integer not null default 0,
+            error text,
+            updated_at real);
+
+            create index if not exists fragments_state on fragments (state, id);
+            """
+        )
+
+    def publish(self, kind: str, month: str, descriptors: list) -> str:
+        """
+        :param kind: etab or legal
+        :param month: YYYY-MM
+        :param descriptors: output of describe_fragment, in load order
+        :return: run id
+        """
+        run_id = f'{month}_{kind}_{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}'
+        self.con.execute('begin immediate')
+        self.con.execute("""insert into runs (run_id, kind, month, published_at) values (?, ?, ?, ?)""",
+                         (run_id, kind, month, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        self.con.executemany(
+            """
+            insert into fragments (run_id, kind, month, path, header_end, start, end, checksum, updated_at)
+            values (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [(run_id, kind, month, d['path'], d['header_end'], d['start'], d['end'], d['checksum'], time.time())
+             for d in descriptors])
+        self.con.execute('commit')
+        logger.info(f'published {len(descriptors)} {kind} fragments as {run_id}')
+        return run_id
+
+    def lease(self, worker: str):
+        """
+        lease the oldest pending fragment, expired leases are put back in the queue first
+        :param worker:
+        :return: the fragment as a dict, None when there is nothing to do
+        """
+        now = time.time()
+        self.con.execute('begin immediate')
+        try:
+            self._expire_leases(now)
+            row = self.con.execute(
+                """
+                select id, run_id, kind, month, path, header_end, start, end, checksum, attempts
+                from fragments where state = 'pending' order by id limit 1
+                """).fetchone()
+            if row is None:
+                self.con.execute('commit')
+                return None
+            fragment = dict(zip(['id', 'run_id', 'kind', 'month', 'path', 'header_end', 'start', 'end',
+                                 'checksum', 'attempts'], row))
+            self.con.execute(
+                """
+                update fragments set state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1,
+                updated_at = ? where id = ?
+                """, (worker, now + lease_seconds, now, fragment['id']))
+            self.con.execute('commit')
+        except Exception:
+            self.con.execute('rollback')
+            raise
+        return fragment
+
+    def _expire_leases(self, now: float) -> None:
+        """
+        put fragments whose lease has expired back in the queue, or mark them failed once they have used up their
+        attempts. runs inside the caller's transaction
+        :param now:
+        :return:
+        """
+        expired = self.con.execute(
+            """select id, worker, attempts from fragments where state = 'leased' and lease_expires < ?""",
+            (now,)).fetchall()
+        if not expired:
+            return
+        self.con.execute(
+            """
+            update fragments set state = case when attempts >= ? then 'failed' else 'pending' end,
+            error = case when attempts >= ? then 'lease expired on every attempt' else 'lease expired' end,
+            lease_expires = null, updated_at = ?
+            where state = 'leased' and lease_expires < ?
+            """, (max_attempts, max_attempts, now, now))
+        for fragment_id, worker, attempts in expired:
+            logger.warning(f'lease of fragment {fragment_id} held by {worker} expired, '
+                           f'{"failed" if attempts >= max_attempts else "back in the queue"}')
+
+    def reclaim_expired(self) -> None:
+        self.con.execute('begin immediate')
+        try:
+            self._expire_leases(time.time())
+            self.con.execute('commit')
+        except Exception:
+            self.con.execute('rollback')
+            raise
+
+    def abandon_run(self, run_id: str, error: str) -> int:
+        """
+        mark every fragment of a run that is not done as failed
+        :return: number of fragments abandoned
+        """
+        cursor = self.con.execute(
+            """
+            update fragments set state = 'failed', error = ?, lease_expires = null, updated_at = ?
+            where run_id = ? and state in ('pending', 'leased')
+            """, (error, time.time(), run_id))
+        return cursor.rowcount
+
+    def renew(self, fragment_id: int, worker: str) -> bool:
+        """
+        :return: False if the lease has been lost to another worker
+        """
+        cursor = self.con.execute(
+            """
+            update fragments set lease_expires = ?, updated_at = ?
+            where id = ? and worker = ? and state = 'leased'
+            """, (time.time() + lease_seconds, time.time(), fragment_id, worker))
+        return cursor.rowcount == 1
+
+    def ack(self, fragment_id: int, worker: str) -> None:
+        self.con.execute(
+            """update fragments set state = 'done', updated_at = ? where id = ? and worker = ?""",
+            (time.time(), fragment_id, worker))
+
+    def fail(self, fragment_id: int, worker: str, error: str) -> None:
+        """
+        give a fragment back to the queue, or mark it failed once it has had max_attempts
+        """
+        self.con.execute(
+            """
+            update fragments set state = case when attempts >= ? then 'failed' else 'pending' end,
+            error = ?, lease_expires = null, updated_at = ? where id = ? and worker = ?
+            """, (max_attempts, error[:2000], time.time(), fragment_id, worker))
+
+    def progress(self, run_id: str) -> dict:
+        """
+        :return: number of fragments of the run in each state
+        """
+        counts = dict(self.con.execute("""select state, count(*) from fragments where run_id = ? group by state""",
+                                       (run_id,)).fetchall())
+        return {state: counts.get(state, 0) for state in ('pending', 'leased', 'done', 'failed')}
+
+    def failures(self, run_id: str) -> list:
+        return self.con.execute(
+            """select path, start, end, error from fragments where run_id = ? and state = 'failed'""",
+            (run_id,)).fetchall()
+
+    def close_run(self, run_id: str) -> None:
+        self.con.execute("""update runs set finished_at = ? where run_id = ?""",
+                         (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), run_id))
+
+    def close(self) -> None:
+        self.con.close()
+
+
+def wait_for_run(queue: WorkQueue, run_id: str, poll_seconds: float = 30, timeout_seconds: float = None) -> dict:
+    """
+    block until every fragment of a run is done or failed. expired leases are reclaimed here as well as by the
+    workers, so the run ends even if every worker has died
+    :param queue:
+    :param run_id:
+    :param poll_seconds:
+    :param timeout_seconds: fail the fragments still pending or leased after this long, default run_timeout_seconds
+    :return: final progress
+    """
+    deadline = time.time() + (timeout_seconds or run_timeout_seconds)
+    last_progress = None
+    while True:
+        queue.reclaim_expired()
+        if time.time() > deadline:
+            abandoned = queue.abandon_run(run_id, 'run timed out, no worker loaded the fragment')
+            if abandoned:
+                logger.error(f'{run_id} timed out, {abandoned} fragments abandoned')
+        progress = queue.progress(run_id)
+        if progress != last_progress:
+            logger.info(f'{run_id}: {progress["done"]} done, {progress["leased"]} leased, '
+                        f'{progress["pending"]} pending, {progress["failed"]} failed')
+            last_progress = progress
+        if progress['pending'] == 0 and progress['leased'] == 0:
+            return progress
+        time.sleep(poll_seconds)
+
+
+def coordinate(kinds: tuple = ('etab', 'legal'), month: str = None, sink_spec: str = 'mysql', path: str = None,
+               pipelined: bool = False, force: bool = False, wait_seconds: float = 0,
+               poll_seconds: float = 30, timeout_seconds: float = None) -> dict:
+    """
+    prepare and publish the fragments of each file, then run the whole-file steps as each one completes.
+    every file is published before the first is waited on, so legal is prepared while the workers load etab
+    :param kinds:
+    :param month: YYYY-MM, defaults to the current month
+    :param sink_spec: the coordinator's own sink, used for begin and finish
+    :param path: queue file
+    :param pipelined:
+    :param force: publish files that are unchanged since they were last loaded
+    :param wait_seconds: keep probing for this long if a file has not been published yet
+    :param poll_seconds:
+    :param timeout_seconds: how long to wait for the workers to finish a run, default run_timeout_seconds
+    :return: final progress of each run
+    """
+    month = month or datetime.datetime.now().strftime('%Y-%m')
+    queue = WorkQueue(path)
+    sink = create_sink(sink_spec)
+    published = []
+    results = {}
+    try:
+        for kind in kinds:
+            filestring = etab_filestring(month) if kind == 'etab' else legal_filestring(month)
+            probe = wait_for_publication(filestring, max_wait_seconds=wait_seconds)
+            if not probe['changed'] and not force:
+                logger.info(f'{filestring} is unchanged since it was last loaded, skipping')
+                continue
+            prepare_fragments = prepare_etab_fragments if kind == 'etab' else prepare_legal_fragments
+            list_of_fragments = prepare_fragments(filestring, pipelined=pipelined,
+                                                  remote_version=probe['etag'] or probe['last_modified'])
+            sink.begin(kind, month)
+            run_id = queue.publish(kind, month, [describe_fragment(fragment) for fragment in list_of_fragments])
+            published.append((kind, filestring, probe, run_id, list_of_fragments))
+
+        for kind, filestring, probe, run_id, list_of_fragments in published:
+            t0 = time.time()
+            progress = wait_for_run(queue, run_id, poll_seconds, timeout_seconds)
+            results[run_id] = progress
+            if progress['failed']:
+                failures = queue.failures(run_id)
+                pipeline_messenger(
+                    title=f'Sirene work queue {kind} run has failed',
+                    text=f'{progress["failed"]} of {len(list_of_fragments)} fragments failed in {run_id}, '
+                         f'first: {failures[0]}',
+                    notification_type='fail'
+                )
+                continue
+            sink.finish(kind)
+            record_applied_version(filestring, probe)
+            queue.close_run(run_id)
+            for fragment in list_of_fragments:
+                if os.path.exists(fragment):
+                    os.remove(fragment)
+            pipeline_messenger(
+                title=f'Sirene work queue {kind} run has finished',
+                text=f'{progress["done"]} fragments loaded in {round(time.time() - t0)} seconds after publishing',
+                notification_type='pass'
+            )
+    finally:
+        sink.close()
+        queue.close()
+    return results
+
+
+def keep_lease(path: str, fragment_id: int, worker: str, stop: threading.Event) -> None:
+    """
+    renew a lease every third of lease_seconds until stopped, in a thread with its own connection
+    """
+    queue = WorkQueue(path)
+    try:
+        while not stop.wait(lease_seconds / 3):
+            if not queue.renew(fragment_id, worker):
+                logger.warning(f'lease of fragment {fragment_id} was lost')
+                return
+    finally:
+        queue.close()
+
+
+def work(sink_spec: str = 'mysql', path: str = None, exit_when_empty: bool = False,
+         idle_seconds: float = 30) -> int:
+    """
+    lease, load and acknowledge fragments until the queue is empty
+    :param sink_spec:
+    :param path: queue file
+    :param exit_when_empty: return once there is nothing to lease, otherwise keep polling
+    :param idle_seconds: wait between polls of an empty queue
+    :return: number of fragments loaded
+    """
+    worker = f'{socket.gethostname()}-{os.getpid()}'
+    queue = WorkQueue(path)
+    sink = create_sink(sink_spec)
+    joined = set()
+    loaded = 0
+    logger.info(f'worker {worker} polling {queue.path}')
+    try:
+        while True:
+            fragment = queue.lease(worker)
+            if fragment is None:
+                # nothing to do, hand back the per-file state so metrics are not held across months
+                for kind, month in joined:
+                    sink.leave(kind)
+                joined.clear()
+                if exit_when_empty:
+                    break
+                time.sleep(idle_seconds)
+                continue
+
+            stop = threading.Event()
+            lease_keeper = threading.Thread(target=keep_lease, args=(queue.path, fragment['id'], worker, stop),
+                                            daemon=True)
+            lease_keeper.start()
+            try:
+                t0 = time.time()
+                data = fragment_bytes(fragment)
+                if hashlib.sha256(data).hexdigest() != fragment['checksum']:
+                    raise ValueError(f'checksum mismatch for {fragment["path"]} [{fragment["start"]}:'
+                                     f'{fragment["end"]}]')
+                kind, month = fragment['kind'], fragment['month']
+                if (kind, month) not in joined:
+                    for other_kind, other_month in [key for key in joined if key[0] == kind]:
+                        sink.leave(other_kind)
+                        joined.discard((other_kind, other_month))
+                    sink.join(kind, month, worker)
+                    joined.add((kind, month))
+                if kind == 'etab':
+                    sink.write_etab(read_etab_fragment(io.BytesIO(data)))
+                else:
+                    sink.write_legal(read_legal_fragment(io.BytesIO(data)))
+                queue.ack(fragment['id'], worker)
+                loaded += 1
+                logger.info(f'{kind} fragment {fragment["id"]} loaded in {round(time.time() - t0, 2)} seconds')
+            except Exception as e:
+                logger.error(f'fragment {fragment["id"]} failed on attempt {fragment["attempts"] + 1}: {e}')
+                queue.fail(fragment['id'], worker, f'{type(e).__name__}: {e}')
+            finally:
+                stop.set()
+                lease_keeper.join()
+    finally:
+        for kind, month in joined:
+            sink.leave(kind)
+        sink.close()
+        queue.close()
+    logger.info(f'worker {worker} loaded {loaded} fragments')
+    return loaded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='distribute the sirene fragments over several workers')
+    parser.add_argument('role', choices=['coordinate', 'work'])
+    parser.add_argument('--queue', default=queue_path, help='SQLite queue file, on storage every node can reach')
+    parser.add_argument('--sink', default='mysql',
+                        help='where to write the cleaned fragments: mysql, mysql:<env prefix>, duckdb:<path> or '
+                             'parquet:<directory>, several comma separated sinks are loaded from one parse')
+    parser.add_argument('--kinds', nargs='+', choices=['etab', 'legal'], default=['etab', 'legal'],
+                        help='coordinator: files to publish')
+    parser.add_argument('--month', help='coordinator: YYYY-MM, defaults to the current month')
+    parser.add_argument('--pipelined', action='store_true')
+    parser.add_argument('--force', action='store_true')
+    parser.add_argument('--wait-hours', type=float, default=0)
+    parser.add_argument('--run-timeout-hours', type=float, default=run_timeout_seconds / 3600,
+                        help='coordinator: fail the fragments of a file still not loaded after this long')
+    parser.add_argument('--exit-when-empty', action='store_true',
+                        help='worker: stop once there is nothing left to lease')
+    args = parser.parse_args()
+
+    if args.role == 'coordinate':
+        coordinate(tuple(args.kinds), month=args.month, sink_spec=args.sink, path=args.queue,
+                   pipelined=args.pipelined, force=args.force, wait_seconds=args.wait_hours * 3600,
+                   timeout_seconds=args.run_timeout_hours * 3600)
+    else:
+        work(sink_spec=args.sink, path=args.queue, exit_when_empty=args.exit_when_empty)